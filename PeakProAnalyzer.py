@@ -3,19 +3,36 @@
 import tkinter as tk
 import sys
 import os
-import openpyxl
+import warnings
+import importlib
+import tempfile
 from itertools import zip_longest
 from tkinter import filedialog, ttk, messagebox, simpledialog
 import numpy as np
+import io
+import csv
 import json
 import pickle
-from Bio import SeqIO
-from scipy.interpolate import interp1d
-from scipy.signal import find_peaks
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+import threading
+import zipfile
+import sqlite3
+import time
+import cProfile
+import pstats
+import functools
+import struct
+import re
+import hashlib
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+# Los módulos pesados (scipy, matplotlib, openpyxl) se importan en la primera
+# función que los usa, para que la portada y la ventana principal aparezcan antes.
+HEAVY_MODULES = ("scipy.signal", "scipy.interpolate", "matplotlib.figure", "matplotlib.backends.backend_tkagg", "openpyxl")
+
 
 # --- Constantes y Configuración ---
 CHANNEL_COLOR_MAP = {
@@ -39,12 +56,163 @@ CHANNEL_DISPLAY_NAME_MAP = {
     'DATA3':  'Negro',
 }
 
+SAMPLE_CHANNELS = ['DATA9', 'DATA10', 'DATA11']
+LADDER_CHANNELS = ['DATA4', 'DATA105']
+
+# Perfiles de instrumento / juego de fluorocromos. El perfil activo rellena los mapas de
+# canales de arriba y decide qué etiquetas DATA se leen de cada .fsa. Se pueden cargar
+# perfiles adicionales desde JSON con la misma estructura.
+INSTRUMENT_PROFILES = {
+    "ABI 3130/3500 (4 colores, ROX)": {
+        "channels": {
+            'DATA9': {"name": 'Azul', "color": 'blue'}, 'DATA10': {"name": 'Verde', "color": 'green'},
+            'DATA11': {"name": 'Negro', "color": 'black'}, 'DATA4': {"name": 'Rojo (Marcador)', "color": 'red'},
+        },
+        "sample_channels": ['DATA9', 'DATA10', 'DATA11'], "ladder_channels": ['DATA4', 'DATA105'],
+        "ladder_type": "GeneScan 500(-250) ROX", "start_scan": 1500, "sizing": "cubic",
+    },
+    "ABI 3500 (5 colores, LIZ)": {
+        "channels": {
+            'DATA9': {"name": 'Azul', "color": 'blue'}, 'DATA10': {"name": 'Verde', "color": 'green'},
+            'DATA11': {"name": 'Amarillo', "color": 'black'}, 'DATA12': {"name": 'Rojo', "color": 'red'},
+            'DATA105': {"name": 'Naranja (Marcador)', "color": 'orange'},
+        },
+        "sample_channels": ['DATA9', 'DATA10', 'DATA11', 'DATA12'], "ladder_channels": ['DATA105'],
+        "ladder_type": None, "start_scan": 1500, "sizing": "cubic",
+    },
+    "Canales crudos DATA1-4": {
+        "channels": {
+            'DATA1': {"name": 'Azul', "color": 'blue'}, 'DATA2': {"name": 'Verde', "color": 'green'},
+            'DATA3': {"name": 'Negro', "color": 'black'}, 'DATA4': {"name": 'Rojo (Marcador)', "color": 'red'},
+        },
+        "sample_channels": ['DATA1', 'DATA2', 'DATA3'], "ladder_channels": ['DATA4'],
+        "ladder_type": None, "start_scan": 1500, "sizing": "cubic",
+    },
+}
+DEFAULT_INSTRUMENT_PROFILE = "ABI 3130/3500 (4 colores, ROX)"
+# Métodos de calibración scan -> pb disponibles en los perfiles
+SIZING_METHODS = ("cubic", "linear")
+ACTIVE_PROFILE = {"name": DEFAULT_INSTRUMENT_PROFILE, **INSTRUMENT_PROFILES[DEFAULT_INSTRUMENT_PROFILE]}
+
+# Valores iniciales de los parámetros de detección (asistente de calibración y visor)
+DEFAULT_DETECTION_PARAMS = {
+    "ignore_scans": "1500", "width": "100", "template_tolerance": "40",
+    "height": "50", "prominence": "25", "distance": "10", "peak_height": "100",
+}
+
+# Huellas de muestra para la búsqueda por similitud: rango y anchura de bin en pb
+FINGERPRINT_RANGE_BP = (20.0, 600.0)
+FINGERPRINT_BIN_BP = 2.0
+
+# Comparación con una muestra de referencia (quimerismo, réplicas): tolerancia de emparejamiento en pb
+COMPARISON_TOLERANCE_BP = 1.0
+COMPARISON_METRICS = ["Presencia", "Ratio de altura", "Desplazamiento (pb)", "Altura (RFU)", "Tamaño (pb)"]
+
+# Informes estáticos: tamaño de página (A4 apaisado, pulgadas) y resolución
+REPORT_PAGE_SIZE = (11.69, 8.27)
+REPORT_DPI = 110
+REPORT_AXES_RECT = (0.07, 0.08, 0.91, 0.86)
+
+# Procesamiento por lotes en streaming: archivos cuyas trazas conviven en memoria a la vez
+BATCH_CHUNK_SIZE = 32
+PEAK_EXPORT_HEADERS = ['Archivo', 'Canal', 'Tamaño (pb)', 'Altura (RFU)', 'Saturado']
+
+# Servicio HTTP local (LIMS): dirección por defecto, tamaño máximo de petición y archivos decodificados en caché
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_MAX_BODY = 64 * 1024 * 1024
+SERVICE_CACHE_FILES = 256
+# Calibraciones guardadas por archivo (una por combinación de plantilla/asignaciones y parámetros)
+SERVICE_CACHE_CALIBRATIONS = 32
+
+# Intervalo de sondeo del modo de vigilancia de carpeta (ms)
+WATCH_POLL_MS = 3000
+
+# Modelo de deriva del marcador por capilar: puntos mínimos para ajustar una muestra y
+# tolerancia de plantilla derivada de la dispersión de la predicción (scans)
+DRIFT_MIN_POINTS = 3
+DRIFT_MIN_TOLERANCE = 15
+DRIFT_TOLERANCE_FACTOR = 4.0
+
+# Señal fuera de escala: scans seguidos con el mismo valor (techo plano) y RFU mínima del techo
+SATURATION_MIN_RUN = 3
+SATURATION_MIN_RFU = 1000
+
+SESSION_MANIFEST = "session.json"
+SESSION_FORMAT_VERSION = 1
+
+OVERLAY_MODES = ["Trazas", "Consenso (mediana y P10-P90)", "Diferencia vs referencia"]
+# Intervalo de sondeo del render en segundo plano del visor (ms)
+RENDER_POLL_MS = 30
+
 KNOWN_LADDERS = {
     "GeneScan 500(-250) ROX": [35, 50, 75, 100, 139, 150, 160, 200, 250, 300, 340, 350, 400, 450, 490, 500],
     "BTO 550": [60, 80, 90, 100, 120, 140, 160, 180, 200, 220, 240, 250, 260, 280, 300, 320, 340, 360, 380, 400, 425, 450, 475, 500, 525, 550],
     "BTO 560": [73, 88, 123, 148, 173, 198, 223, 248, 273, 298, 324, 349, 373, 398, 423, 448, 470, 495, 520, 545, 555]
 }
 
+def load_instrument_profile(path):
+    """Lee un perfil de instrumento en JSON; devuelve (nombre, perfil) o lanza ValueError si está incompleto."""
+    with open(path, 'r', encoding='utf-8') as f:
+        profile = json.load(f)
+    missing = [key for key in ("channels", "sample_channels", "ladder_channels") if key not in profile]
+    if missing:
+        raise ValueError(f"Faltan las claves: {', '.join(missing)}")
+    if profile.get("sizing", "cubic") not in SIZING_METHODS:
+        raise ValueError(f"Método de calibración desconocido: {profile['sizing']}")
+    unknown = [ch for ch in profile["sample_channels"] + profile["ladder_channels"] if not ch.startswith('DATA')]
+    if unknown:
+        raise ValueError(f"Canales no válidos: {', '.join(unknown)}")
+    profile.setdefault("ladder_type", None); profile.setdefault("start_scan", None); profile.setdefault("sizing", "cubic")
+    return profile.pop("name", Path(path).stem), profile
+
+def apply_instrument_profile(name, profile):
+    """Activa un perfil: actualiza en sitio los mapas y listas de canales que usa todo el programa."""
+    CHANNEL_COLOR_MAP.clear(); CHANNEL_DISPLAY_NAME_MAP.clear()
+    for channel, info in profile["channels"].items():
+        CHANNEL_COLOR_MAP[channel] = info.get("color", 'purple')
+        CHANNEL_DISPLAY_NAME_MAP[channel] = info.get("name", channel)
+    SAMPLE_CHANNELS[:] = profile["sample_channels"]
+    LADDER_CHANNELS[:] = profile["ladder_channels"]
+    ACTIVE_PROFILE.clear()
+    ACTIVE_PROFILE.update(name=name, **profile)
+
+def profile_channels():
+    """Etiquetas DATA que el perfil activo necesita leer de cada archivo."""
+    return SAMPLE_CHANNELS + [ch for ch in LADDER_CHANNELS if ch not in SAMPLE_CHANNELS]
+
+def preload_heavy_modules():
+    """Importa en segundo plano los módulos de análisis y exportación mientras el usuario ve la portada."""
+    def worker():
+        for name in HEAVY_MODULES:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+    threading.Thread(target=worker, daemon=True).start()
+
+def load_splash_image(path, width, height):
+    """
+    Devuelve la portada ya recortada al tamaño de la ventana. Con Pillow, el recorte se
+    guarda en la carpeta temporal para que los siguientes arranques decodifiquen una
+    imagen pequeña en lugar del PNG completo.
+    """
+    cached = Path(tempfile.gettempdir()) / f"peakpro_portada_{width}x{height}_{int(os.path.getmtime(path))}.png"
+    if cached.exists():
+        return tk.PhotoImage(file=str(cached))
+    try:
+        from PIL import Image
+    except ImportError:
+        return tk.PhotoImage(file=path)
+    try:
+        with Image.open(path) as image:
+            # Mismo encuadre que mostraba la etiqueta con la imagen completa: centrado y sin escalar
+            left = max(0, (image.width - width) // 2); top = max(0, (image.height - height) // 2)
+            image.crop((left, top, left + min(width, image.width), top + min(height, image.height))).save(cached)
+    except OSError:
+        return tk.PhotoImage(file=path)
+    return tk.PhotoImage(file=str(cached))
+
 def resource_path(relative_path):
     """ Obtiene la ruta absoluta al recurso, funciona para desarrollo y para PyInstaller """
     try:
@@ -55,6 +223,1872 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+# --- Instrumentación de Rendimiento ---
+class PerfRecorder:
+    """
+    Registra la duración de las etapas críticas (lectura, línea base, tamaño en pb,
+    find_peaks, tabla, dibujo) en un búfer circular en memoria, con totales por etapa
+    y captura opcional de cProfile.
+    """
+
+    def __init__(self, capacity=5000):
+        self.events = deque(maxlen=capacity)
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._profiler = None
+        self.last_profile = ""
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorador equivalente a envolver toda la función en 'stage(name)'."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.events.append((time.time(), name, seconds))
+            count, total, longest = self.stats.get(name, (0, 0.0, 0.0))
+            self.stats[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def summary(self):
+        """Lista de (etapa, llamadas, total s, media s, máximo s), de mayor a menor tiempo total."""
+        with self._lock:
+            rows = [(name, count, total, total / count, longest) for name, (count, total, longest) in self.stats.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.events.clear()
+            self.stats = {}
+
+    @property
+    def profiling(self):
+        return self._profiler is not None
+
+    def start_profiling(self):
+        if self._profiler is None:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop_profiling(self):
+        """Detiene cProfile y devuelve el informe de las funciones más costosas."""
+        if self._profiler is None:
+            return ""
+        self._profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(40)
+        self._profiler = None
+        self.last_profile = stream.getvalue()
+        return self.last_profile
+
+    def dump(self, filepath):
+        """Guarda totales, eventos recientes y el último perfil en JSON para adjuntar a un informe de error."""
+        report = {
+            "summary": [dict(zip(("stage", "calls", "total_s", "mean_s", "max_s"), row)) for row in self.summary()],
+            "events": [{"time": t, "stage": name, "seconds": seconds} for t, name, seconds in list(self.events)],
+            "cprofile": self.last_profile,
+        }
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+PERF = PerfRecorder()
+
+# --- Caché de Picos ---
+class PeakCache:
+    """
+    Picos ya detectados, compartidos por el asistente de calibración, el visor y los hilos
+    de trabajo. Hay una entrada por (archivo, canal, método de línea base); si cambian los
+    parámetros de detección, la entrada se sustituye. Los índices se guardan en scans, así
+    que una recalibración no invalida nada: el paso a pb se hace al leer.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename, channel, method, params, compute):
+        """Devuelve el resultado cacheado para estos parámetros o lo calcula con compute()."""
+        slot = (filename, channel, method)
+        with self._lock:
+            entry = self._entries.get(slot)
+            if entry is not None and entry[0] == params:
+                self._entries.move_to_end(slot)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        result = compute()
+        with self._lock:
+            self._entries[slot] = (params, result)
+            self._entries.move_to_end(slot)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self, filename):
+        """Descarta todo lo cacheado de un archivo (p. ej. si se ha vuelto a leer)."""
+        with self._lock:
+            for slot in [slot for slot in self._entries if slot[0] == filename]:
+                del self._entries[slot]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+PEAK_CACHE = PeakCache()
+
+# --- Funciones de Análisis ---
+def detect_data_start(traces, window=51, search_fraction=0.4, noise_factor=5.0, dominance=2.0, margin=50):
+    """
+    Detecta el inicio de los datos útiles (fin del frente de primer o de la zona
+    saturada inicial) para un lote de trazas en un único pase vectorizado.
+
+    Devuelve un array con el primer scan útil de cada traza (0 si no hay frente).
+    """
+    if not traces:
+        return np.zeros(0, dtype=int)
+
+    lengths = np.array([len(t) for t in traces])
+    max_len = int(lengths.max())
+    if max_len < window * 2:
+        return np.zeros(len(traces), dtype=int)
+
+    # Matriz (muestras x scans) rellenada con ceros más allá de cada longitud
+    matrix = np.zeros((len(traces), max_len), dtype=np.float64)
+    for row, trace in enumerate(traces):
+        matrix[row, :len(trace)] = trace
+
+    # Media móvil con suma acumulada; las ventanas que salen de la traza se anulan con NaN
+    cumsum = np.cumsum(np.pad(matrix, ((0, 0), (1, 0))), axis=1)
+    smoothed = (cumsum[:, window:] - cumsum[:, :-window]) / window
+    positions = np.arange(smoothed.shape[1])
+    valid = positions[None, :] <= (lengths - window)[:, None]
+    smoothed[~valid] = np.nan
+
+    # Línea base y ruido estimados en la segunda mitad de cada traza
+    # (las trazas demasiado cortas quedan todo NaN y no se recortan)
+    tail = np.where(positions[None, :] >= (lengths // 2)[:, None], smoothed, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        baseline = np.nanmedian(tail, axis=1)
+        noise = np.maximum(np.nanmedian(np.abs(tail - baseline[:, None]), axis=1) * 1.4826, 1.0)
+    threshold = baseline + noise_factor * noise
+
+    # El frente es el máximo (suavizado) de la zona inicial; debe destacar sobre la línea base
+    # y dominar a los picos del resto de la traza, que el suavizado atenúa por ser estrechos
+    in_early = positions[None, :] < (lengths * search_fraction)[:, None]
+    early = np.where(in_early, smoothed, -np.inf)
+    late = np.where(~in_early, smoothed, -np.inf)
+    early[np.isnan(early)] = -np.inf
+    late[np.isnan(late)] = -np.inf
+    front_idx = np.argmax(early, axis=1)
+    front_height = early[np.arange(len(traces)), front_idx] - baseline
+    late_height = np.maximum(late.max(axis=1) - baseline, 0)
+    has_front = (front_height > 4 * noise_factor * noise) & (front_height > dominance * late_height)
+
+    # Primer punto tras el frente en el que la señal vuelve a la línea base
+    returned = (smoothed <= threshold[:, None]) & (positions[None, :] > front_idx[:, None])
+    first_return = np.argmax(returned, axis=1)
+    found = has_front & returned.any(axis=1)
+
+    starts = np.where(found, first_return + window // 2 + margin, 0)
+    starts = np.minimum(starts, np.maximum(lengths - 1, 0))
+    return starts.astype(int)
+
+def combine_start_channels(channels):
+    """Suma los canales de muestra y marcador de un archivo para detectar su inicio útil."""
+    keys = [ch for ch in SAMPLE_CHANNELS + LADDER_CHANNELS if ch in channels] or list(channels)
+    n_scans = min((len(channels[ch]) for ch in keys), default=0)
+    return np.sum([channels[ch][:n_scans] for ch in keys], axis=0) if n_scans else np.zeros(0)
+
+@PERF.timed("Línea base")
+def clean_trace_hammock(y_data, num_chunks=30):
+    """Resta una línea base tipo 'hamaca' anclada en el mínimo de cada tramo de la traza."""
+    if len(y_data) < num_chunks * 2: return y_data
+    x_points = np.arange(len(y_data)); chunk_size = len(y_data) // num_chunks
+    if chunk_size == 0: return y_data
+    anchor_x = [0]; anchor_y = [y_data[0]]
+    for i in range(num_chunks):
+        start = i * chunk_size; end = start + chunk_size
+        chunk = y_data[start:end]
+        if chunk.size > 0:
+            min_index_in_chunk = np.argmin(chunk)
+            anchor_x.append(start + min_index_in_chunk); anchor_y.append(chunk[min_index_in_chunk])
+    anchor_x.append(len(y_data) - 1); anchor_y.append(y_data[-1])
+    baseline = np.interp(x_points, anchor_x, anchor_y)
+    cleaned_data = y_data - baseline; cleaned_data[cleaned_data < 0] = 0
+    return cleaned_data
+
+def detect_ladder_peaks(raw_data, start_scan, height, prominence, distance, cache_key=None):
+    """
+    Detecta los picos del marcador a partir de 'start_scan'; devuelve sus índices absolutos.
+    Con cache_key=(archivo, canal) el resultado se comparte a través de PEAK_CACHE.
+    """
+    if start_scan >= len(raw_data):
+        return np.array([], dtype=int)
+
+    def compute():
+        from scipy.signal import find_peaks
+        with PERF.stage("find_peaks"):
+            indices_relative, _ = find_peaks(raw_data[start_scan:], height=height, prominence=prominence, distance=distance)
+        return indices_relative + start_scan
+
+    if cache_key is None:
+        return compute()
+    return PEAK_CACHE.get(*cache_key, "raw", (start_scan, height, prominence, distance), compute)
+
+def _select_by_peak_distance(positions, heights, distance):
+    """Misma regla que find_peaks(distance=...): los picos más altos eliminan a sus vecinos más cercanos que 'distance'."""
+    keep = np.ones(len(positions), dtype=bool)
+    lo = np.searchsorted(positions, positions - distance, side='right')
+    hi = np.searchsorted(positions, positions + distance, side='left')
+    # Los picos sin vecinos dentro de la distancia no compiten con nadie
+    crowded = (hi - lo) > 1
+    order = np.argsort(heights)[::-1]
+    for i in order[crowded[order]].tolist():
+        if keep[i]:
+            keep[lo[i]:i] = False; keep[i + 1:hi[i]] = False
+    return keep
+
+class LadderPeakSweep:
+    """
+    Candidatos a pico del marcador calculados una sola vez con la altura mínima del barrido.
+    select() reproduce find_peaks(height, prominence, distance) filtrando esos candidatos
+    en NumPy, sin volver a recorrer la traza.
+    """
+
+    def __init__(self, raw_data, start_scan, min_height):
+        from scipy.signal import find_peaks
+        self.start_scan = start_scan
+        if start_scan >= len(raw_data):
+            indices, props = np.array([], dtype=int), {'peak_heights': np.array([]), 'prominences': np.array([])}
+        else:
+            with PERF.stage("find_peaks"):
+                # prominence=0 no descarta nada pero devuelve la prominencia de todos los candidatos
+                indices, props = find_peaks(raw_data[start_scan:], height=min_height, prominence=0)
+        self.positions = indices + start_scan
+        self.heights = props['peak_heights']
+        self.prominences = props['prominences']
+
+    def select(self, height, prominence, distance):
+        """Índices absolutos que devolvería detect_ladder_peaks con estos umbrales (height >= altura del barrido)."""
+        candidates = np.flatnonzero(self.heights >= height)
+        distance = int(np.ceil(distance))
+        if distance > 1 and len(candidates) > 1:
+            candidates = candidates[_select_by_peak_distance(self.positions[candidates], self.heights[candidates], distance)]
+        candidates = candidates[self.prominences[candidates] >= prominence]
+        return self.positions[candidates]
+
+def assign_from_template(detected_peaks, template, tolerance):
+    """
+    Asigna tamaños de la plantilla {pb: scan} a los picos detectados más cercanos,
+    recorriendo ambas listas en orden para no reutilizar ni cruzar picos.
+    Devuelve las asignaciones {scan: pb}.
+    """
+    assignments = {}
+
+    # 1. Preparamos las dos listas, ambas ordenadas
+    # La plantilla, ordenada por tamaño de fragmento (bp)
+    template_peaks_sorted = sorted(template.items())
+    # Los picos detectados, ordenados por posición (scan point)
+    detected_peaks_sorted = sorted(list(detected_peaks))
+
+    # Índice para no volver a usar un pico detectado
+    last_detected_idx = 0
+
+    # 2. Iteramos por la plantilla en orden
+    for bp_size, template_scan_point in template_peaks_sorted:
+
+        # El espacio de búsqueda son solo los picos detectados que aún no hemos usado
+        search_space = detected_peaks_sorted[last_detected_idx:]
+        if len(search_space) == 0:
+            break # No quedan más picos que asignar
+
+        # Buscamos la distancia al pico más cercano en el espacio de búsqueda
+        distances = np.abs(np.array(search_space) - template_scan_point)
+
+        # Si la distancia mínima está dentro de la tolerancia...
+        if np.min(distances) < tolerance:
+            # ...encontramos su posición y lo asignamos
+            best_local_idx = np.argmin(distances)
+            assignments[search_space[best_local_idx]] = bp_size
+
+            # IMPORTANTE: la próxima búsqueda empieza DESPUÉS de este pico
+            last_detected_idx += best_local_idx + 1
+
+    return assignments
+
+def build_calibration(assignments, method=None):
+    """
+    Ajusta la función scan -> pb a partir de los puntos asignados {scan: pb}. 'method' es uno
+    de SIZING_METHODS; por defecto, el del perfil de instrumento activo.
+    """
+    from scipy.interpolate import interp1d
+    num_points = len(assignments)
+    method = method or ACTIVE_PROFILE.get("sizing", "cubic")
+    if method == "linear":
+        kind = 'linear'
+    else:
+        kind = 'cubic' if num_points >= 4 else ('quadratic' if num_points == 3 else 'linear')
+    sorted_points = sorted(assignments.items())
+    scan_points = np.array([p[0] for p in sorted_points])
+    bp_sizes = np.array([p[1] for p in sorted_points])
+    return interp1d(scan_points, bp_sizes, kind=kind, fill_value="extrapolate")
+
+class CalibrationState:
+    """
+    Puntos de calibración {scan: pb} de una muestra con historial de deshacer/rehacer. Cada
+    comando guarda solo los puntos que cambia (valor anterior y nuevo, None = sin asignar),
+    los nodos se mantienen ordenados insertando en su posición y el ajuste scan -> pb se
+    recalcula solo cuando cambia el conjunto de puntos; los ajustes recientes se conservan,
+    así que deshacer y rehacer no vuelven a ajustar.
+    """
+    HISTORY_LIMIT = 200
+    FIT_CACHE_SIZE = 16
+
+    def __init__(self, assignments=None, method=None):
+        self.method = method
+        self.scans = np.array([], dtype=np.int64)
+        self.bps = np.array([], dtype=float)
+        self._undo = deque(maxlen=self.HISTORY_LIMIT)
+        self._redo = []
+        self._fits = OrderedDict()
+        for scan, bp in (assignments or {}).items():
+            self._set_point(int(scan), bp)
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __contains__(self, scan):
+        return self.get(scan) is not None
+
+    @property
+    def assignments(self):
+        return dict(zip(self.scans.tolist(), self.bps.tolist()))
+
+    def get(self, scan):
+        i = np.searchsorted(self.scans, scan)
+        return float(self.bps[i]) if i < len(self.scans) and self.scans[i] == scan else None
+
+    def _set_point(self, scan, bp):
+        i = np.searchsorted(self.scans, scan)
+        exists = i < len(self.scans) and self.scans[i] == scan
+        if bp is None:
+            if exists:
+                self.scans = np.delete(self.scans, i); self.bps = np.delete(self.bps, i)
+        elif exists:
+            self.bps[i] = bp
+        else:
+            self.scans = np.insert(self.scans, i, scan); self.bps = np.insert(self.bps, i, bp)
+
+    def apply(self, label, changes):
+        """Aplica {scan: pb o None (borrar)} como un único comando. Devuelve False si no cambia nada."""
+        before = {int(scan): self.get(scan) for scan in changes}
+        after = {int(scan): (None if bp is None else float(bp)) for scan, bp in changes.items()}
+        after = {scan: bp for scan, bp in after.items() if before[scan] != bp}
+        if not after:
+            return False
+        for scan, bp in after.items():
+            self._set_point(scan, bp)
+        self._undo.append((label, {scan: before[scan] for scan in after}, after))
+        self._redo.clear()
+        return True
+
+    def assign(self, scan, bp):
+        return self.apply("Asignar", {scan: bp})
+
+    def remove(self, scan):
+        return self.apply("Borrar", {scan: None})
+
+    def replace(self, label, assignments):
+        """Sustituye todos los puntos por 'assignments' en un solo comando."""
+        changes = {scan: None for scan in self.scans.tolist() if scan not in assignments}
+        changes.update(assignments)
+        return self.apply(label, changes)
+
+    def clear(self):
+        return self.replace("Limpiar", {})
+
+    def undo(self):
+        """Deshace el último comando y devuelve su nombre (None si no hay nada que deshacer)."""
+        if not self._undo:
+            return None
+        label, before, after = self._undo.pop()
+        for scan, bp in before.items():
+            self._set_point(scan, bp)
+        self._redo.append((label, before, after))
+        return label
+
+    def redo(self):
+        if not self._redo:
+            return None
+        label, before, after = self._redo.pop()
+        for scan, bp in after.items():
+            self._set_point(scan, bp)
+        self._undo.append((label, before, after))
+        return label
+
+    @property
+    def undo_label(self):
+        return self._undo[-1][0] if self._undo else None
+
+    @property
+    def redo_label(self):
+        return self._redo[-1][0] if self._redo else None
+
+    def fit(self):
+        """Función scan -> pb de los puntos actuales (None con menos de 2 puntos)."""
+        if len(self.scans) < 2:
+            return None
+        key = (self.scans.tobytes(), self.bps.tobytes())
+        fit = self._fits.get(key)
+        if fit is None:
+            fit = self._fits[key] = build_calibration(self.assignments, self.method)
+            while len(self._fits) > self.FIT_CACHE_SIZE:
+                self._fits.popitem(last=False)
+        else:
+            self._fits.move_to_end(key)
+        return fit
+
+def auto_calibrate(ladder_trace, start_scan, template, params):
+    """
+    Calibra una muestra sin intervención: detecta el marcador con los parámetros del
+    asistente y asigna la plantilla. Devuelve (función, asignaciones) o None.
+    """
+    peaks = detect_ladder_peaks(ladder_trace, start_scan, float(params["height"]), float(params["prominence"]), int(params["distance"]))
+    assignments = assign_from_template(peaks, template, int(params["template_tolerance"]))
+    if len(assignments) < 2:
+        return None
+    return build_calibration(assignments), assignments
+
+class DriftModel:
+    """
+    Deriva del marcador entre muestras de una misma tanda. Cada muestra calibrada aporta un
+    ajuste scan = escala * scan_plantilla + desplazamiento para su capilar; la predicción usa
+    la mediana de los ajustes de ese capilar o, si aún no hay ninguno, la de toda la tanda.
+    Los ajustes se guardan por muestra: volver a observar una muestra sustituye su ajuste.
+    """
+    def __init__(self, reference):
+        # Plantilla de referencia {pb: scan}, normalmente la de la primera muestra
+        self.reference = {float(bp): float(scan) for bp, scan in reference.items()}
+        self._fits = {}
+
+    def __len__(self):
+        return sum(len(fits) for fits in self._fits.values())
+
+    def copy(self):
+        model = DriftModel({})
+        model.reference = dict(self.reference)
+        model._fits = {capillary: dict(fits) for capillary, fits in self._fits.items()}
+        return model
+
+    def forget(self, key):
+        """Descarta el ajuste de la muestra 'key', si lo hay."""
+        for fits in self._fits.values():
+            fits.pop(key, None)
+
+    def observe(self, capillary, assignments, key=None):
+        """
+        Añade las asignaciones {scan: pb} de una muestra calibrada; con 'key' (su ruta) sustituyen
+        a las observadas antes para esa muestra. Devuelve el ajuste o None.
+        """
+        if key is not None:
+            self.forget(key)
+        pairs = [(self.reference[float(bp)], float(scan)) for scan, bp in assignments.items() if float(bp) in self.reference]
+        if len(pairs) < DRIFT_MIN_POINTS:
+            return None
+        ref_scans, scans = np.array(pairs).T
+        scale, shift = np.polyfit(ref_scans, scans, 1)
+        rms = float(np.sqrt(np.mean((scans - (scale * ref_scans + shift)) ** 2)))
+        fit = (float(scale), float(shift), rms)
+        # Sin clave, cada observación cuenta como una muestra distinta
+        self._fits.setdefault(capillary, {})[object() if key is None else key] = fit
+        return fit
+
+    def predict(self, capillary=None):
+        """
+        Devuelve (plantilla {pb: scan} esperada para el capilar, tolerancia sugerida). Sin
+        ningún ajuste la plantilla es la de referencia y la tolerancia None.
+        """
+        fits = list(self._fits.get(capillary, {}).values()) or [fit for fits in self._fits.values() for fit in fits.values()]
+        if not fits:
+            return {bp: int(round(scan)) for bp, scan in self.reference.items()}, None
+        fits = np.array(fits)
+        scale, shift, rms = np.median(fits, axis=0)
+        bps = list(self.reference)
+        ref_scans = np.array([self.reference[bp] for bp in bps])
+        template = dict(zip(bps, np.rint(scale * ref_scans + shift).astype(int).tolist()))
+        if len(fits) < 2:
+            # Un solo ajuste no dice cuánto varía la deriva entre muestras: se mantiene la tolerancia del usuario
+            return template, None
+        # Dispersión entre muestras de la posición prevista de cada pico, más el residuo del ajuste
+        spread = np.std(fits[:, :1] * ref_scans + fits[:, 1:2], axis=0).max()
+        sigma = np.hypot(rms, spread)
+        return template, max(DRIFT_MIN_TOLERANCE, int(np.ceil(DRIFT_TOLERANCE_FACTOR * sigma)))
+
+    def template_for(self, capillary, tolerance):
+        """
+        Plantilla prevista para el capilar y tolerancia a usar con ella: la del usuario, reducida
+        a la sugerida por el modelo cuando este ya tiene suficientes ajustes para sugerir una.
+        """
+        template, drift_tolerance = self.predict(capillary)
+        return template, tolerance if drift_tolerance is None else min(tolerance, drift_tolerance)
+
+# Entrada de directorio ABIF: nombre, número, tipo, tamaño de elemento, nº de elementos,
+# tamaño de datos, desplazamiento (o los propios datos si ocupan <= 4 bytes) y handle
+ABIF_DIR_ENTRY = struct.Struct('>4sIHHIIII')
+ABIF_CHAR, ABIF_SHORT, ABIF_LONG, ABIF_DATE, ABIF_TIME, ABIF_PSTRING, ABIF_CSTRING = 2, 4, 5, 10, 11, 18, 19
+# Metadatos de muestra que se leen del .fsa: clave -> (etiqueta, número)
+ABIF_METADATA_TAGS = {
+    "sample": (b'SMPL', 1), "well": (b'TUBE', 1), "capillary": (b'LANE', 1), "plate": (b'CTID', 1),
+    "run_date": (b'RUND', 1), "run_time": (b'RUNT', 1), "instrument": (b'MCHN', 1), "model": (b'MODL', 1),
+    "offscale": (b'OfSc', 1),
+}
+# Columnas del índice de muestras y su rótulo en la interfaz y las exportaciones
+SAMPLE_INDEX_COLUMNS = {
+    "file": "Archivo", "sample": "Muestra", "well": "Pocillo", "capillary": "Capilar",
+    "plate": "Placa", "run_date": "Fecha de ejecución", "instrument": "Instrumento", "saturated": "Saturación",
+}
+
+def read_abif_directory(raw):
+    """Devuelve las entradas del directorio de un archivo ABIF ya leído en memoria."""
+    if raw[:4] != b'ABIF':
+        raise ValueError("No es un archivo ABIF (.fsa/.ab1)")
+    header = ABIF_DIR_ENTRY.unpack_from(raw, 6)
+    n_entries, dir_offset = header[4], header[6]
+    return [ABIF_DIR_ENTRY.unpack_from(raw, dir_offset + k * ABIF_DIR_ENTRY.size) for k in range(n_entries)]
+
+def read_fsa_channels(path, channels=None):
+    """
+    Lee un archivo .fsa y devuelve sus canales de datos {DATAn: array}. Con 'channels' solo
+    se decodifican esas etiquetas; si el archivo no tiene ninguna (otro instrumento), se
+    devuelven todas para que el usuario pueda elegir.
+    """
+    return read_fsa_file(path, channels)[0]
+
+@PERF.timed("Lectura .fsa")
+def read_fsa_file(path, channels=None):
+    """Como read_fsa_channels, pero devuelve también los metadatos: (canales, metadatos)."""
+    with open(path, 'rb') as handle: raw = handle.read()
+    channels = parse_fsa_bytes(raw, channels)
+    metadata = parse_fsa_metadata(raw)
+    metadata["saturation"] = detect_saturation(channels, metadata.get("offscale"))
+    return channels, metadata
+
+def parse_fsa_bytes(raw, channels=None):
+    """Como read_fsa_channels, pero a partir del contenido del archivo ya en memoria."""
+    entries = [entry for entry in read_abif_directory(raw) if entry[0] == b'DATA' and entry[2] == ABIF_SHORT]
+    available = {f"DATA{entry[1]}": entry for entry in entries}
+    wanted = [ch for ch in channels if ch in available] if channels is not None else []
+    result = {}
+    for tag in wanted or list(available):
+        _, _, _, _, n_elements, data_size, data_offset, _ = available[tag]
+        if data_size <= 4:
+            data = np.frombuffer(ABIF_DIR_ENTRY.pack(*available[tag])[20:20 + data_size], dtype='>i2', count=n_elements)
+        else:
+            data = np.frombuffer(raw, dtype='>i2', count=n_elements, offset=data_offset)
+        result[tag] = data.astype(np.int64)
+    return result
+
+def find_saturated_regions(trace, min_run=SATURATION_MIN_RUN, min_rfu=SATURATION_MIN_RFU):
+    """
+    Tramos [inicio, fin] (scans) en los que la señal queda plana en el techo del detector:
+    al menos 'min_run' scans seguidos con el mismo valor, igual o superior a 'min_rfu'.
+    """
+    if len(trace) < min_run:
+        return np.empty((0, 2), dtype=np.int64)
+    flat = (trace[1:] == trace[:-1]) & (trace[1:] >= min_rfu)
+    edges = np.diff(flat.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    # k diferencias nulas seguidas abarcan k + 1 scans
+    keep = ends - starts + 1 >= min_run
+    return np.column_stack((starts[keep], ends[keep]))
+
+def detect_saturation(channels, offscale=None):
+    """
+    {canal: [[inicio, fin], ...]} con los tramos fuera de escala de cada canal recién
+    decodificado. Los scans que el propio instrumento marca como fuera de escala (OfSc) se
+    añaden a los canales cuya señal supera allí SATURATION_MIN_RFU.
+    """
+    if isinstance(offscale, int):
+        offscale = [offscale]
+    offscale = np.asarray(offscale or [], dtype=np.int64)
+    saturation = {}
+    for channel, trace in channels.items():
+        regions = find_saturated_regions(trace)
+        reported = offscale[(offscale >= 0) & (offscale < len(trace))]
+        reported = reported[trace[reported] >= SATURATION_MIN_RFU]
+        if len(reported):
+            regions = np.concatenate((regions, np.column_stack((reported, reported))))
+            regions = regions[np.argsort(regions[:, 0], kind='stable')]
+            # Fusiona los tramos solapados o contiguos
+            ends = np.maximum.accumulate(regions[:, 1])
+            new_group = np.concatenate(([True], regions[1:, 0] > ends[:-1] + 1))
+            last = np.append(np.flatnonzero(new_group)[1:] - 1, len(regions) - 1)
+            regions = np.column_stack((regions[new_group, 0], ends[last]))
+        if len(regions):
+            saturation[channel] = regions.tolist()
+    return saturation
+
+def trim_saturation(saturation, start_scan):
+    """Descarta los tramos anteriores al inicio útil (frente del primer), que no afectan al análisis."""
+    trimmed = {ch: [region for region in regions if region[1] >= start_scan] for ch, regions in saturation.items()}
+    return {ch: regions for ch, regions in trimmed.items() if regions}
+
+def saturated_peak_mask(sizes_bp, regions, calib_func):
+    """Máscara de los picos (en pb) que caen dentro de algún tramo saturado del canal."""
+    sizes_bp = np.asarray(sizes_bp, dtype=float)
+    if not regions or len(sizes_bp) == 0:
+        return np.zeros(len(sizes_bp), dtype=bool)
+    # Un scan de margen a cada lado: el vértice de un techo plano puede desplazarse al limpiar la línea base
+    bounds = calib_func(np.asarray(regions, dtype=float) + [-1.0, 1.0])
+    lo, hi = np.minimum(bounds[:, 0], bounds[:, 1]), np.maximum(bounds[:, 0], bounds[:, 1])
+    order = np.argsort(lo)
+    lo, hi = lo[order], np.maximum.accumulate(hi[order])
+    index = np.searchsorted(lo, sizes_bp, side='right') - 1
+    return (index >= 0) & (sizes_bp <= hi[np.maximum(index, 0)])
+
+def _abif_value(raw, entry):
+    """Decodifica el valor de una entrada de texto o entera del directorio ABIF."""
+    _, _, elem_type, _, n_elements, data_size, data_offset, _ = entry
+    data = ABIF_DIR_ENTRY.pack(*entry)[20:20 + data_size] if data_size <= 4 else raw[data_offset:data_offset + data_size]
+    if elem_type == ABIF_PSTRING:
+        return data[1:1 + data[0]].decode('latin-1')
+    if elem_type in (ABIF_CSTRING, ABIF_CHAR):
+        return data.split(b'\x00', 1)[0].decode('latin-1')
+    if elem_type == ABIF_DATE:
+        year, month, day = struct.unpack('>hBB', data[:4])
+        return f"{year:04d}-{month:02d}-{day:02d}"
+    if elem_type == ABIF_TIME:
+        return "{:02d}:{:02d}:{:02d}".format(*data[:3])
+    if elem_type in (ABIF_SHORT, ABIF_LONG):
+        values = np.frombuffer(data, dtype='>i2' if elem_type == ABIF_SHORT else '>i4', count=n_elements)
+        return int(values[0]) if n_elements == 1 else values.tolist()
+    return None
+
+def parse_fsa_metadata(raw):
+    """Metadatos de la muestra (nombre, pocillo, capilar) presentes en el archivo ya en memoria."""
+    wanted = {tag: key for key, tag in ABIF_METADATA_TAGS.items()}
+    metadata = {}
+    for entry in read_abif_directory(raw):
+        key = wanted.get((entry[0], entry[1]))
+        if key is not None:
+            metadata[key] = _abif_value(raw, entry)
+    return metadata
+
+def _well_order(well):
+    """Posición de un pocillo ('A01', 'H12'...) en el orden de inyección: columna a columna."""
+    match = re.fullmatch(r'\s*([A-Za-z])\s*0*(\d+)\s*', str(well)) if well is not None else None
+    if match is None:
+        return -1
+    return int(match.group(2)) * 26 + ord(match.group(1).upper()) - ord('A')
+
+class SampleIndex:
+    """
+    Tabla columnar con los metadatos de las muestras cargadas (una columna por campo de
+    SAMPLE_INDEX_COLUMNS), construida durante la carga. Filtra, ordena y agrupa lotes
+    grandes sin volver a leer ningún archivo.
+    """
+    def __init__(self, paths=(), metadata=None):
+        metadata = metadata or {}
+        self.paths = []
+        self._columns = {key: [] for key in SAMPLE_INDEX_COLUMNS}
+        self._arrays = None
+        for path in paths:
+            self.append(path, metadata.get(Path(path).name, {}))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _row(self, path, metadata):
+        saturated = [CHANNEL_DISPLAY_NAME_MAP.get(ch, ch) for ch, regions in metadata.get("saturation", {}).items() if regions]
+        row = {}
+        for key in self._columns:
+            if key == "file":
+                row[key] = Path(path).name
+            elif key == "saturated":
+                row[key] = ", ".join(saturated) if saturated else None
+            else:
+                row[key] = metadata.get(key)
+        return row
+
+    def append(self, path, metadata):
+        self.paths.append(path)
+        for key, value in self._row(path, metadata).items():
+            self._columns[key].append(value)
+        self._arrays = None
+
+    def update(self, path, metadata):
+        """Sustituye los metadatos de una ruta ya indexada (p. ej. un archivo reescrito)."""
+        index = self.paths.index(path)
+        for key, value in self._row(path, metadata).items():
+            self._columns[key][index] = value
+        self._arrays = None
+
+    def _array(self, key):
+        if self._arrays is None:
+            self._arrays = {key: np.array(values + [None], dtype=object)[:-1] for key, values in self._columns.items()}
+            # Texto de búsqueda de cada fila: todas sus columnas en minúsculas
+            self._arrays["_text"] = np.array([" ".join(str(v).lower() for v in row if v is not None)
+                                              for row in zip(*self._columns.values())], dtype=str)
+        return self._arrays[key]
+
+    def value(self, index, key):
+        return self._columns[key][index]
+
+    def match(self, text):
+        """Máscara de las filas que contienen 'text' en cualquiera de sus columnas."""
+        text = text.strip().lower()
+        if not text or not self.paths:
+            return np.ones(len(self.paths), dtype=bool)
+        return np.char.find(self._array("_text"), text) >= 0
+
+    def order(self, key, mask=None):
+        """Índices de las filas (opcionalmente solo las de 'mask') ordenadas por la columna 'key'."""
+        cache_key = ("order", key)
+        values = self._array(key)
+        if cache_key not in self._arrays:
+            missing = np.array([v is None for v in values], dtype=bool)
+            if key == "well":
+                sort_key = np.array([_well_order(v) for v in values], dtype=np.int64)
+            elif key == "capillary":
+                sort_key = np.array([v if isinstance(v, int) else -1 for v in values], dtype=np.int64)
+            else:
+                sort_key = np.array(["" if v is None else str(v) for v in values], dtype=str)
+            # Orden principal por la columna (vacíos al final) y, a igualdad, por nombre de archivo
+            self._arrays[cache_key] = np.lexsort((self._array("file").astype(str), sort_key, missing))
+        indices = self._arrays[cache_key]
+        return indices if mask is None else indices[mask[indices]]
+
+    def groups(self, key, indices=None):
+        """{valor: [rutas]} de la columna 'key', en el orden de 'indices'."""
+        grouped = OrderedDict()
+        for index in (range(len(self.paths)) if indices is None else indices):
+            grouped.setdefault(self._columns[key][index], []).append(self.paths[index])
+        return grouped
+
+    def table(self, paths=None):
+        """(cabeceras, filas) con los metadatos de las rutas indicadas, para exportar."""
+        positions = {path: index for index, path in enumerate(self.paths)}
+        indices = [positions[p] for p in paths if p in positions] if paths is not None else range(len(self.paths))
+        rows = [["" if self._columns[key][i] is None else self._columns[key][i] for key in SAMPLE_INDEX_COLUMNS] for i in indices]
+        return list(SAMPLE_INDEX_COLUMNS.values()), rows
+
+def detect_sample_peaks(y_raw, calib_func, min_height, cache_key=None):
+    """
+    Limpia la línea base de un canal de muestra y devuelve (tamaños en pb, alturas) de sus picos.
+    Con cache_key=(archivo, canal) la detección en scans se reutiliza a través de PEAK_CACHE.
+    """
+    def compute():
+        from scipy.signal import find_peaks
+        y_cleaned = clean_trace_hammock(y_raw)
+        with PERF.stage("find_peaks"):
+            indices, props = find_peaks(y_cleaned, height=min_height, prominence=min_height/4)
+        return indices, props['peak_heights']
+
+    if cache_key is None:
+        indices, heights = compute()
+    else:
+        indices, heights = PEAK_CACHE.get(*cache_key, "hammock", (min_height,), compute)
+    if len(indices) == 0:
+        return np.array([]), np.array([])
+    with PERF.stage("Tamaño en pb"):
+        sizes_bp = calib_func(indices)
+    return sizes_bp, heights
+
+def draw_sample_axes(ax, filename_key, channels_data, calib_data, sample_channels, ladder_channel, xlim):
+    """
+    Dibuja el electroferograma de una muestra (marcador, canales de muestra y puntos de
+    calibración) en un eje. Lo usan el visor interactivo y la generación sin interfaz.
+    """
+    ax.set_title(filename_key, fontsize=10)
+    if calib_data is None:
+        ax.text(0.5, 0.5, "Calibración saltada", color='red', ha='center', transform=ax.transAxes)
+        return []
+    local_calib_func, assigned_peaks = calib_data
+    sample_lines = []
+    # Trazas cuyo eje x depende de la calibración (para poder recalibrar sin redibujar el eje)
+    ax.bp_lines = []
+    ax.calibration_marks = []
+    if ladder_channel in channels_data:
+        y_ladder = channels_data[ladder_channel]
+        with PERF.stage("Tamaño en pb"):
+            x_bp_ladder = local_calib_func(np.arange(len(y_ladder)))
+        ladder_display_name = CHANNEL_DISPLAY_NAME_MAP.get(ladder_channel, ladder_channel)
+        ax.bp_lines.append(ax.plot(x_bp_ladder, y_ladder, color='grey', alpha=0.4, linewidth=1, label=f'Marcador ({ladder_display_name})')[0])
+    for sample_ch in sample_channels:
+        if sample_ch in channels_data:
+            y_sample_cleaned = clean_trace_hammock(channels_data[sample_ch])
+            with PERF.stage("Tamaño en pb"):
+                x_bp_sample = local_calib_func(np.arange(len(y_sample_cleaned)))
+            color = CHANNEL_COLOR_MAP.get(sample_ch, 'purple')
+            display_name = CHANNEL_DISPLAY_NAME_MAP.get(sample_ch, sample_ch)
+            line, = ax.plot(x_bp_sample, y_sample_cleaned, color=color, label=display_name, linewidth=1.2)
+            line.full_data = (x_bp_sample, y_sample_cleaned)
+            sample_lines.append(line)
+            ax.bp_lines.append(line)
+    if ladder_channel in channels_data:
+        ax.calibration_marks = draw_calibration_marks(ax, assigned_peaks, channels_data[ladder_channel])
+    ax.grid(True, linestyle=':'); ax.legend(fontsize='small'); ax.set_xlim(*xlim); ax.set_ylabel("RFU")
+    return sample_lines
+
+def draw_calibration_marks(ax, assigned_peaks, y_ladder):
+    """Líneas y etiquetas de los puntos de calibración {scan: pb} sobre el marcador. Devuelve los artistas."""
+    artists = []
+    for scan_point, bp_size in assigned_peaks.items():
+        scan_point = int(scan_point)
+        if scan_point < len(y_ladder):
+            rfu = y_ladder[scan_point]
+            artists.append(ax.vlines(x=bp_size, ymin=0, ymax=rfu, color='red', linestyle='--', alpha=0.8))
+            artists.append(ax.text(bp_size, rfu, f' {int(bp_size)}', color='red', fontsize=8, ha='center', va='bottom'))
+    return artists
+
+# --- Informes Estáticos ---
+# Figura reutilizada por cada proceso de trabajo del informe (una por proceso)
+_REPORT_FIGURE = None
+
+def _init_report_worker(profile):
+    """Inicializa un proceso de informe: perfil de instrumento y una única figura Agg."""
+    global _REPORT_FIGURE
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    profile = dict(profile)
+    apply_instrument_profile(profile.pop("name"), profile)
+    _REPORT_FIGURE = Figure(figsize=REPORT_PAGE_SIZE, dpi=REPORT_DPI)
+    FigureCanvasAgg(_REPORT_FIGURE)
+
+def render_report_page(job):
+    """
+    Dibuja la página de una muestra (marcador, canales, puntos de calibración y picos
+    llamados) sobre la figura del proceso y la devuelve como PNG en bytes.
+    job = (archivo, canales, asignaciones, canales de muestra, canal marcador, xlim, altura mínima).
+    """
+    if _REPORT_FIGURE is None:
+        _init_report_worker(ACTIVE_PROFILE)
+    filename_key, channels_data, assignments, sample_channels, ladder_channel, xlim, min_height = job
+    fig = _REPORT_FIGURE
+    fig.clear()
+    # Márgenes fijos: todas las páginas tienen la misma composición y no hace falta tight_layout
+    ax = fig.add_axes(REPORT_AXES_RECT)
+    calib_data = (build_calibration(assignments), assignments) if assignments and len(assignments) >= 2 else None
+    draw_sample_axes(ax, filename_key, channels_data, calib_data, sample_channels, ladder_channel, xlim)
+    if calib_data is not None:
+        for channel in sample_channels:
+            if channel not in channels_data: continue
+            sizes_bp, heights_rfu = detect_sample_peaks(channels_data[channel], calib_data[0], min_height)
+            inside = (sizes_bp >= xlim[0]) & (sizes_bp <= xlim[1])
+            ax.plot(sizes_bp[inside], heights_rfu[inside], 'v', markersize=5, alpha=0.7, color=CHANNEL_COLOR_MAP.get(channel, 'purple'))
+            for size, height in zip(sizes_bp[inside], heights_rfu[inside]):
+                ax.annotate(f"{size:.1f}", (size, height), xytext=(0, 6), textcoords="offset points", ha='center', fontsize=6)
+    ax.set_xlabel("Tamaño (pb)")
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=REPORT_DPI)
+    return filename_key, buffer.getvalue()
+
+def build_report(output_path, jobs, workers=None, progress=None):
+    """
+    Genera el informe en procesos paralelos. Con extensión .pdf escribe un PDF de una página
+    por muestra; con .png, un PNG por muestra junto a output_path (<nombre>_<muestra>.png).
+    Las páginas se escriben en orden a medida que llegan. Devuelve el número de páginas.
+    """
+    from PIL import Image
+    jobs = list(jobs)
+    output_path = Path(output_path)
+    as_pdf = output_path.suffix.lower() == ".pdf"
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_report_worker, initargs=(dict(ACTIVE_PROFILE),)) as pool:
+        for page, (filename_key, png) in enumerate(pool.map(render_report_page, jobs, chunksize=4), start=1):
+            if as_pdf:
+                with Image.open(io.BytesIO(png)) as image:
+                    image.convert('RGB').save(output_path, format='PDF', resolution=REPORT_DPI, append=page > 1)
+            else:
+                (output_path.parent / f"{output_path.stem}_{Path(filename_key).stem}.png").write_bytes(png)
+            if progress is not None:
+                progress(page, len(jobs))
+    return len(jobs)
+
+def write_peak_workbook(filepath, headers, rows, params, samples=None):
+    """
+    Escribe el Excel de resultados: resumen de picos, una hoja pivotada por muestra, los
+    parámetros y, si se indica 'samples' (cabeceras, filas), los metadatos de las muestras.
+    """
+    import openpyxl
+    workbook = openpyxl.Workbook()
+    summary_sheet = workbook.active
+    summary_sheet.title = "Resumen de Picos"
+    summary_sheet.append(headers)
+    all_peaks = []
+    for values in rows:
+        summary_sheet.append(list(values))
+        all_peaks.append(dict(zip(headers, values)))
+    pivoted_data = {}
+    for peak in all_peaks:
+        filename = peak['Archivo']
+        channel = peak['Canal']
+        size = peak['Tamaño (pb)']
+        if filename not in pivoted_data: pivoted_data[filename] = {}
+        if channel not in pivoted_data[filename]: pivoted_data[filename][channel] = []
+        pivoted_data[filename][channel].append(float(size))
+    for filename, channel_data in pivoted_data.items():
+        sheet_name = filename.split('.')[0][:30]
+        sample_sheet = workbook.create_sheet(title=sheet_name)
+        column_headers = list(channel_data.keys())
+        column_data = list(channel_data.values())
+        sample_sheet.append(column_headers)
+        for row_data in zip_longest(*column_data, fillvalue=""):
+            sample_sheet.append(row_data)
+    params_sheet = workbook.create_sheet(title="Parámetros de Análisis")
+    params_sheet.append(["Parámetro", "Valor"])
+    for key, value in params.items():
+        params_sheet.append([key, value])
+    if samples is not None:
+        samples_sheet = workbook.create_sheet(title="Muestras")
+        samples_sheet.append(samples[0])
+        for values in samples[1]:
+            samples_sheet.append(values)
+    workbook.save(filepath)
+
+def match_peaks(reference_bp, sizes_bp, tolerance):
+    """
+    Empareja cada pico de referencia con el pico de la muestra más cercano a menos de
+    'tolerance' pb, sin reutilizar ningún pico. Devuelve, para cada pico de referencia, el
+    índice del pico emparejado en 'sizes_bp' o -1 si no está presente.
+    """
+    reference_bp = np.asarray(reference_bp, dtype=float)
+    sizes_bp = np.asarray(sizes_bp, dtype=float)
+    matched = np.full(len(reference_bp), -1, dtype=np.int64)
+    if len(reference_bp) == 0 or len(sizes_bp) == 0:
+        return matched
+    order = np.argsort(sizes_bp, kind='stable')
+    sorted_bp = sizes_bp[order]
+    # Fusión ordenada: los candidatos son los vecinos a ambos lados de la posición de inserción
+    position = np.searchsorted(sorted_bp, reference_bp)
+    left = np.clip(position - 1, 0, len(sorted_bp) - 1)
+    right = np.clip(position, 0, len(sorted_bp) - 1)
+    use_right = np.abs(sorted_bp[right] - reference_bp) < np.abs(sorted_bp[left] - reference_bp)
+    candidate = np.where(use_right, right, left)
+    distance = np.abs(sorted_bp[candidate] - reference_bp)
+    valid = np.flatnonzero(distance <= tolerance)
+    # Si dos picos de referencia reclaman el mismo pico, se queda con él el más cercano
+    valid = valid[np.argsort(distance[valid], kind='stable')]
+    _, first = np.unique(candidate[valid], return_index=True)
+    winners = valid[first]
+    matched[winners] = order[candidate[winners]]
+    return matched
+
+class PeakComparison:
+    """
+    Resultado de comparar una tanda con una muestra de referencia. Las filas son los picos de
+    la referencia (canal, tamaño, altura) y las columnas las muestras; 'size' y 'height' son
+    matrices filas x muestras con NaN donde el pico no está presente. 'unmatched' guarda los
+    picos de cada muestra que no existen en la referencia.
+    """
+    def __init__(self, reference_name, peaks, samples, size, height, unmatched):
+        self.reference_name = reference_name
+        self.peaks = peaks
+        self.samples = samples
+        self.size = size
+        self.height = height
+        self.unmatched = unmatched
+
+    def metric(self, name):
+        """Matriz filas x muestras de una de las métricas de COMPARISON_METRICS."""
+        ref_size = np.array([size for _, size, _ in self.peaks]).reshape(-1, 1)
+        ref_height = np.array([height for _, _, height in self.peaks]).reshape(-1, 1)
+        if name == "Presencia":
+            return ~np.isnan(self.size)
+        if name == "Ratio de altura":
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return self.height / ref_height
+        if name == "Desplazamiento (pb)":
+            return self.size - ref_size
+        if name == "Altura (RFU)":
+            return self.height
+        if name == "Tamaño (pb)":
+            return self.size
+        raise ValueError(f"Métrica desconocida: {name}")
+
+    @staticmethod
+    def format_value(name, value):
+        if name == "Presencia":
+            return "Sí" if value else "No"
+        if np.isnan(value):
+            return ""
+        if name == "Ratio de altura":
+            return f"{value:.3f}"
+        if name == "Desplazamiento (pb)":
+            return f"{value:+.2f}"
+        return f"{value:.0f}" if name == "Altura (RFU)" else f"{value:.2f}"
+
+    def table(self, name):
+        """(cabeceras, filas) de una métrica, con una columna por muestra."""
+        headers = ["Canal", "Tamaño ref. (pb)", "Altura ref. (RFU)"] + [Path(sample).name for sample in self.samples]
+        matrix = self.metric(name)
+        rows = [[CHANNEL_DISPLAY_NAME_MAP.get(channel, channel), round(float(size), 2), round(float(height), 0)]
+                + [self.format_value(name, value) for value in matrix[i]]
+                for i, (channel, size, height) in enumerate(self.peaks)]
+        return headers, rows
+
+def compare_peaks(reference_name, peak_results, tolerance=COMPARISON_TOLERANCE_BP):
+    """
+    Compara en una sola pasada todas las muestras de 'peak_results' ({muestra: {canal:
+    (tamaños, alturas)}}) con los picos de 'reference_name', canal a canal.
+    """
+    reference = peak_results[reference_name]
+    samples = [name for name in peak_results if name != reference_name]
+    peaks, blocks = [], []
+    for channel, (ref_sizes, ref_heights) in reference.items():
+        order = np.argsort(ref_sizes)
+        ref_sizes = np.asarray(ref_sizes, dtype=float)[order]
+        peaks.extend((channel, size, height) for size, height in zip(ref_sizes, np.asarray(ref_heights, dtype=float)[order]))
+        blocks.append((channel, ref_sizes))
+    size = np.full((len(peaks), len(samples)), np.nan)
+    height = np.full((len(peaks), len(samples)), np.nan)
+    unmatched = {}
+    for column, sample in enumerate(samples):
+        row = 0
+        for channel, ref_sizes in blocks:
+            sizes_bp, heights_rfu = peak_results[sample].get(channel, ((), ()))
+            sizes_bp = np.asarray(sizes_bp, dtype=float); heights_rfu = np.asarray(heights_rfu, dtype=float)
+            matched = match_peaks(ref_sizes, sizes_bp, tolerance)
+            found = matched >= 0
+            size[row:row + len(ref_sizes), column][found] = sizes_bp[matched[found]]
+            height[row:row + len(ref_sizes), column][found] = heights_rfu[matched[found]]
+            extra = np.ones(len(sizes_bp), dtype=bool); extra[matched[found]] = False
+            unmatched.setdefault(sample, []).extend((channel, s, h) for s, h in zip(sizes_bp[extra], heights_rfu[extra]))
+            row += len(ref_sizes)
+    return PeakComparison(reference_name, peaks, samples, size, height, unmatched)
+
+def write_comparison_workbook(filepath, comparison, params):
+    """Excel de la comparación: una hoja por métrica, los picos sin pareja en la referencia y los parámetros."""
+    import openpyxl
+    workbook = openpyxl.Workbook()
+    workbook.remove(workbook.active)
+    for name in COMPARISON_METRICS:
+        headers, rows = comparison.table(name)
+        sheet = workbook.create_sheet(title=name.replace("(", "").replace(")", "")[:30])
+        sheet.append(headers)
+        for values in rows:
+            sheet.append(values)
+    extra_sheet = workbook.create_sheet(title="Picos sin Referencia")
+    extra_sheet.append(["Archivo", "Canal", "Tamaño (pb)", "Altura (RFU)"])
+    for sample, peaks in comparison.unmatched.items():
+        for channel, size, height in peaks:
+            extra_sheet.append([Path(sample).name, CHANNEL_DISPLAY_NAME_MAP.get(channel, channel), round(float(size), 2), round(float(height), 0)])
+    params_sheet = workbook.create_sheet(title="Parámetros de Análisis")
+    params_sheet.append(["Parámetro", "Valor"])
+    for key, value in params.items():
+        params_sheet.append([key, value])
+    workbook.save(filepath)
+
+def build_bp_grid(start_bp, stop_bp, step_bp=0.1):
+    """Crea la rejilla común de tamaños (pb) usada para superponer y comparar muestras."""
+    return np.arange(start_bp, stop_bp + step_bp / 2, step_bp)
+
+def resample_to_bp_grid(x_list, y_list, grid):
+    """
+    Remuestrea un lote de trazas calibradas (x en pb, y en RFU) sobre una rejilla común.
+
+    Todas las trazas se desplazan a tramos disjuntos del eje x y se interpolan con una
+    única llamada a np.interp. Los puntos de la rejilla fuera del rango de cada traza
+    quedan como NaN. Devuelve una matriz (muestras x rejilla).
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    if not x_list:
+        return np.empty((0, len(grid)))
+
+    # El eje en pb debe ser creciente; la extrapolación de la calibración puede no serlo en los extremos
+    xs = [np.maximum.accumulate(np.asarray(x, dtype=np.float64)) for x in x_list]
+    lo = min(grid[0], min(x[0] for x in xs))
+    hi = max(grid[-1], max(x[-1] for x in xs))
+    offset = (hi - lo) + 1.0
+
+    shifts = np.arange(len(xs)) * offset
+    xp = np.concatenate([x + shift for x, shift in zip(xs, shifts)])
+    fp = np.concatenate([np.asarray(y, dtype=np.float64) for y in y_list])
+    queries = grid[None, :] + shifts[:, None]
+    resampled = np.interp(queries.ravel(), xp, fp).reshape(queries.shape)
+
+    starts = np.array([x[0] for x in xs]); ends = np.array([x[-1] for x in xs])
+    outside = (grid[None, :] < starts[:, None]) | (grid[None, :] > ends[:, None])
+    resampled[outside] = np.nan
+    return resampled
+
+def nearest_sorted(values, x):
+    """Posición del valor más cercano a x en un array ordenado (búsqueda binaria)."""
+    pos = int(np.searchsorted(values, x))
+    if pos == 0: return 0
+    if pos == len(values): return len(values) - 1
+    return pos if values[pos] - x < x - values[pos - 1] else pos - 1
+
+class TracePeakIndex:
+    """
+    Índice de una traza dibujada para buscar por coordenada x en O(log n): el eje en pb
+    se fuerza a creciente y los máximos locales se precalculan una sola vez, de modo que
+    ajustar un clic al pico más cercano o leer el valor bajo el ratón no recorre la traza.
+    """
+
+    def __init__(self, x_data, y_data):
+        y_data = np.asarray(y_data, dtype=np.float64)
+        self.x = np.maximum.accumulate(np.asarray(x_data, dtype=np.float64))
+        self.y = y_data
+        if len(y_data) > 2:
+            is_max = (y_data[1:-1] >= y_data[:-2]) & (y_data[1:-1] > y_data[2:])
+            self.maxima = np.flatnonzero(is_max) + 1
+        else:
+            self.maxima = np.array([], dtype=int)
+
+    @classmethod
+    def for_artist(cls, artist):
+        """Índice de una línea con 'full_data', creado en el primer uso y guardado en la propia línea."""
+        index = getattr(artist, 'peak_index', None)
+        if index is None:
+            index = artist.peak_index = cls(*artist.full_data)
+        return index
+
+    def value_at(self, x):
+        """(índice, x, y) del punto de la traza más cercano a x."""
+        i = nearest_sorted(self.x, x)
+        return i, self.x[i], self.y[i]
+
+    def snap(self, x, search_radius=20):
+        """Índice del máximo local más alto a menos de 'search_radius' puntos del punto más cercano a x."""
+        center = nearest_sorted(self.x, x)
+        lo, hi = np.searchsorted(self.maxima, [center - search_radius, center + search_radius])
+        if hi > lo:
+            candidates = self.maxima[lo:hi]
+            return int(candidates[np.argmax(self.y[candidates])])
+        start = max(0, center - search_radius)
+        return start + int(np.argmax(self.y[start:center + search_radius]))
+
+def compute_fingerprint(channels_data, calib_func, channels, bp_range=FINGERPRINT_RANGE_BP, bin_bp=FINGERPRINT_BIN_BP):
+    """
+    Huella de una muestra: área de señal por bin de pb de cada canal calibrado, concatenada
+    en un vector float32. Se comprime con raíz cuadrada, se centra y se normaliza a norma 1,
+    de modo que el producto escalar entre dos huellas es su correlación de Pearson.
+    'channels' fija la longitud y el orden del vector: solo son comparables las huellas
+    calculadas con la misma lista. Los canales ausentes se rellenan con ceros.
+    """
+    n_bins = int(round((bp_range[1] - bp_range[0]) / bin_bp))
+    profile = np.zeros((len(channels), n_bins))
+    for row, channel in enumerate(channels):
+        if channel not in channels_data: continue
+        y_cleaned = np.clip(clean_trace_hammock(channels_data[channel]), 0, None)
+        bins = np.floor((calib_func(np.arange(len(y_cleaned))) - bp_range[0]) / bin_bp).astype(np.int64)
+        inside = (bins >= 0) & (bins < n_bins)
+        profile[row] = np.bincount(bins[inside], weights=y_cleaned[inside], minlength=n_bins)
+    vector = np.sqrt(profile).ravel()
+    vector -= vector.mean()
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm > 0 else vector).astype(np.float32)
+
+# --- Almacén de Trazas en pb ---
+class BpTraceStore:
+    """
+    Trazas calibradas remuestreadas sobre una rejilla fija de pb, guardadas como un único
+    array contiguo float32 (muestras x canales x rejilla). Puede vivir en memoria o en un
+    archivo .npy mapeado en memoria, con sus metadatos en un .json del mismo nombre.
+    """
+
+    def __init__(self, sample_names, channels, grid, data):
+        self.sample_names = list(sample_names)
+        self.channels = list(channels)
+        self.grid = np.asarray(grid, dtype=np.float64)
+        self.data = data
+        self._sample_pos = {name: i for i, name in enumerate(self.sample_names)}
+        self._channel_pos = {ch: i for i, ch in enumerate(self.channels)}
+
+    @classmethod
+    def build(cls, fsa_files, loaded_data, calibrations, channels, grid, path=None):
+        """Construye el almacén a partir de los archivos calibrados; con 'path' se crea mapeado en disco."""
+        calibrated = [(Path(f).name, calibrations[f][0]) for f in fsa_files if calibrations.get(f) and Path(f).name in loaded_data]
+        shape = (len(calibrated), len(channels), len(grid))
+        if path:
+            data = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+            data[...] = np.nan
+        else:
+            data = np.full(shape, np.nan, dtype=np.float32)
+
+        for ch_idx, channel in enumerate(channels):
+            rows, x_list, y_list = [], [], []
+            for row, (filename, calib_func) in enumerate(calibrated):
+                if channel not in loaded_data[filename]: continue
+                y_cleaned = clean_trace_hammock(loaded_data[filename][channel])
+                rows.append(row); x_list.append(calib_func(np.arange(len(y_cleaned)))); y_list.append(y_cleaned)
+            if rows:
+                data[rows, ch_idx, :] = resample_to_bp_grid(x_list, y_list, grid)
+
+        store = cls([name for name, _ in calibrated], channels, grid, data)
+        if path:
+            data.flush()
+            store._write_metadata(path)
+        return store
+
+    @classmethod
+    def open(cls, path):
+        """Abre un almacén guardado en disco sin cargarlo en memoria (mmap de solo lectura)."""
+        with open(Path(path).with_suffix('.json'), 'r') as f:
+            meta = json.load(f)
+        data = np.load(path, mmap_mode='r')
+        grid = meta['grid_start'] + np.arange(meta['grid_size']) * meta['grid_step']
+        return cls(meta['samples'], meta['channels'], grid, data)
+
+    def _write_metadata(self, path):
+        meta = {
+            "samples": self.sample_names, "channels": self.channels,
+            "grid_start": float(self.grid[0]), "grid_step": float(self.grid[1] - self.grid[0]) if len(self.grid) > 1 else 0.0,
+            "grid_size": len(self.grid)
+        }
+        with open(Path(path).with_suffix('.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+
+    def contains(self, sample_names, channel):
+        return channel in self._channel_pos and all(name in self._sample_pos for name in sample_names)
+
+    def window(self, sample_names, channel, start_bp, stop_bp):
+        """Devuelve (rejilla, matriz muestras x rejilla) de un canal dentro del rango de pb pedido."""
+        lo, hi = np.searchsorted(self.grid, [start_bp, stop_bp], side='left')
+        rows = [self._sample_pos[name] for name in sample_names]
+        return self.grid[lo:hi + 1], np.asarray(self.data[rows, self._channel_pos[channel], lo:hi + 1])
+
+    def call_peaks(self, channel, min_height):
+        """
+        Llamada de picos en lote en espacio de pb: máximos locales sobre el umbral para todas
+        las muestras a la vez. Devuelve {muestra: (tamaños_pb, alturas)}.
+        """
+        matrix = np.nan_to_num(np.asarray(self.data[:, self._channel_pos[channel], :]))
+        center = matrix[:, 1:-1]
+        is_peak = (center > matrix[:, :-2]) & (center >= matrix[:, 2:]) & (center >= min_height)
+        sample_idx, grid_idx = np.nonzero(is_peak)
+        grid_idx = grid_idx + 1
+        splits = np.searchsorted(sample_idx, np.arange(1, len(self.sample_names)))
+        sizes = np.split(self.grid[grid_idx], splits)
+        heights = np.split(matrix[sample_idx, grid_idx], splits)
+        return {name: (sizes[i], heights[i]) for i, name in enumerate(self.sample_names)}
+
+    def similarity(self, sample_name, channels=None):
+        """Correlación de Pearson del perfil de una muestra contra todas las del almacén."""
+        ch_rows = [self._channel_pos[ch] for ch in (channels or self.channels)]
+        profiles = np.nan_to_num(np.asarray(self.data[:, ch_rows, :])).reshape(len(self.sample_names), -1)
+        profiles = profiles - profiles.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(profiles, axis=1)
+        norms[norms == 0] = 1.0
+        profiles /= norms[:, None]
+        return profiles @ profiles[self._sample_pos[sample_name]]
+
+# --- Índice de Huellas ---
+class FingerprintIndex:
+    """
+    Huellas de muestra en una única matriz contigua float32 (muestras x bins). Como las
+    huellas están centradas y normalizadas, la búsqueda es un producto matriz-vector.
+    """
+
+    def __init__(self, labels, matrix):
+        self.labels = list(labels)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def search(self, fingerprint, top_k=20, min_score=None):
+        """Devuelve [(etiqueta, correlación)] de las huellas más parecidas, de mayor a menor."""
+        if not self.labels:
+            return []
+        scores = self.matrix @ np.asarray(fingerprint, dtype=np.float32)
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        if min_score is not None:
+            best = best[scores[best] >= min_score]
+        return [(self.labels[i], float(scores[i])) for i in best]
+
+# --- Sesiones Autocontenidas ---
+def save_session_archive(filepath, fsa_files, loaded_data, calibrations, settings):
+    """
+    Guarda la sesión en un único ZIP: un manifiesto JSON (archivos, puntos de calibración,
+    plantilla y parámetros) y las trazas de cada archivo comprimidas en un .npz propio.
+    """
+    manifest = dict(settings)
+    manifest["version"] = SESSION_FORMAT_VERSION
+    manifest["fsa_files"] = list(fsa_files)
+    manifest["calibrations"] = {
+        path: ({str(int(scan)): float(bp) for scan, bp in cal[1].items()} if cal is not None else None)
+        for path, cal in calibrations.items()
+    }
+    manifest["traces"] = list(loaded_data.keys())
+    # Las trazas ya van comprimidas en cada .npz, así que el ZIP solo las almacena
+    with zipfile.ZipFile(filepath, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr(SESSION_MANIFEST, json.dumps(manifest, indent=2))
+        for filename, channels in loaded_data.items():
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, **channels)
+            zf.writestr(f"traces/{filename}.npz", buffer.getvalue())
+
+def read_session_manifest(filepath):
+    """Lee solo el manifiesto de una sesión y reconstruye las calibraciones desde sus puntos."""
+    with zipfile.ZipFile(filepath, 'r') as zf:
+        manifest = json.loads(zf.read(SESSION_MANIFEST))
+    sizing = (manifest.get("instrument_profile") or {}).get("sizing")
+    calibrations = {}
+    for path, points in manifest.get("calibrations", {}).items():
+        if points is None:
+            calibrations[path] = None
+        else:
+            assignments = {int(scan): bp for scan, bp in points.items()}
+            calibrations[path] = (build_calibration(assignments, sizing), assignments)
+    manifest["calibrations"] = calibrations
+    return manifest
+
+class SessionTraceArchive(Mapping):
+    """
+    Trazas embebidas en una sesión, con la misma forma que 'loaded_data'
+    ({archivo: {canal: array}}). Cada archivo se descomprime la primera vez que se pide.
+    """
+
+    def __init__(self, filepath, filenames):
+        self._zip = zipfile.ZipFile(filepath, 'r')
+        self._filenames = list(filenames)
+        self._known = set(self._filenames)
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, filename):
+        if filename not in self._known:
+            raise KeyError(filename)
+        with self._lock:
+            if filename not in self._cache:
+                with np.load(io.BytesIO(self._zip.read(f"traces/{filename}.npz"))) as npz:
+                    self._cache[filename] = {ch: npz[ch] for ch in npz.files}
+            return self._cache[filename]
+
+    def __contains__(self, filename):
+        return filename in self._known
+
+    def __iter__(self):
+        return iter(self._filenames)
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def prefetch(self):
+        """Descomprime en segundo plano el resto de archivos mientras se usa la interfaz."""
+        threading.Thread(target=lambda: [self[name] for name in self._filenames], daemon=True).start()
+
+# --- Base de Datos de Proyecto ---
+PROJECT_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    created TEXT NOT NULL,
+    ladder_type TEXT,
+    ladder_channel TEXT,
+    params TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    filename TEXT NOT NULL,
+    path TEXT
+);
+CREATE TABLE IF NOT EXISTS calibrations (
+    sample_id INTEGER PRIMARY KEY REFERENCES samples(id) ON DELETE CASCADE,
+    points TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS peaks (
+    sample_id INTEGER NOT NULL REFERENCES samples(id) ON DELETE CASCADE,
+    channel TEXT NOT NULL,
+    size_bp REAL NOT NULL,
+    height REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    sample_id INTEGER PRIMARY KEY REFERENCES samples(id) ON DELETE CASCADE,
+    bin_bp REAL NOT NULL,
+    vector BLOB NOT NULL,
+    channels TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_peaks_channel_size ON peaks(channel, size_bp);
+CREATE INDEX IF NOT EXISTS idx_peaks_sample_channel ON peaks(sample_id, channel);
+CREATE INDEX IF NOT EXISTS idx_samples_run ON samples(run_id);
+"""
+
+class ProjectDatabase:
+    """
+    Base de datos SQLite local con las muestras, calibraciones y picos de todas las
+    ejecuciones analizadas. Los canales se guardan con su etiqueta ABIF (DATA9, ...).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(PROJECT_DB_SCHEMA)
+        # Proyectos anteriores: las huellas no guardaban sus canales y quedan fuera de las búsquedas
+        if "channels" not in [row[1] for row in self.conn.execute("PRAGMA table_info(fingerprints)")]:
+            self.conn.execute("ALTER TABLE fingerprints ADD COLUMN channels TEXT")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_run(self, name, samples, ladder_type="", ladder_channel="", params=None):
+        """
+        Guarda una ejecución en una sola transacción. 'samples' es una lista de dicts con
+        'filename', 'path', 'assignments' ({scan: pb}), 'peaks' ({canal: (tamaños, alturas)})
+        opcionalmente 'fingerprint' (vector de compute_fingerprint) con 'fingerprint_channels' (sus
+        canales). Devuelve el id de la ejecución.
+        """
+        created = np.datetime_as_string(np.datetime64('now', 's'), unit='s')
+        with self.conn:
+            run_id = self.conn.execute("INSERT INTO runs (name, created, ladder_type, ladder_channel, params) VALUES (?, ?, ?, ?, ?)",
+                                       (name, created, ladder_type, ladder_channel, json.dumps(params or {}))).lastrowid
+            for sample in samples:
+                sample_id = self.conn.execute("INSERT INTO samples (run_id, filename, path) VALUES (?, ?, ?)",
+                                              (run_id, sample["filename"], sample.get("path"))).lastrowid
+                if sample.get("assignments"):
+                    points = {str(int(scan)): float(bp) for scan, bp in sample["assignments"].items()}
+                    self.conn.execute("INSERT INTO calibrations (sample_id, points) VALUES (?, ?)", (sample_id, json.dumps(points)))
+                if sample.get("fingerprint") is not None:
+                    self.conn.execute("INSERT INTO fingerprints (sample_id, bin_bp, vector, channels) VALUES (?, ?, ?, ?)",
+                                      (sample_id, FINGERPRINT_BIN_BP, np.asarray(sample["fingerprint"], dtype=np.float32).tobytes(),
+                                       json.dumps(list(sample["fingerprint_channels"]))))
+                for channel, (sizes_bp, heights_rfu) in sample.get("peaks", {}).items():
+                    self.conn.executemany("INSERT INTO peaks (sample_id, channel, size_bp, height) VALUES (?, ?, ?, ?)",
+                                          ((sample_id, channel, float(size), float(height)) for size, height in zip(sizes_bp, heights_rfu)))
+        return run_id
+
+    def find_peaks(self, channel, size_bp, tolerance=1.0):
+        """Todas las muestras con un pico en size_bp ± tolerance en el canal dado (usa el índice canal/tamaño)."""
+        return self.conn.execute(
+            "SELECT r.name, s.filename, p.channel, p.size_bp, p.height FROM peaks p "
+            "JOIN samples s ON s.id = p.sample_id JOIN runs r ON r.id = s.run_id "
+            "WHERE p.channel = ? AND p.size_bp BETWEEN ? AND ? ORDER BY r.id, s.filename, p.size_bp",
+            (channel, size_bp - tolerance, size_bp + tolerance)).fetchall()
+
+    def run_calibrations(self, run_id):
+        """Puntos de calibración guardados de cada muestra de una ejecución: {archivo: {scan: pb} o None}."""
+        rows = self.conn.execute("SELECT s.filename, c.points FROM samples s LEFT JOIN calibrations c ON c.sample_id = s.id "
+                                 "WHERE s.run_id = ? ORDER BY s.id", (run_id,)).fetchall()
+        return {filename: {int(float(scan)): float(bp) for scan, bp in json.loads(points).items()} if points else None
+                for filename, points in rows}
+
+    def sample_peaks(self, sample_id, channel):
+        """Picos de una muestra en un canal (usa el índice muestra/canal)."""
+        return self.conn.execute("SELECT size_bp, height FROM peaks WHERE sample_id = ? AND channel = ? ORDER BY size_bp",
+                                 (sample_id, channel)).fetchall()
+
+    def load_fingerprints(self, channels, bin_bp=FINGERPRINT_BIN_BP):
+        """
+        Carga como un FingerprintIndex con etiquetas (ejecución, archivo) las huellas calculadas
+        con los mismos canales, en el mismo orden, y la misma anchura de bin.
+        """
+        n_values = len(channels) * int(round((FINGERPRINT_RANGE_BP[1] - FINGERPRINT_RANGE_BP[0]) / bin_bp))
+        rows = self.conn.execute(
+            "SELECT r.name, s.filename, f.vector FROM fingerprints f "
+            "JOIN samples s ON s.id = f.sample_id JOIN runs r ON r.id = s.run_id "
+            "WHERE f.bin_bp = ? AND f.channels = ? AND length(f.vector) = ? ORDER BY f.sample_id",
+            (bin_bp, json.dumps(list(channels)), n_values * 4)).fetchall()
+        matrix = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.float32).reshape(len(rows), n_values)
+        return FingerprintIndex([(run_name, filename) for run_name, filename, _ in rows], matrix)
+
+    def counts(self):
+        """Número de ejecuciones, muestras y picos guardados."""
+        return tuple(self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("runs", "samples", "peaks"))
+
+# --- Procesamiento por Lotes en Streaming ---
+def iter_chunks(items, size):
+    """Agrupa un iterable en listas de 'size' elementos sin materializarlo entero."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def stream_batch(paths, template, params, ladder_channel, sample_channels, min_height, chunk_size=BATCH_CHUNK_SIZE, fingerprints=False):
+    """
+    Tubería por bloques: carga -> inicio útil -> calibración -> línea base y picos. Entrega un
+    dict por archivo ('path', 'filename', 'assignments', 'peaks', 'saturated' o 'error') y solo
+    mantiene en memoria las trazas del bloque en curso, sin pasar por 'loaded_data'. Con
+    'fingerprints' añade también la huella de cada muestra calibrada (para guardarla en el proyecto).
+    """
+    wanted = list(dict.fromkeys(list(sample_channels) + [ladder_channel]))
+    for chunk in iter_chunks(paths, chunk_size):
+        loaded = []
+        for path in chunk:
+            try:
+                loaded.append((path, *read_fsa_file(path, wanted)))
+            except (OSError, ValueError, struct.error) as e:
+                yield {"path": path, "filename": Path(path).name, "error": str(e)}
+        starts = detect_data_start([combine_start_channels(channels) for _, channels, _ in loaded])
+        for (path, channels, metadata), start in zip(loaded, starts.tolist()):
+            result = {"path": path, "filename": Path(path).name, "assignments": None, "peaks": {}, "saturated": {}}
+            saturation = trim_saturation(metadata["saturation"], start)
+            calibration = auto_calibrate(channels[ladder_channel], start, template, params) if ladder_channel in channels else None
+            if calibration is not None:
+                calib_func, result["assignments"] = calibration
+                for channel in sample_channels:
+                    if channel in channels:
+                        sizes_bp, heights_rfu = result["peaks"][channel] = detect_sample_peaks(channels[channel], calib_func, min_height)
+                        result["saturated"][channel] = saturated_peak_mask(sizes_bp, saturation.get(channel), calib_func)
+                if fingerprints:
+                    result["fingerprint"] = compute_fingerprint(channels, calib_func, sample_channels)
+                    result["fingerprint_channels"] = list(sample_channels)
+            yield result
+        del loaded
+
+def export_stream(results, csv_path, db_path=None, run_name="", ladder_type="", ladder_channel="", params=None, progress=None):
+    """
+    Consume los resultados de stream_batch según llegan: cada fila de picos va directa al CSV
+    y, si se indica db_path, las muestras se insertan en el proyecto en la misma pasada.
+    Devuelve un resumen {'files', 'calibrated', 'peaks', 'errors'}.
+    """
+    summary = {"files": 0, "calibrated": 0, "peaks": 0, "errors": []}
+
+    def written(writer):
+        for result in results:
+            summary["files"] += 1
+            if "error" in result:
+                summary["errors"].append(f"{result['filename']}: {result['error']}")
+            else:
+                summary["calibrated"] += result["assignments"] is not None
+                for channel, (sizes_bp, heights_rfu) in result["peaks"].items():
+                    display_name = CHANNEL_DISPLAY_NAME_MAP.get(channel, channel)
+                    writer.writerows((result["filename"], display_name, f"{size:.1f}", f"{height:.0f}", "Sí" if saturated else "")
+                                     for size, height, saturated in zip(sizes_bp, heights_rfu, result["saturated"][channel]))
+                    summary["peaks"] += len(sizes_bp)
+                yield result
+            if progress is not None:
+                progress(summary["files"])
+
+    with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(PEAK_EXPORT_HEADERS)
+        if db_path:
+            with ProjectDatabase(db_path) as db:
+                db.add_run(run_name, written(writer), ladder_type, ladder_channel, params)
+        else:
+            for _ in written(writer):
+                pass
+    return summary
+
+# --- Servicio de Análisis Local (HTTP/JSON) ---
+class AnalysisService:
+    """
+    Motor del servicio para el LIMS, sin nada de HTTP: cada método recibe y devuelve dicts
+    serializables en JSON. Los archivos decodificados se guardan en una caché acotada
+    (identificados por 'file_id', que incluye los canales pedidos) y los picos se reutilizan
+    a través de PEAK_CACHE, de modo que las peticiones repetidas solo pagan el cálculo que
+    cambia. Cada calibración se guarda aparte con su 'calibration_id', derivado de sus datos
+    de entrada, para que dos clientes que calibran el mismo archivo no se pisen. Los archivos
+    se suben en la petición; leerlos por ruta solo se permite dentro de 'data_dir', si se configura.
+    """
+
+    def __init__(self, max_files=SERVICE_CACHE_FILES, data_dir=None):
+        self.max_files = max_files
+        self.data_dir = os.path.realpath(data_dir) if data_dir else None
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, file_id, entry):
+        with self._lock:
+            self._files[file_id] = entry
+            self._files.move_to_end(file_id)
+            while len(self._files) > self.max_files:
+                evicted, _ = self._files.popitem(last=False)
+                PEAK_CACHE.invalidate(evicted)
+
+    def _get(self, file_id):
+        with self._lock:
+            entry = self._files.get(file_id)
+            if entry is None:
+                raise KeyError(f"file_id desconocido o caducado: {file_id}")
+            self._files.move_to_end(file_id)
+            return entry
+
+    def _resolve_path(self, path):
+        """Ruta real de un archivo del directorio de datos (las relativas se toman respecto a él)."""
+        if self.data_dir is None:
+            raise PermissionError("La lectura por ruta está desactivada: envía el archivo en 'content_base64' o arranca el servicio con --data-dir")
+        resolved = os.path.realpath(os.path.join(self.data_dir, path))
+        if os.path.commonpath([resolved, self.data_dir]) != self.data_dir:
+            raise PermissionError(f"Ruta fuera del directorio de datos: {path}")
+        return resolved
+
+    @staticmethod
+    def _params(payload):
+        params = dict(DEFAULT_DETECTION_PARAMS)
+        params.update({key: str(value) for key, value in payload.get("params", {}).items()})
+        return params
+
+    def load(self, payload):
+        """{'filename', 'content_base64'} o {'path'} (dentro de data_dir), 'channels' -> file_id, canales y scan de inicio útil."""
+        requested = payload.get("channels") or profile_channels()
+        # Lo decodificado depende de los canales pedidos, así que forman parte del file_id
+        channels_key = ",".join(sorted(requested))
+        if "content_base64" in payload:
+            import base64
+            raw = base64.b64decode(payload["content_base64"])
+            filename = payload.get("filename", "muestra.fsa")
+            file_id = hashlib.sha1(raw + b"|" + channels_key.encode('utf-8')).hexdigest()[:16]
+        else:
+            path = self._resolve_path(payload["path"])
+            stat = os.stat(path)
+            filename = Path(path).name
+            file_id = hashlib.sha1(f"{path}|{stat.st_size}|{stat.st_mtime_ns}|{channels_key}".encode('utf-8')).hexdigest()[:16]
+            raw = None
+        with self._lock:
+            cached = self._files.get(file_id)
+        if cached is None:
+            if raw is None:
+                with open(path, 'rb') as handle: raw = handle.read()
+            channels = parse_fsa_bytes(raw, requested)
+            start = int(detect_data_start([combine_start_channels(channels)])[0])
+            saturation = trim_saturation(detect_saturation(channels, parse_fsa_metadata(raw).get("offscale")), start)
+            cached = {"filename": filename, "channels": channels, "start": start, "saturation": saturation, "calibrations": OrderedDict()}
+            self._store(file_id, cached)
+        return {"file_id": file_id, "filename": cached["filename"], "start_scan": cached["start"],
+                "channels": {ch: len(trace) for ch, trace in cached["channels"].items()}, "saturation": cached["saturation"]}
+
+    def calibrate(self, payload):
+        """{'file_id', 'template' {pb: scan} | 'assignments' {scan: pb}, 'ladder_channel', 'params'} -> calibration_id y asignaciones."""
+        file_id = payload["file_id"]
+        entry = self._get(file_id)
+        if payload.get("assignments"):
+            assignments = {int(scan): float(bp) for scan, bp in payload["assignments"].items()}
+            if len(assignments) < 2:
+                raise ValueError("Se necesitan al menos 2 puntos de calibración")
+            calibration = (build_calibration(assignments), assignments)
+            inputs = {"assignments": sorted(assignments.items())}
+        else:
+            template = {float(bp): int(scan) for bp, scan in payload["template"].items()}
+            ladder_channel = payload.get("ladder_channel", LADDER_CHANNELS[0])
+            if ladder_channel not in entry["channels"]:
+                raise ValueError(f"El archivo no tiene el canal marcador {ladder_channel}")
+            params = self._params(payload)
+            start = int(payload.get("start_scan", entry["start"]))
+            peaks = detect_ladder_peaks(entry["channels"][ladder_channel], start, float(params["height"]), float(params["prominence"]),
+                                        int(params["distance"]), cache_key=(payload["file_id"], ladder_channel))
+            assignments = assign_from_template(peaks, template, int(params["template_tolerance"]))
+            calibration = (build_calibration(assignments), assignments) if len(assignments) >= 2 else None
+            inputs = {"template": sorted(template.items()), "ladder_channel": ladder_channel, "params": params, "start": start}
+        # Mismas entradas -> mismo calibration_id: repetir una petición no llena la caché
+        calibration_id = f"{file_id}-{hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()[:12]}"
+        with self._lock:
+            calibrations = entry["calibrations"]
+            calibrations[calibration_id] = calibration
+            calibrations.move_to_end(calibration_id)
+            while len(calibrations) > SERVICE_CACHE_CALIBRATIONS:
+                calibrations.popitem(last=False)
+        return {"file_id": file_id, "calibration_id": calibration_id, "calibrated": calibration is not None,
+                "assignments": {str(scan): bp for scan, bp in calibration[1].items()} if calibration else {}}
+
+    def detect(self, payload):
+        """{'calibration_id', 'channels', 'min_height'} -> lista de picos en pb con una calibración de /calibrate."""
+        calibration_id = payload["calibration_id"]
+        file_id = calibration_id.partition("-")[0]
+        entry = self._get(file_id)
+        with self._lock:
+            if calibration_id not in entry["calibrations"]:
+                raise KeyError(f"calibration_id desconocido o caducado: {calibration_id}")
+            calibration = entry["calibrations"][calibration_id]
+        if calibration is None:
+            raise ValueError("La calibración no tiene puntos suficientes; revisa la plantilla o las asignaciones")
+        min_height = float(payload.get("min_height", DEFAULT_DETECTION_PARAMS["peak_height"]))
+        peaks = []
+        for channel in payload.get("channels") or SAMPLE_CHANNELS:
+            if channel not in entry["channels"]: continue
+            sizes_bp, heights_rfu = detect_sample_peaks(entry["channels"][channel], calibration[0], min_height, cache_key=(file_id, channel))
+            saturated = saturated_peak_mask(sizes_bp, entry["saturation"].get(channel), calibration[0])
+            display_name = CHANNEL_DISPLAY_NAME_MAP.get(channel, channel)
+            peaks.extend({"channel": channel, "display_name": display_name, "size_bp": round(float(size), 2), "height": round(float(height), 1),
+                          "saturated": bool(flag)} for size, height, flag in zip(sizes_bp, heights_rfu, saturated))
+        return {"file_id": file_id, "calibration_id": calibration_id, "filename": entry["filename"], "peaks": peaks}
+
+    def analyze(self, payload):
+        """load + calibrate + detect en una sola petición."""
+        loaded = self.load(payload)
+        calibrated = self.calibrate({**payload, "file_id": loaded["file_id"]})
+        result = {**loaded, **calibrated, "peaks": []}
+        if calibrated["calibrated"]:
+            result["peaks"] = self.detect({**payload, "calibration_id": calibrated["calibration_id"]})["peaks"]
+        return result
+
+    def export(self, payload):
+        """{'calibration_ids', 'format': 'csv'|'xlsx', 'min_height'} -> (bytes, tipo de contenido) con la tabla de picos."""
+        rows = []
+        for calibration_id in payload["calibration_ids"]:
+            result = self.detect({**payload, "calibration_id": calibration_id})
+            rows.extend((result["filename"], peak["display_name"], f"{peak['size_bp']:.1f}", f"{peak['height']:.0f}", "Sí" if peak["saturated"] else "")
+                        for peak in result["peaks"])
+        if payload.get("format", "csv") == "xlsx":
+            with tempfile.TemporaryDirectory() as tmp:
+                filepath = os.path.join(tmp, "picos.xlsx")
+                write_peak_workbook(filepath, PEAK_EXPORT_HEADERS, rows, {"Archivos Analizados": len(payload["calibration_ids"])})
+                with open(filepath, 'rb') as f:
+                    return f.read(), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(PEAK_EXPORT_HEADERS); writer.writerows(rows)
+        return buffer.getvalue().encode('utf-8'), "text/csv; charset=utf-8"
+
+def make_service_handler(service):
+    """Crea la clase de manejador HTTP ligada a un AnalysisService (http.server se importa solo aquí)."""
+    from http.server import BaseHTTPRequestHandler
+
+    class AnalysisRequestHandler(BaseHTTPRequestHandler):
+        routes = {"/load": service.load, "/calibrate": service.calibrate, "/detect": service.detect,
+                  "/analyze": service.analyze, "/export": service.export}
+
+        def _send(self, status, body, content_type="application/json; charset=utf-8"):
+            if not isinstance(body, bytes):
+                body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/health":
+                self._send(404, {"error": f"Ruta desconocida: {self.path}"}); return
+            self._send(200, {"status": "ok", "profile": ACTIVE_PROFILE["name"], "ladders": list(KNOWN_LADDERS),
+                             "peak_cache": {"hits": PEAK_CACHE.hits, "misses": PEAK_CACHE.misses}})
+
+        def do_POST(self):
+            handler = self.routes.get(self.path)
+            if handler is None:
+                self._send(404, {"error": f"Ruta desconocida: {self.path}"}); return
+            length = int(self.headers.get("Content-Length", 0))
+            if length > SERVICE_MAX_BODY:
+                self._send(413, {"error": "Petición demasiado grande"}); return
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                with PERF.stage(f"Servicio {self.path}"):
+                    result = handler(payload)
+            except FileNotFoundError as e:
+                self._send(404, {"error": str(e)}); return
+            except PermissionError as e:
+                self._send(403, {"error": str(e)}); return
+            except (KeyError, ValueError, TypeError, OSError, struct.error) as e:
+                self._send(400, {"error": f"{type(e).__name__}: {e}"}); return
+            if isinstance(result, tuple):
+                self._send(200, *result)
+            else:
+                self._send(200, result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return AnalysisRequestHandler
+
+def create_analysis_server(host=SERVICE_HOST, port=SERVICE_PORT, workers=None, data_dir=None):
+    """
+    Servidor HTTP cuyas peticiones se atienden en un grupo fijo de hilos ya arrancados (en
+    lugar de un hilo nuevo por petición). Los módulos pesados se importan antes de escuchar.
+    """
+    from http.server import ThreadingHTTPServer
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+    pool = ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1))
+
+    class PooledHTTPServer(ThreadingHTTPServer):
+        def process_request(self, request, client_address):
+            pool.submit(self.process_request_thread, request, client_address)
+
+        def server_close(self):
+            super().server_close()
+            pool.shutdown(wait=False)
+
+    return PooledHTTPServer((host, port), make_service_handler(AnalysisService(data_dir=data_dir)))
+
+def serve_analysis(host=SERVICE_HOST, port=SERVICE_PORT, data_dir=None):
+    """Arranca el servicio local hasta Ctrl+C."""
+    server = create_analysis_server(host, port, data_dir=data_dir)
+    print(f"Servicio de análisis en http://{host}:{server.server_address[1]} (Ctrl+C para detener)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# --- Vigilancia de Carpeta ---
+class FolderWatcher:
+    """
+    Sondea una carpeta de ejecución y entrega los .fsa nuevos en cuanto el secuenciador
+    termina de escribirlos (tamaño y fecha sin cambios entre dos sondeos). Un archivo
+    ya entregado no se vuelve a entregar salvo que cambie.
+    """
+
+    def __init__(self, folder, known_paths=()):
+        self.folder = folder
+        self._last_seen = {}
+        self._delivered = {}
+        for path in known_paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self._delivered[os.path.normcase(os.path.abspath(path))] = (stat.st_size, stat.st_mtime_ns)
+
+    def poll(self):
+        """Devuelve las rutas de los archivos completos que aún no se habían entregado."""
+        ready = []
+        current = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith('.fsa'):
+                    continue
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns)
+                key = os.path.normcase(os.path.abspath(entry.path))
+                current[key] = signature
+                if stat.st_size == 0 or self._delivered.get(key) == signature:
+                    continue
+                if self._last_seen.get(key) == signature:
+                    ready.append(os.path.abspath(entry.path))
+                    self._delivered[key] = signature
+        self._last_seen = current
+        return sorted(ready)
+
+def load_and_calibrate(path, ladder_channel, template, params, channels=None, drift_model=None):
+    """
+    Carga un .fsa y lo calibra con la plantilla actual, corregida por el modelo de deriva de
+    su capilar si se indica. No toca Tk: pensado para hilos de trabajo.
+    """
+    channels, metadata = read_fsa_file(path, channels)
+    start = int(detect_data_start([combine_start_channels(channels)])[0])
+    metadata["saturation"] = trim_saturation(metadata["saturation"], start)
+    calibration = None
+    if template and ladder_channel in channels:
+        if drift_model is not None:
+            template, tolerance = drift_model.template_for(metadata.get("capillary"), int(params["template_tolerance"]))
+            params = dict(params, template_tolerance=tolerance)
+        calibration = auto_calibrate(channels[ladder_channel], start, template, params)
+    return channels, metadata, start, calibration
+
 # --- Clase SelectPeakDialog ---
 class SelectPeakDialog(simpledialog.Dialog):
     def __init__(self, parent, title, available_sizes):
@@ -87,11 +2121,11 @@ class SplashScreen(tk.Toplevel):
         super().__init__(parent)
         self.launch_callback = launch_callback
 
-        # Cargar la imagen de portada USANDO resource_path
+        # Cargar la imagen de portada USANDO resource_path, ya recortada al tamaño de la ventana
         try:
             path_portada = resource_path("portada.png")
-            self.bg_image = tk.PhotoImage(file=path_portada)
-        except tk.TclError:
+            self.bg_image = load_splash_image(path_portada, width, height)
+        except (tk.TclError, OSError):
             self.bg_image = tk.PhotoImage(width=width, height=height)
 
         # Configuración de la ventana de la portada
@@ -133,6 +2167,9 @@ class SplashScreen(tk.Toplevel):
         
 # --- Asistente de Calibración ---
 class CalibrationWizard(tk.Toplevel):
+    # Número de muestras siguientes que se preparan en segundo plano
+    PRECOMPUTE_AHEAD = 8
+
     def __init__(self, master, app, template=None):
         super().__init__(master)
         self.transient(master)
@@ -142,15 +2179,35 @@ class CalibrationWizard(tk.Toplevel):
         self.calibrations = {}
         self.raw_data = None
         self.detected_peaks_indices = np.array([])
-        self.manual_assignments = {}
+        # Puntos asignados a la muestra actual, con su historial de deshacer/rehacer
+        self.state = CalibrationState()
+        self._bp_axis = None
+        self._bp_lookup = None
         self.first_sample_template = template
+        # Deriva del marcador aprendida de las muestras ya calibradas de esta tanda
+        self.drift_model = DriftModel(template) if template else None
+        # Detección y asignación por plantilla de las muestras siguientes: {índice: (clave, future)}
+        self._precompute_executor = ThreadPoolExecutor(max_workers=1)
+        self._precomputed = {}
+        self._plot_artists = None
+        self._assignment_texts = []
         self.create_widgets()
         self.setup_for_current_file()
         self.fig.canvas.mpl_connect('button_press_event', self._on_plot_click)
+        self.bind("<Control-z>", lambda e: self.undo())
+        self.bind("<Control-y>", lambda e: self.redo())
+        self.bind("<Control-Z>", lambda e: self.redo())
 
-    # En la clase CalibrationWizard, reemplaza esta función:
+    @property
+    def manual_assignments(self):
+        """Copia de los puntos asignados {scan: pb}; los cambios se hacen a través de self.state."""
+        return self.state.assignments
 
-    # En la clase CalibrationWizard, reemplaza esta función:
+    def destroy(self):
+        for _, future in self._precomputed.values():
+            future.cancel()
+        self._precompute_executor.shutdown(wait=False)
+        super().destroy()
 
     def create_widgets(self):
         self.title_var = tk.StringVar()
@@ -165,41 +2222,52 @@ class CalibrationWizard(tk.Toplevel):
 
         # Fila 1 de controles
         ttk.Label(controls_frame, text="Ignorar scans hasta:").grid(row=0, column=0, padx=5, pady=5, sticky="w")
-        self.ignore_scans_var = tk.StringVar(value="1500")
-        ttk.Entry(controls_frame, textvariable=self.ignore_scans_var, width=8).grid(row=0, column=1, padx=5, pady=2)
+        params = self.app.detection_params
+        self.ignore_scans_var = tk.StringVar(value=params["ignore_scans"])
+        ignore_frame = ttk.Frame(controls_frame)
+        ignore_frame.grid(row=0, column=1, padx=5, pady=2, sticky="w")
+        ttk.Entry(ignore_frame, textvariable=self.ignore_scans_var, width=8).pack(side=tk.LEFT)
+        # Si está activo, el corte inicial se toma del inicio detectado automáticamente en cada archivo
+        self.auto_start_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(ignore_frame, text="Auto", variable=self.auto_start_var).pack(side=tk.LEFT, padx=(5, 0))
         
         ttk.Label(controls_frame, text="Ancho Máximo (Picos):").grid(row=0, column=2, padx=5, pady=5, sticky="w")
-        self.width_var = tk.StringVar(value="100") 
+        self.width_var = tk.StringVar(value=params["width"])
         ttk.Entry(controls_frame, textvariable=self.width_var, width=8).grid(row=0, column=3, padx=5, pady=2)
         
         # --- NUEVO PARÁMETRO DE TOLERANCIA ---
         ttk.Label(controls_frame, text="Tolerancia Plantilla:").grid(row=0, column=4, padx=5, pady=5, sticky="w")
-        self.template_tolerance_var = tk.StringVar(value="40") # Aumentamos el valor por defecto
+        self.template_tolerance_var = tk.StringVar(value=params["template_tolerance"])
         ttk.Entry(controls_frame, textvariable=self.template_tolerance_var, width=8).grid(row=0, column=5, padx=5, pady=2)
 
         # Fila 2 de controles
         ttk.Label(controls_frame, text="Altura Mínima:").grid(row=1, column=0, padx=5, pady=5, sticky="w")
-        self.height_var = tk.StringVar(value="50")
+        self.height_var = tk.StringVar(value=params["height"])
         ttk.Entry(controls_frame, textvariable=self.height_var, width=8).grid(row=1, column=1, padx=5)
 
         ttk.Label(controls_frame, text="Prominencia Mínima:").grid(row=1, column=2, padx=5, pady=5, sticky="w")
-        self.prominence_var = tk.StringVar(value="25")
+        self.prominence_var = tk.StringVar(value=params["prominence"])
         ttk.Entry(controls_frame, textvariable=self.prominence_var, width=8).grid(row=1, column=3, padx=5)
         
         ttk.Label(controls_frame, text="Distancia Mínima:").grid(row=1, column=4, padx=5, pady=5, sticky="w")
-        self.distance_var = tk.StringVar(value="10")
+        self.distance_var = tk.StringVar(value=params["distance"])
         ttk.Entry(controls_frame, textvariable=self.distance_var, width=8).grid(row=1, column=5, padx=5)
         
         # Botón de refresco
-        ttk.Button(controls_frame, text="Detectar / Refrescar Picos", command=lambda: self.detect_peaks(silent=False)).grid(row=2, column=0, columnspan=6, pady=10, sticky="ew")
+        ttk.Button(controls_frame, text="Detectar / Refrescar Picos", command=lambda: self.detect_peaks(silent=False)).grid(row=2, column=0, columnspan=5, pady=10, sticky="ew")
+        ttk.Button(controls_frame, text="Barrido de Parámetros...", command=self._open_parameter_sweep).grid(row=2, column=5, padx=5, pady=10, sticky="ew")
         
         # El resto de la función se queda igual
         plot_frame = ttk.LabelFrame(main_frame, text="Gráfico Interactivo", padding="10"); plot_frame.grid(row=1, column=0, sticky="nsew", pady=5)
         plot_frame.rowconfigure(0, weight=1); plot_frame.columnconfigure(0, weight=1)
-        self.fig = plt.Figure(figsize=(10, 6)); self.ax = self.fig.add_subplot(111)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+        self.fig = Figure(figsize=(10, 6)); self.ax = self.fig.add_subplot(111)
         self.canvas = FigureCanvasTkAgg(self.fig, master=plot_frame); self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
         self.toolbar = NavigationToolbar2Tk(self.canvas, plot_frame, pack_toolbar=False); self.toolbar.update(); self.toolbar.pack(side=tk.TOP, fill=tk.X)
         action_frame = ttk.Frame(main_frame); action_frame.grid(row=2, column=0, pady=10, sticky="e")
+        self.undo_button = ttk.Button(action_frame, text="↶ Deshacer", command=self.undo, state='disabled'); self.undo_button.pack(side=tk.LEFT, padx=5)
+        self.redo_button = ttk.Button(action_frame, text="↷ Rehacer", command=self.redo, state='disabled'); self.redo_button.pack(side=tk.LEFT, padx=5)
         ttk.Button(action_frame, text="Limpiar Asignaciones", command=self.clear_assignments).pack(side=tk.LEFT, padx=5)
         self.next_button = ttk.Button(action_frame, command=self.save_and_next, style="Accent.TButton"); self.next_button.pack(side=tk.LEFT, padx=5)
 
@@ -217,20 +2285,103 @@ class CalibrationWizard(tk.Toplevel):
             self.raw_data = None
         else:
             self.raw_data = self.app.loaded_data[filename_key][ladder_ch]
+        if self.auto_start_var.get() and filename_key in self.app.data_start_scans:
+            self.ignore_scans_var.set(str(self.app.data_start_scans[filename_key]))
         if self.current_file_index == len(self.app.fsa_files) - 1:
             self.next_button.config(text="Finalizar")
         else:
             self.next_button.config(text="Guardar y Siguiente")
-            
-        self.detect_peaks(silent=True) # Esto solo detecta los picos
-        if self.first_sample_template:
-            self._auto_assign_from_template(silent=True) # Y esto asigna la primera vez, sin mensaje
-            
+
+        precomputed = self._take_precomputed(self.current_file_index)
+        if precomputed is not None and self.raw_data is not None:
+            # La muestra ya se preparó en segundo plano con los mismos parámetros
+            peaks, assignments = precomputed
+            self.detected_peaks_indices = peaks
+            self.state.replace("Plantilla", assignments)
+        else:
+            self.detect_peaks(silent=True) # Esto solo detecta los picos
+            if self.first_sample_template:
+                self._auto_assign_from_template(silent=True) # Y esto asigna la primera vez, sin mensaje
+
         self.redraw_plot()
-    # En la clase CalibrationWizard, reemplaza esta función:
+        self._schedule_precompute()
+
+    def _open_parameter_sweep(self):
+        try:
+            ParameterSweepWindow(self)
+        except ValueError:
+            messagebox.showerror("Error", "Los parámetros de detección deben ser números.", parent=self)
+
+    def _precompute_key(self, index):
+        """Parámetros que determinan el resultado de una muestra; None si algún valor no es válido."""
+        filename_key = Path(self.app.fsa_files[index]).name
+        try:
+            if self.auto_start_var.get() and filename_key in self.app.data_start_scans:
+                start = int(self.app.data_start_scans[filename_key])
+            else:
+                start = int(self.ignore_scans_var.get())
+            height = float(self.height_var.get())
+            prominence = float(self.prominence_var.get())
+            distance = int(self.distance_var.get())
+            tolerance = int(self.template_tolerance_var.get())
+        except (ValueError, tk.TclError):
+            return None
+        template, tolerance = self._template_for(index, tolerance)
+        template = tuple(sorted(template.items())) if template else None
+        return (filename_key, self.app.ladder_channel_var.get(), start, height, prominence, distance, tolerance, template)
+
+    def _template_for(self, index, tolerance):
+        """
+        Plantilla y tolerancia para una muestra: la plantilla se desplaza/escala según la deriva
+        de su capilar y la tolerancia se reduce a la que justifica el residuo de ese ajuste.
+        """
+        if self.drift_model is None or len(self.drift_model) == 0:
+            return self.first_sample_template, tolerance
+        metadata = self.app.sample_metadata.get(Path(self.app.fsa_files[index]).name, {})
+        return self.drift_model.template_for(metadata.get("capillary"), tolerance)
+
+    def _schedule_precompute(self):
+        """Encola en el hilo de trabajo la detección de las próximas muestras que aún no están listas."""
+        last = min(len(self.app.fsa_files), self.current_file_index + 1 + self.PRECOMPUTE_AHEAD)
+        for index in range(self.current_file_index + 1, last):
+            key = self._precompute_key(index)
+            if key is None:
+                return
+            if index in self._precomputed and self._precomputed[index][0] == key:
+                continue
+            future = self._precompute_executor.submit(self._precompute_sample, self.app.loaded_data, key)
+            self._precomputed[index] = (key, future)
+
+    def _take_precomputed(self, index):
+        entry = self._precomputed.pop(index, None)
+        key = self._precompute_key(index)
+        # La detección solo depende de los 6 primeros campos; si desde entonces solo ha cambiado
+        # la plantilla (el modelo de deriva aprende con cada muestra) se reasigna sin redetectar
+        if entry is None or key is None or entry[0][:6] != key[:6]:
+            return None
+        try:
+            result = entry[1].result()
+        except Exception:
+            return None
+        if result is None or entry[0] == key:
+            return result
+        peaks = result[0]
+        tolerance, template = key[6], key[7]
+        return peaks, (assign_from_template(peaks, dict(template), tolerance) if template and len(peaks) else {})
+
+    @staticmethod
+    def _precompute_sample(loaded_data, key):
+        """Se ejecuta en el hilo de trabajo: no toca ningún widget."""
+        filename_key, ladder_ch, start, height, prominence, distance, tolerance, template = key
+        raw_data = loaded_data.get(filename_key, {}).get(ladder_ch)
+        if raw_data is None:
+            return None
+        peaks = detect_ladder_peaks(raw_data, start, height, prominence, distance, cache_key=(filename_key, ladder_ch))
+        assignments = assign_from_template(peaks, dict(template), tolerance) if template and len(peaks) else {}
+        return peaks, assignments
 
 
-    def _auto_assign_from_template(self, silent=False):
+    def _auto_assign_from_template(self, silent=False, replace=False):
         if not self.first_sample_template or self.raw_data is None or len(self.detected_peaks_indices) == 0:
             return
             
@@ -239,42 +2390,14 @@ class CalibrationWizard(tk.Toplevel):
         except (ValueError, tk.TclError):
             tolerance = 40
 
-        assigned_count = 0
-        
-        # 1. Preparamos las dos listas, ambas ordenadas
-        # La plantilla, ordenada por tamaño de fragmento (bp)
-        template_peaks_sorted = sorted(self.first_sample_template.items())
-        # Los picos detectados, ordenados por posición (scan point)
-        detected_peaks_sorted = sorted(list(self.detected_peaks_indices))
-
-        # Índice para no volver a usar un pico detectado
-        last_detected_idx = 0
-
-        # 2. Iteramos por la plantilla en orden
-        for bp_size, template_scan_point in template_peaks_sorted:
-            
-            # El espacio de búsqueda son solo los picos detectados que aún no hemos usado
-            search_space = detected_peaks_sorted[last_detected_idx:]
-            if len(search_space) == 0:
-                break # No quedan más picos que asignar
+        template, tolerance = self._template_for(self.current_file_index, tolerance)
+        assignments = assign_from_template(self.detected_peaks_indices, template, tolerance)
+        if replace:
+            self.state.replace("Reasignar con plantilla", assignments)
+        else:
+            self.state.apply("Plantilla", assignments)
+        assigned_count = len(assignments)
 
-            # Buscamos la distancia al pico más cercano en el espacio de búsqueda
-            distances = np.abs(np.array(search_space) - template_scan_point)
-            
-            # Si la distancia mínima está dentro de la tolerancia...
-            if np.min(distances) < tolerance:
-                # ...encontramos su posición
-                best_local_idx = np.argmin(distances)
-                
-                # Y lo asignamos
-                scan_point_to_assign = search_space[best_local_idx]
-                self.manual_assignments[scan_point_to_assign] = bp_size
-                assigned_count += 1
-                
-                # IMPORTANTE: Actualizamos el índice para que la próxima búsqueda empiece DESPUÉS de este pico
-                # El '+1' asegura que no volvemos a considerar el mismo pico
-                last_detected_idx += best_local_idx + 1
-            
         if not silent:
             messagebox.showinfo(
                 "Asignación Automática", 
@@ -289,23 +2412,28 @@ class CalibrationWizard(tk.Toplevel):
                 return
             self.calibrations[current_full_path] = None
         else:
-            num_points = len(self.manual_assignments)
-            kind = 'cubic' if num_points >= 4 else ('quadratic' if num_points == 3 else 'linear')
-            sorted_points = sorted(self.manual_assignments.items())
-            scan_points = np.array([p[0] for p in sorted_points])
-            bp_sizes = np.array([p[1] for p in sorted_points])
+            scan_points = np.array(sorted(self.manual_assignments))
             if not np.all(np.diff(scan_points) > 0):
                 messagebox.showerror("Error de Calibración", "Los puntos de calibración deben tener valores de escaneo crecientes.", parent=self)
                 return
-            calib_func = interp1d(scan_points, bp_sizes, kind=kind, fill_value="extrapolate")
+            calib_func = self.state.fit()
             self.calibrations[current_full_path] = (calib_func, self.manual_assignments)
             if self.current_file_index == 0 and self.first_sample_template is None and len(self.manual_assignments) > 0:
                 self.first_sample_template = {v: int(k) for k, v in self.manual_assignments.items()}
+                self.drift_model = DriftModel(self.first_sample_template)
+            if self.drift_model is not None:
+                metadata = self.app.sample_metadata.get(Path(current_full_path).name, {})
+                self.drift_model.observe(metadata.get("capillary"), self.manual_assignments, key=current_full_path)
         self.current_file_index += 1
         if self.current_file_index < len(self.app.fsa_files):
             self.setup_for_current_file()
         else:
-            self.app.finish_calibration(self.calibrations, self.first_sample_template)
+            self.app.detection_params.update({
+                "ignore_scans": self.ignore_scans_var.get(), "width": self.width_var.get(),
+                "template_tolerance": self.template_tolerance_var.get(), "height": self.height_var.get(),
+                "prominence": self.prominence_var.get(), "distance": self.distance_var.get(),
+            })
+            self.app.finish_calibration(self.calibrations, self.first_sample_template, self.drift_model)
             self.destroy()
 
     # En la clase CalibrationWizard, reemplaza esta función:
@@ -323,21 +2451,20 @@ class CalibrationWizard(tk.Toplevel):
             
             if ignore_until_scan >= len(self.raw_data):
                 if not silent: messagebox.showinfo("Aviso", "El valor 'Ignorar scans hasta' es mayor que la longitud de los datos.", parent=self)
-                self.detected_peaks_indices = np.array([])
-            else:
-                data_slice = self.raw_data[ignore_until_scan:]
-                indices_relative, _ = find_peaks(data_slice, height=height, prominence=prominence, distance=distance)
-                self.detected_peaks_indices = indices_relative + ignore_until_scan
+            filename_key = Path(self.app.fsa_files[self.current_file_index]).name
+            self.detected_peaks_indices = detect_ladder_peaks(self.raw_data, ignore_until_scan, height, prominence, distance,
+                                                              cache_key=(filename_key, self.app.ladder_channel_var.get()))
             
             # --- LÓGICA CORREGIDA ---
             # Si el usuario ha pulsado el botón (no es silencioso) y tenemos una plantilla...
             if not silent and self.first_sample_template:
-                self.manual_assignments = {} # Limpiamos las asignaciones anteriores
-                self._auto_assign_from_template(silent=False) # Re-aplicamos la plantilla
+                # Sustituye las asignaciones anteriores por las de la plantilla (se puede deshacer)
+                self._auto_assign_from_template(silent=False, replace=True)
 
             if not silent:
                 self.redraw_plot()
-                
+                self._schedule_precompute()
+
         except Exception as e:
             if not silent:
                 messagebox.showerror("Error", f"No se pudieron detectar los picos: {e}", parent=self)
@@ -358,17 +2485,14 @@ class CalibrationWizard(tk.Toplevel):
         if self.detected_peaks_indices.size == 0:
             return
             
-        # Calculamos la distancia desde el punto del clic a todos los picos detectados
-        distances = np.abs(self.detected_peaks_indices - clicked_scan_point)
-        
+        # Los picos detectados están ordenados por scan: búsqueda binaria del más cercano
+        closest_peak_index_in_array = nearest_sorted(self.detected_peaks_indices, clicked_scan_point)
+        scan_point_to_assign = self.detected_peaks_indices[closest_peak_index_in_array]
+
         # Si el clic está demasiado lejos de cualquier pico, lo ignoramos para evitar clics accidentales.
         # El umbral (e.g., 20 puntos de escaneo) se puede ajustar si es necesario.
-        if np.min(distances) > 20: 
-            return
-
-        # Obtenemos el índice y el valor del pico más cercano
-        closest_peak_index_in_array = np.argmin(distances)
-        scan_point_to_assign = self.detected_peaks_indices[closest_peak_index_in_array]
+        if abs(scan_point_to_assign - clicked_scan_point) > 20:
+            return
 
         # Preparamos la lista de tamaños del marcador que aún no han sido asignados
         ladder_sizes = KNOWN_LADDERS[self.app.ladder_type_var.get()]
@@ -387,25 +2511,44 @@ class CalibrationWizard(tk.Toplevel):
         if selected_bp is not None:
             if selected_bp == "DELETE":
                 # Si el usuario quiere borrar, eliminamos la asignación
-                if scan_point_to_assign in self.manual_assignments:
-                    del self.manual_assignments[scan_point_to_assign]
+                self.state.remove(scan_point_to_assign)
             else:
                 # Si no, creamos o actualizamos la asignación
-                self.manual_assignments[scan_point_to_assign] = selected_bp
+                self.state.assign(scan_point_to_assign, selected_bp)
         
         # Redibujamos el gráfico para que se vean los cambios al instante
         self.redraw_plot()
+    def _create_plot_artists(self):
+        """Crea una sola vez los artistas del gráfico; al cambiar de muestra solo se sustituyen sus datos."""
+        raw_line, = self.ax.plot([], [], color='grey', alpha=0.7, label='Datos Brutos Marcador')
+        unassigned_line, = self.ax.plot([], [], 'x', color='red', label='Picos Detectados')
+        assigned_line, = self.ax.plot([], [], 'o', color='blue', markersize=8, fillstyle='none', markeredgewidth=1.5, label='Picos Asignados')
+        self._plot_artists = (raw_line, unassigned_line, assigned_line)
+        self.ax.set_title("Haz clic en un pico 'x' para asignarle un tamaño del marcador")
+        self.ax.set_xlabel("Puntos de escaneo (Scan Points)")
+        self.ax.set_ylabel("Intensidad (RFU)")
+        self.ax.grid(True, linestyle=':')
+        self.ax.legend()
+        # Eje superior en pb con la calibración en curso: se recalcula al dibujar, sin rehacer el gráfico
+        self._bp_axis = self.ax.secondary_xaxis('top', functions=(self._scan_to_bp, self._bp_to_scan))
+        self._bp_axis.set_xlabel("Tamaño estimado (pb)")
+        self.fig.tight_layout()
+
     def redraw_plot(self):
-        current_xlim = self.ax.get_xlim()
-        current_ylim = self.ax.get_ylim()
-        is_zoomed = not self.ax.get_autoscalex_on() and not self.ax.get_autoscaley_on()
-        self.ax.clear()
+        if self._plot_artists is None:
+            self._create_plot_artists()
+        raw_line, unassigned_line, assigned_line = self._plot_artists
+        for text in self._assignment_texts:
+            text.remove()
+        self._assignment_texts = []
+        empty = np.array([])
+        raw_line.set_data(empty, empty); unassigned_line.set_data(empty, empty); assigned_line.set_data(empty, empty)
+
         if self.raw_data is not None:
-            self.ax.plot(self.raw_data, color='grey', alpha=0.7, label='Datos Brutos Marcador')
+            raw_line.set_data(np.arange(len(self.raw_data)), self.raw_data)
             if len(self.detected_peaks_indices) > 0:
-                unassigned_peaks = np.setdiff1d(self.detected_peaks_indices, list(self.manual_assignments.keys()))
-                if len(unassigned_peaks) > 0:
-                    self.ax.plot(unassigned_peaks, self.raw_data[unassigned_peaks], 'x', color='red', label='Picos Detectados')
+                unassigned_peaks = np.setdiff1d(self.detected_peaks_indices, list(self.manual_assignments.keys())).astype(int)
+                unassigned_line.set_data(unassigned_peaks, self.raw_data[unassigned_peaks])
             if self.manual_assignments:
                 assigned_scans = np.array(list(self.manual_assignments.keys()), dtype=int)
                 assigned_bps = np.array(list(self.manual_assignments.values()))
@@ -413,28 +2556,63 @@ class CalibrationWizard(tk.Toplevel):
                 assigned_scans = assigned_scans[sort_indices]
                 assigned_bps = assigned_bps[sort_indices]
                 valid_indices = assigned_scans < len(self.raw_data)
-                self.ax.plot(assigned_scans[valid_indices], self.raw_data[assigned_scans[valid_indices]], 'o', color='blue', markersize=8, fillstyle='none', markeredgewidth=1.5, label='Picos Asignados')
+                assigned_line.set_data(assigned_scans[valid_indices], self.raw_data[assigned_scans[valid_indices]])
+                label_offset = self.raw_data.max() * 0.02
                 for sp, bp in zip(assigned_scans[valid_indices], assigned_bps[valid_indices]):
-                    self.ax.text(sp, self.raw_data[sp] + (self.raw_data.max() * 0.02), f'{bp:.0f}', color='blue', fontweight='bold', fontsize=8, ha='center')
-        self.ax.set_title("Haz clic en un pico 'x' para asignarle un tamaño del marcador")
-        self.ax.set_xlabel("Puntos de escaneo (Scan Points)")
-        self.ax.set_ylabel("Intensidad (RFU)")
-        self.ax.grid(True, linestyle=':')
-        handles, labels = self.ax.get_legend_handles_labels()
-        if handles:
-            self.ax.legend(handles, labels)
-        if is_zoomed:
-            self.ax.set_xlim(current_xlim)
-            self.ax.set_ylim(current_ylim)
-        self.fig.tight_layout()
-        self.canvas.draw()
+                    self._assignment_texts.append(self.ax.text(sp, self.raw_data[sp] + label_offset, f'{bp:.0f}', color='blue', fontweight='bold', fontsize=8, ha='center'))
+
+        self._bp_axis.set_visible(self.state.fit() is not None)
+        self.undo_button.config(state='normal' if self.state.undo_label else 'disabled')
+        self.redo_button.config(state='normal' if self.state.redo_label else 'disabled')
+        # Si el usuario ha hecho zoom se respetan sus límites; si no, se reajustan a los nuevos datos
+        if self.ax.get_autoscalex_on() or self.ax.get_autoscaley_on():
+            self.ax.relim()
+            self.ax.autoscale_view()
+        self.canvas.draw_idle()
+
+    def _bp_table(self):
+        """(scans, pb) de la calibración actual entre el primer y el último punto, monótona, para el eje superior."""
+        fit = self.state.fit()
+        if fit is None:
+            return None
+        if self._bp_lookup is None or self._bp_lookup[0] is not fit:
+            scans = np.arange(self.state.scans[0], self.state.scans[-1] + 1, dtype=float)
+            self._bp_lookup = (fit, scans, np.maximum.accumulate(fit(scans)))
+        return self._bp_lookup[1:]
+
+    @staticmethod
+    def _interp_linear_ends(x, xp, fp):
+        """np.interp con extrapolación lineal (pendiente media) fuera del tramo calibrado."""
+        x = np.asarray(x, dtype=float)
+        slope = (fp[-1] - fp[0]) / (xp[-1] - xp[0])
+        return np.where(x < xp[0], fp[0] + (x - xp[0]) * slope,
+                        np.where(x > xp[-1], fp[-1] + (x - xp[-1]) * slope, np.interp(x, xp, fp)))
+
+    def _scan_to_bp(self, scans):
+        table = self._bp_table()
+        return np.asarray(scans, dtype=float) if table is None else self._interp_linear_ends(scans, *table)
+
+    def _bp_to_scan(self, bps):
+        table = self._bp_table()
+        return np.asarray(bps, dtype=float) if table is None else self._interp_linear_ends(bps, table[1], table[0])
+
+    def undo(self):
+        if self.state.undo() is not None:
+            self.redraw_plot()
+
+    def redo(self):
+        if self.state.redo() is not None:
+            self.redraw_plot()
 
     def clear_assignments(self, full_reset=False):
-        self.manual_assignments = {}
         if full_reset:
+            # Muestra nueva: estado e historial propios
+            self.state = CalibrationState()
             self.detected_peaks_indices = np.array([])
             if self.raw_data is not None:
                 self.ax.autoscale()
+        else:
+            self.state.clear()
         self.redraw_plot()
 
 # REEMPLAZA LA CLASE ANTERIOR CON ESTA VERSIÓN MEJORADA
@@ -479,12 +2657,16 @@ class PlotViewerWindow(tk.Toplevel):
         self.overlay_var = tk.BooleanVar(value=False)
         overlay_cb = ttk.Checkbutton(controls_frame, text="Superponer Muestras", variable=self.overlay_var, command=self.update_plots, style="Toolbutton")
         overlay_cb.pack(side=tk.LEFT, padx=5)
+        self.overlay_mode_var = tk.StringVar(value=OVERLAY_MODES[0])
+        overlay_mode_menu = ttk.Combobox(controls_frame, textvariable=self.overlay_mode_var, values=OVERLAY_MODES, state='readonly', width=28)
+        overlay_mode_menu.pack(side=tk.LEFT, padx=5)
+        overlay_mode_menu.bind("<<ComboboxSelected>>", lambda e: self.update_plots())
         
         ttk.Separator(controls_frame, orient=tk.VERTICAL).pack(side=tk.LEFT, padx=10, fill='y')
 
         # Controles de Detección
         ttk.Label(controls_frame, text="Altura Mínima (RFU):").pack(side=tk.LEFT, padx=(5, 0))
-        self.peak_height_var = tk.StringVar(value="100")
+        self.peak_height_var = tk.StringVar(value=self.app.detection_params["peak_height"])
         ttk.Entry(controls_frame, textvariable=self.peak_height_var, width=8).pack(side=tk.LEFT, padx=5)
         
         ttk.Button(controls_frame, text="🔍 Encontrar Picos", command=self._find_and_display_peaks).pack(side=tk.LEFT, padx=5)
@@ -493,12 +2675,17 @@ class PlotViewerWindow(tk.Toplevel):
         # --- 2. Panel del Gráfico ---
         plot_frame = ttk.Frame(left_pane)
         left_pane.add(plot_frame, weight=1)
-        self.fig = plt.Figure(figsize=(10, 8), dpi=100)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        self.plot_frame = plot_frame
+        self.fig = Figure(figsize=(10, 8), dpi=100)
         self.canvas = FigureCanvasTkAgg(self.fig, master=plot_frame)
         self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
-        self.toolbar = NavigationToolbar2Tk(self.canvas, plot_frame, pack_toolbar=False)
-        self.toolbar.update()
-        self.toolbar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.hover_var = tk.StringVar()
+        self.hover_label = ttk.Label(plot_frame, textvariable=self.hover_var, anchor='w')
+        self.hover_label.pack(side=tk.BOTTOM, fill=tk.X)
+        self.toolbar = None
+        self._connect_canvas_events()
         
         # --- 3. Panel Derecho para la Tabla de Picos ---
         table_container = ttk.Frame(main_pane)
@@ -506,12 +2693,15 @@ class PlotViewerWindow(tk.Toplevel):
         table_frame = ttk.LabelFrame(table_container, text="Tabla de Picos Detectados", padding=10)
         table_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 5))
 
-        columns = ('file', 'channel', 'size', 'height')
+        columns = ('file', 'channel', 'size', 'height', 'saturated')
         self.peak_table = ttk.Treeview(table_frame, columns=columns, show='headings')
         self.peak_table.heading('file', text='Archivo'); self.peak_table.column('file', width=180)
         self.peak_table.heading('channel', text='Canal'); self.peak_table.column('channel', width=60)
         self.peak_table.heading('size', text='Tamaño (pb)'); self.peak_table.column('size', width=80)
         self.peak_table.heading('height', text='Altura (RFU)'); self.peak_table.column('height', width=80)
+        self.peak_table.heading('saturated', text='Saturado'); self.peak_table.column('saturated', width=60)
+        # Picos fuera de escala: su altura no es fiable
+        self.peak_table.tag_configure('saturated', foreground='red')
         
         scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.peak_table.yview)
         self.peak_table.configure(yscrollcommand=scrollbar.set)
@@ -522,10 +2712,19 @@ class PlotViewerWindow(tk.Toplevel):
         
         export_button = ttk.Button(table_container, text="📊 Exportar Tabla a Excel", command=self._export_to_excel, style="Accent.TButton")
         export_button.pack(fill=tk.X, ipady=5)
+        ttk.Button(table_container, text="🗄 Guardar en Proyecto...", command=self._save_to_project).pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(table_container, text="⚖ Comparar con Referencia...", command=self._open_comparison).pack(fill=tk.X, pady=(5, 0))
 
         # --- Variables y final de la inicialización ---
         self.peak_markers = []
+        self.peak_results = {}
         self.last_clicked_peak = None
+        # Render en segundo plano: un solo hilo; cada petición incrementa la generación y las
+        # anteriores se descartan. _render_job = (generación, future, entradas)
+        self._render_executor = ThreadPoolExecutor(max_workers=1)
+        self._render_generation = 0
+        self._render_job = None
+        self._render_after_id = None
         self.protocol("WM_DELETE_WINDOW", self.on_close)
         self.update_plots()
 
@@ -533,6 +2732,33 @@ class PlotViewerWindow(tk.Toplevel):
         self.app.plot_viewer = None
         self.destroy()
 
+    def destroy(self):
+        self._render_generation += 1
+        if self._render_after_id is not None:
+            self.after_cancel(self._render_after_id)
+            self._render_after_id = None
+        if self._render_job is not None:
+            self._render_job[1].cancel()
+            self._render_job = None
+        self._render_executor.shutdown(wait=False)
+        super().destroy()
+
+    def _on_hover(self, event):
+        """Lectura en vivo bajo el ratón: la traza del eje cuyo valor en x queda más cerca del cursor."""
+        if event.inaxes is None or event.xdata is None:
+            self.hover_var.set(""); return
+        best = None
+        for line in event.inaxes.get_lines():
+            if not hasattr(line, 'full_data') or not line.get_visible(): continue
+            _, x_coord, y_coord = TracePeakIndex.for_artist(line).value_at(event.xdata)
+            distance = abs(y_coord - event.ydata)
+            if best is None or distance < best[0]:
+                best = (distance, line.get_label(), x_coord, y_coord)
+        if best is None:
+            self.hover_var.set(f"{event.xdata:.1f} pb"); return
+        _, label, x_coord, y_coord = best
+        self.hover_var.set(f"{event.inaxes.get_title()}  {label}: {x_coord:.1f} pb, {y_coord:.0f} RFU")
+
     # En la clase PlotViewerWindow, reemplaza esta función:
 
     def _send_peak_to_calculator(self):
@@ -555,211 +2781,688 @@ class PlotViewerWindow(tk.Toplevel):
     # En la clase PlotViewerWindow, reemplaza la función _find_and_display_peaks por esta:
 
     def _find_and_display_peaks(self):
-        # La llamada a update_plots ya no necesita el argumento clear_peak_markers
-        self.update_plots(clear_table=True) # <--- LÍNEA CORREGIDA
-        
-        # El resto de la función se queda igual
         try:
             min_height = float(self.peak_height_var.get())
         except ValueError:
             messagebox.showerror("Error", "La altura mínima del pico debe ser un número.", parent=self)
             return
-            
-        selected_sample_channels = [name for name, var in self.channel_vars.items() if var.get()]
-        selected_file_indices = self.app.file_listbox.curselection()
-        files_to_plot = [self.app.fsa_files[i] for i in selected_file_indices]
-        
-        axes_to_process = self.fig.axes
-        is_overlay = self.overlay_var.get()
-        
-        for ax_idx, ax in enumerate(axes_to_process):
-            files_for_this_ax = files_to_plot if is_overlay else [files_to_plot[ax_idx]]
-            
-            for full_path in files_for_this_ax:
-                filename_key = Path(full_path).name
-                calib_data = self.app.calibrations.get(full_path)
-                if not calib_data: continue
-                
-                local_calib_func, _ = calib_data
-                
-                for channel_name in selected_sample_channels:
-                    if channel_name in self.app.loaded_data.get(filename_key, {}):
-                        y_raw = self.app.loaded_data[filename_key][channel_name]
-                        y_cleaned = self._clean_trace_hammock(y_raw)
-                        
-                        indices, props = find_peaks(y_cleaned, height=min_height, prominence=min_height/4)
-                        
-                        if len(indices) > 0:
-                            sizes_bp = local_calib_func(indices)
-                            heights_rfu = props['peak_heights']
-                            
-                            channel_display_name = CHANNEL_DISPLAY_NAME_MAP.get(channel_name, channel_name)
-                            for size, height in zip(sizes_bp, heights_rfu):
-                                table_values = (filename_key, channel_display_name, f"{size:.1f}", f"{height:.0f}")
-                                self.peak_table.insert('', tk.END, values=table_values)
-                            
-                            color = CHANNEL_COLOR_MAP.get(channel_name, 'purple')
-                            marker = ax.plot(sizes_bp, heights_rfu, 'v', markersize=5, alpha=0.7, color=color)[0]
-                            self.peak_markers.append(marker)
-    
-        self.canvas.draw()
+        self.app.detection_params["peak_height"] = self.peak_height_var.get()
+        # Detección y marcadores se hacen junto con el render de la figura, en segundo plano
+        self.update_plots(clear_table=True, min_height=min_height)
     
+    def _insert_peak_rows(self, full_path, channel_name, sizes_bp, heights_rfu):
+        self.peak_results.setdefault(full_path, {})[channel_name] = (sizes_bp, heights_rfu)
+        filename_key = Path(full_path).name
+        channel_display_name = CHANNEL_DISPLAY_NAME_MAP.get(channel_name, channel_name)
+        regions = self.app.sample_metadata.get(filename_key, {}).get("saturation", {}).get(channel_name)
+        saturated = saturated_peak_mask(sizes_bp, regions, self.app.calibrations[full_path][0])
+        with PERF.stage("Inserción en tabla"):
+            for size, height, flag in zip(sizes_bp, heights_rfu, saturated):
+                table_values = (filename_key, channel_display_name, f"{size:.1f}", f"{height:.0f}", "Sí" if flag else "")
+                self.peak_table.insert('', tk.END, values=table_values, tags=('saturated',) if flag else ())
+
+    def append_sample_peaks(self, full_path):
+        """Añade a la tabla ya calculada los picos de una muestra recién incorporada, sin redibujar."""
+        calib_data = self.app.calibrations.get(full_path)
+        if not calib_data or not self.peak_table.get_children():
+            return
+        try:
+            min_height = float(self.peak_height_var.get())
+        except ValueError:
+            return
+        filename_key = Path(full_path).name
+        channels_data = self.app.loaded_data.get(filename_key, {})
+        for channel_name in [name for name, var in self.channel_vars.items() if var.get()]:
+            if channel_name in channels_data:
+                sizes_bp, heights_rfu = detect_sample_peaks(channels_data[channel_name], calib_data[0], min_height, cache_key=(filename_key, channel_name))
+                if len(sizes_bp) > 0:
+                    self._insert_peak_rows(full_path, channel_name, sizes_bp, heights_rfu)
+
+    def refresh_calibrations(self, paths):
+        """
+        Aplica en sitio las nuevas calibraciones de 'paths': nuevas x (pb) de sus trazas,
+        marcas de calibración, picos y filas de la tabla, sin reconstruir la figura. La
+        superposición (remuestreada en una rejilla común) y los cambios de calibrada a
+        saltada, o al revés, sí redibujan todo.
+        """
+        paths = set(paths)
+        if self._render_job is not None:
+            # Hay una figura en curso con las calibraciones anteriores: se vuelve a pedir
+            self.update_plots(clear_table=bool(self.peak_results), min_height=self._render_job[2]["min_height"]); return
+        axes = [ax for ax in self.fig.axes if getattr(ax, 'sample_path', None) in paths]
+        needs_rebuild = self.overlay_var.get() or any(
+            self.app.calibrations.get(ax.sample_path) is None or not hasattr(ax, 'bp_lines') for ax in axes)
+        if needs_rebuild:
+            self.update_plots(clear_table=bool(self.peak_results))
+            return
+        if not axes:
+            return
+        ladder_channel = self.app.ladder_channel_var.get()
+        for ax in axes:
+            calib_func, assigned_peaks = self.app.calibrations[ax.sample_path]
+            for line in ax.bp_lines:
+                y_values = line.get_ydata()
+                x_bp = calib_func(np.arange(len(y_values)))
+                line.set_xdata(x_bp)
+                if hasattr(line, 'full_data'):
+                    line.full_data = (x_bp, y_values)
+                    line.peak_index = None
+            for artist in ax.calibration_marks:
+                artist.remove()
+            y_ladder = self.app.loaded_data.get(Path(ax.sample_path).name, {}).get(ladder_channel)
+            ax.calibration_marks = draw_calibration_marks(ax, assigned_peaks, y_ladder) if y_ladder is not None else []
+
+        refreshed = [path for path in paths if path in self.peak_results]
+        if refreshed:
+            # Picos de las muestras recalibradas: se quitan sus marcas y filas y se vuelven a calcular
+            # (la detección en scans sigue en PEAK_CACHE; solo cambia su tamaño en pb)
+            for marker in [m for m in self.peak_markers if getattr(m, 'sample_path', None) in paths]:
+                marker.remove(); self.peak_markers.remove(marker)
+            names = {Path(path).name for path in refreshed}
+            self.peak_table.delete(*[item for item in self.peak_table.get_children() if self.peak_table.item(item)['values'][0] in names])
+            axes_by_path = {ax.sample_path: ax for ax in axes}
+            try:
+                min_height = float(self.peak_height_var.get())
+            except ValueError:
+                min_height = float(DEFAULT_DETECTION_PARAMS["peak_height"])
+            for full_path in refreshed:
+                del self.peak_results[full_path]
+                channels_data = self.app.loaded_data.get(Path(full_path).name, {})
+                calib_func = self.app.calibrations[full_path][0]
+                for channel_name in [name for name, var in self.channel_vars.items() if var.get()]:
+                    if channel_name not in channels_data: continue
+                    sizes_bp, heights_rfu = detect_sample_peaks(channels_data[channel_name], calib_func, min_height, cache_key=(Path(full_path).name, channel_name))
+                    if len(sizes_bp) == 0: continue
+                    self._insert_peak_rows(full_path, channel_name, sizes_bp, heights_rfu)
+                    if full_path in axes_by_path:
+                        marker = axes_by_path[full_path].plot(sizes_bp, heights_rfu, 'v', markersize=5, alpha=0.7, color=CHANNEL_COLOR_MAP.get(channel_name, 'purple'))[0]
+                        marker.sample_path = full_path
+                        self.peak_markers.append(marker)
+        self.canvas.draw_idle()
+
     def _export_to_excel(self):
         if not self.peak_table.get_children():
             messagebox.showwarning("Exportar", "No hay picos en la tabla para exportar.", parent=self); return
         filepath = filedialog.asksaveasfilename(title="Guardar como Excel",defaultextension=".xlsx", filetypes=[("Archivos de Excel", "*.xlsx")])
         if not filepath: return
         try:
-            workbook = openpyxl.Workbook()
-            summary_sheet = workbook.active
-            summary_sheet.title = "Resumen de Picos"
             headers = [self.peak_table.heading(c)['text'] for c in self.peak_table['columns']]
-            summary_sheet.append(headers)
-            all_peaks = []
-            for item_id in self.peak_table.get_children():
-                values = self.peak_table.item(item_id)['values']
-                summary_sheet.append(values)
-                all_peaks.append(dict(zip(headers, values)))
-            pivoted_data = {}
-            for peak in all_peaks:
-                filename = peak['Archivo']
-                channel = peak['Canal']
-                size = peak['Tamaño (pb)']
-                if filename not in pivoted_data: pivoted_data[filename] = {}
-                if channel not in pivoted_data[filename]: pivoted_data[filename][channel] = []
-                pivoted_data[filename][channel].append(float(size))
-            for filename, channel_data in pivoted_data.items():
-                sheet_name = filename.split('.')[0][:30]
-                sample_sheet = workbook.create_sheet(title=sheet_name)
-                column_headers = list(channel_data.keys())
-                column_data = list(channel_data.values())
-                sample_sheet.append(column_headers)
-                for row_data in zip_longest(*column_data, fillvalue=""):
-                    sample_sheet.append(row_data)
-            params_sheet = workbook.create_sheet(title="Parámetros de Análisis")
+            rows = [self.peak_table.item(item_id)['values'] for item_id in self.peak_table.get_children()]
             params = {
-                "Archivos Analizados": ", ".join([Path(f).name for i, f in enumerate(self.app.fsa_files) if i in self.app.file_listbox.curselection()]),
+                "Archivos Analizados": ", ".join(Path(f).name for f in self.app.selected_files()),
                 "Tipo de Marcador": self.app.ladder_type_var.get(), "Canal del Marcador": self.app.ladder_channel_var.get(),
                 "Altura Mínima (RFU) para Detección": self.peak_height_var.get(),
                 "Fecha de Análisis": np.datetime_as_string(np.datetime64('now', 's'), unit='s')
             }
-            params_sheet.append(["Parámetro", "Valor"])
-            for key, value in params.items():
-                params_sheet.append([key, value])
-            workbook.save(filepath)
+            write_peak_workbook(filepath, headers, rows, params, samples=self.app.sample_index.table(list(self.peak_results)))
             messagebox.showinfo("Éxito", f"Resultados exportados a:\n{filepath}", parent=self)
         except Exception as e:
             messagebox.showerror("Error de Exportación", f"No se pudo guardar el archivo de Excel:\n{e}", parent=self)
             
-    @staticmethod
-    def _clean_trace_hammock(y_data, num_chunks=30):
-        if len(y_data) < num_chunks * 2: return y_data
-        x_points = np.arange(len(y_data)); chunk_size = len(y_data) // num_chunks
-        if chunk_size == 0: return y_data
-        anchor_x = [0]; anchor_y = [y_data[0]]
-        for i in range(num_chunks):
-            start = i * chunk_size; end = start + chunk_size
-            chunk = y_data[start:end]
-            if chunk.size > 0:
-                min_index_in_chunk = np.argmin(chunk)
-                anchor_x.append(start + min_index_in_chunk); anchor_y.append(chunk[min_index_in_chunk])
-        anchor_x.append(len(y_data) - 1); anchor_y.append(y_data[-1])
-        baseline = np.interp(x_points, anchor_x, anchor_y)
-        cleaned_data = y_data - baseline; cleaned_data[cleaned_data < 0] = 0
-        return cleaned_data
+    def _open_comparison(self):
+        if len(self.peak_results) < 2:
+            messagebox.showwarning("Comparar", "Detecta primero los picos de al menos dos muestras.", parent=self); return
+        ComparisonWindow(self, self.peak_results)
 
-    # En la clase PlotViewerWindow, reemplaza esta función:
+    def _save_to_project(self):
+        """Añade los picos de la tabla, con sus calibraciones, a la base de datos del proyecto."""
+        if not self.peak_results:
+            messagebox.showwarning("Proyecto", "No hay picos en la tabla para guardar.", parent=self); return
+        filepath = self.app.ask_project_path(parent=self)
+        if not filepath: return
+        default_name = Path(next(iter(self.peak_results))).parent.name
+        run_name = simpledialog.askstring("Proyecto", "Nombre de la ejecución:", initialvalue=default_name, parent=self)
+        if not run_name: return
+        samples = []
+        fingerprint_channels = list(SAMPLE_CHANNELS)
+        for full_path, peaks in self.peak_results.items():
+            calib_data = self.app.calibrations.get(full_path)
+            channels_data = self.app.loaded_data.get(Path(full_path).name, {})
+            samples.append({"filename": Path(full_path).name, "path": full_path,
+                            "assignments": calib_data[1] if calib_data else None, "peaks": peaks,
+                            "fingerprint": compute_fingerprint(channels_data, calib_data[0], fingerprint_channels) if calib_data else None,
+                            "fingerprint_channels": fingerprint_channels})
+        params = {"peak_height": self.peak_height_var.get(), **self.app.detection_params}
+        try:
+            with ProjectDatabase(filepath) as db:
+                db.add_run(run_name, samples, self.app.ladder_type_var.get(), self.app.ladder_channel_var.get(), params)
+                n_runs, n_samples, n_peaks = db.counts()
+            messagebox.showinfo("Proyecto", f"Ejecución guardada.\n\nEl proyecto contiene {n_runs} ejecuciones, {n_samples} muestras y {n_peaks} picos.", parent=self)
+        except sqlite3.Error as e:
+            messagebox.showerror("Proyecto", f"No se pudo guardar en la base de datos:\n{e}", parent=self)
 
-    def update_plots(self, clear_table=False):
-        self.fig.clear()
-        
-        # --- CORRECCIÓN ---
-        # Borramos las referencias a los marcadores antiguos. 
-        # Los gráficos ya se han borrado con self.fig.clear().
+    _clean_trace_hammock = staticmethod(clean_trace_hammock)
+
+    @staticmethod
+    def _draw_overlay_channel(ax, overlay_mode, grid, matrix, sample_names, display_name, color):
+        """Dibuja un canal ya remuestreado (muestras x rejilla) según el modo de superposición."""
+        if overlay_mode == OVERLAY_MODES[1]:
+            # Consenso: mediana y banda de percentiles 10-90 de todas las muestras
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                p10, median, p90 = np.nanpercentile(matrix, [10, 50, 90], axis=0)
+            ax.fill_between(grid, p10, p90, color=color, alpha=0.2, linewidth=0, label=f"{display_name} P10-P90")
+            line, = ax.plot(grid, median, color=color, linewidth=1.4, label=f"{display_name} mediana (n={len(matrix)})")
+            line.set_picker(5); line.full_data = (grid, np.nan_to_num(median))
+        elif overlay_mode == OVERLAY_MODES[2]:
+            # Diferencia: cada muestra menos la primera seleccionada (referencia)
+            reference = matrix[0]
+            for name, row in zip(sample_names[1:], matrix[1:]):
+                difference = row - reference
+                line, = ax.plot(grid, difference, color=color, linewidth=1.0, alpha=0.7, label=f"{name} - {sample_names[0]} ({display_name})")
+                line.set_picker(5); line.full_data = (grid, np.nan_to_num(difference))
+        else:
+            for name, row in zip(sample_names, matrix):
+                line, = ax.plot(grid, row, color=color, linewidth=1.2, alpha=0.7, label=f"{name} - {display_name}")
+                line.set_picker(5); line.full_data = (grid, np.nan_to_num(row))
+
+    def update_plots(self, clear_table=False, min_height=None):
+        """
+        Reconstruye la figura del visor. Las entradas se leen aquí, en el hilo de Tk; los ejes
+        se dibujan y se renderizan con Agg en un hilo de trabajo sobre una figura fuera de
+        pantalla, que sustituye a la actual cuando está lista. Mientras tanto la ventana sigue
+        respondiendo, y cada nueva petición deja obsoletas las anteriores. Con 'min_height'
+        se detectan además los picos de las muestras y se marcan en la figura.
+        """
+        self._render_generation += 1
+        if self._render_job is not None:
+            self._render_job[1].cancel()
+            self._render_job = None
         self.peak_markers = []
         
         if clear_table:
             self.peak_table.delete(*self.peak_table.get_children())
+            self.peak_results = {}
         
-        # El resto de la función se queda exactamente igual
         try:
             selected_sample_channels = [name for name, var in self.channel_vars.items() if var.get()]
-            selected_file_indices = self.app.file_listbox.curselection()
-            if not selected_file_indices:
-                self.fig.text(0.5, 0.5, "No hay muestras seleccionadas.", ha='center'); self.canvas.draw(); return
-            files_to_plot = [self.app.fsa_files[i] for i in selected_file_indices]
+            files_to_plot = self.app.selected_files()
+            if not files_to_plot:
+                self._show_message("No hay muestras seleccionadas."); return
             xlim_min = float(self.app.xlim_min_var.get()); xlim_max = float(self.app.xlim_max_var.get())
         except (ValueError, TypeError):
             messagebox.showerror("Error", "Parámetros de visualización inválidos.", parent=self); return
         if not selected_sample_channels:
-            self.fig.text(0.5, 0.5, "Ningún canal seleccionado.", ha='center'); self.canvas.draw(); return
+            self._show_message("Ningún canal seleccionado."); return
+
+        job = {"files": files_to_plot, "channels": selected_sample_channels, "xlim": (xlim_min, xlim_max),
+               "ladder_channel": self.app.ladder_channel_var.get(),
+               "overlay_mode": self.overlay_mode_var.get() if self.overlay_var.get() else None,
+               "loaded_data": self.app.loaded_data, "calibrations": dict(self.app.calibrations), "bp_store": self.app.bp_store,
+               "min_height": min_height, "figsize": tuple(self.fig.get_size_inches()), "dpi": self.fig.dpi}
+        generation = self._render_generation
+        self._render_job = (generation, self._render_executor.submit(self._render_figure, generation, job), job)
+        if self._render_after_id is None:
+            self._render_after_id = self.after(RENDER_POLL_MS, self._poll_render)
 
+    def _show_message(self, text):
+        self.fig.clear()
         self.app._clear_annotations()
-        self.fig.canvas.mpl_connect('pick_event', self.app._on_plot_click)
-        ladder_channel = self.app.ladder_channel_var.get()
-        
-        is_overlay = self.overlay_var.get()
-        if is_overlay:
+        self.fig.text(0.5, 0.5, text, ha='center')
+        self.canvas.draw()
+
+    def _render_figure(self, generation, job):
+        """
+        Hilo de trabajo: dibuja la figura completa y la renderiza en su propio búfer Agg.
+        Devuelve None si mientras tanto se ha pedido otra figura.
+        """
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        fig = Figure(figsize=job["figsize"], dpi=job["dpi"])
+        agg_canvas = FigureCanvasAgg(fig)
+        files_to_plot, selected_sample_channels = job["files"], job["channels"]
+        loaded_data, calibrations = job["loaded_data"], job["calibrations"]
+        xlim_min, xlim_max = job["xlim"]
+        overlay_mode = job["overlay_mode"]
+        if overlay_mode is not None:
             # --- MODO SUPERPOSICIÓN: 1 GRÁFICO ---
-            ax = self.fig.add_subplot(111)
-            ax.set_title("Superposición de Muestras")
-            for full_path in files_to_plot:
-                filename_key = Path(full_path).name
-                calib_data = self.app.calibrations.get(full_path)
-                if not calib_data: continue
-                local_calib_func, _ = calib_data
-                for sample_ch in selected_sample_channels:
-                    if sample_ch in self.app.loaded_data.get(filename_key, {}):
-                        y_raw = self.app.loaded_data[filename_key][sample_ch]
-                        y_cleaned = self._clean_trace_hammock(y_raw)
-                        x_scan = np.arange(len(y_cleaned))
-                        x_bp = local_calib_func(x_scan)
-                        color = CHANNEL_COLOR_MAP.get(sample_ch, 'purple')
-                        display_name = CHANNEL_DISPLAY_NAME_MAP.get(sample_ch, sample_ch)
-                        label = f"{Path(filename_key).stem} - {display_name}"
-                        line, = ax.plot(x_bp, y_cleaned, color=color, label=label, linewidth=1.2, alpha=0.7)
-                        line.set_picker(5); line.full_data = (x_bp, y_cleaned)
-            ax.grid(True, linestyle=':'); ax.legend(fontsize='small'); ax.set_xlim(xlim_min, xlim_max); ax.set_ylabel("RFU"); ax.set_xlabel("Tamaño (pb)")
+            # Todas las muestras de cada canal se remuestrean juntas sobre una rejilla común de pb
+            ax = fig.add_subplot(111)
+            ax.set_title(f"Superposición de Muestras - {overlay_mode}")
+            calibrated = [(Path(f).name, calibrations[f][0]) for f in files_to_plot if calibrations.get(f)]
+            store = job["bp_store"]
+            for sample_ch in selected_sample_channels:
+                if generation != self._render_generation: return None
+                present = [(key, func) for key, func in calibrated if sample_ch in loaded_data.get(key, {})]
+                if not present: continue
+                keys = [key for key, _ in present]
+                if store is not None and store.contains(keys, sample_ch):
+                    # Si existe el almacén en pb, la superposición es solo una lectura
+                    grid, matrix = store.window(keys, sample_ch, xlim_min, xlim_max)
+                else:
+                    grid = build_bp_grid(xlim_min, xlim_max)
+                    x_list, y_list = [], []
+                    for key, local_calib_func in present:
+                        y_cleaned = self._clean_trace_hammock(loaded_data[key][sample_ch])
+                        with PERF.stage("Tamaño en pb"):
+                            x_list.append(local_calib_func(np.arange(len(y_cleaned))))
+                        y_list.append(y_cleaned)
+                    matrix = resample_to_bp_grid(x_list, y_list, grid)
+                sample_names = [Path(key).stem for key in keys]
+                color = CHANNEL_COLOR_MAP.get(sample_ch, 'purple')
+                display_name = CHANNEL_DISPLAY_NAME_MAP.get(sample_ch, sample_ch)
+                self._draw_overlay_channel(ax, overlay_mode, grid, matrix, sample_names, display_name, color)
+            if overlay_mode == OVERLAY_MODES[2]:
+                ax.axhline(0, color='grey', linewidth=0.8)
+                ax.set_ylabel("Δ RFU respecto a la referencia")
+            else:
+                ax.set_ylabel("RFU")
+            ax.grid(True, linestyle=':'); ax.legend(fontsize='small'); ax.set_xlim(xlim_min, xlim_max); ax.set_xlabel("Tamaño (pb)")
         else:
             # --- MODO NORMAL: GRÁFICOS APILADOS ---
             num_files = len(files_to_plot)
-            axs = self.fig.subplots(num_files, 1, sharex=True, squeeze=False).flatten()
+            axs = fig.subplots(num_files, 1, sharex=True, squeeze=False).flatten()
             for i, full_path in enumerate(files_to_plot):
-                ax = axs[i]
+                if generation != self._render_generation: return None
                 filename_key = Path(full_path).name
-                ax.set_title(filename_key, fontsize=10)
-                calib_data = self.app.calibrations.get(full_path)
-                if calib_data is None:
-                    ax.text(0.5, 0.5, "Calibración saltada", color='red', ha='center', transform=ax.transAxes); continue
-                local_calib_func, assigned_peaks = calib_data
-                if ladder_channel in self.app.loaded_data.get(filename_key, {}):
-                    y_ladder = self.app.loaded_data[filename_key][ladder_channel]
-                    x_scan_ladder = np.arange(len(y_ladder)); x_bp_ladder = local_calib_func(x_scan_ladder)
-                    ladder_display_name = CHANNEL_DISPLAY_NAME_MAP.get(ladder_channel, ladder_channel)
-                    ax.plot(x_bp_ladder, y_ladder, color='grey', alpha=0.4, linewidth=1, label=f'Marcador ({ladder_display_name})')
-                for sample_ch in selected_sample_channels:
-                    if sample_ch in self.app.loaded_data.get(filename_key, {}):
-                        y_sample_raw = self.app.loaded_data[filename_key][sample_ch]
-                        y_sample_cleaned = self._clean_trace_hammock(y_sample_raw)
-                        x_scan_sample = np.arange(len(y_sample_cleaned)); x_bp_sample = local_calib_func(x_scan_sample)
-                        color = CHANNEL_COLOR_MAP.get(sample_ch, 'purple')
-                        display_name = CHANNEL_DISPLAY_NAME_MAP.get(sample_ch, sample_ch)
-                        line, = ax.plot(x_bp_sample, y_sample_cleaned, color=color, label=display_name, linewidth=1.2)
-                        line.set_picker(5); line.full_data = (x_bp_sample, y_sample_cleaned)
-                if ladder_channel in self.app.loaded_data.get(filename_key, {}):
-                    y_ladder = self.app.loaded_data[filename_key][ladder_channel]
-                    for scan_point, bp_size in assigned_peaks.items():
-                        scan_point = int(scan_point)
-                        if scan_point < len(y_ladder):
-                            rfu = y_ladder[scan_point]
-                            ax.vlines(x=bp_size, ymin=0, ymax=rfu, color='red', linestyle='--', alpha=0.8)
-                            ax.text(bp_size, rfu, f' {int(bp_size)}', color='red', fontsize=8, ha='center', va='bottom')
-                ax.grid(True, linestyle=':'); ax.legend(fontsize='small'); ax.set_xlim(xlim_min, xlim_max); ax.set_ylabel("RFU")
+                sample_lines = draw_sample_axes(axs[i], filename_key, loaded_data.get(filename_key, {}), calibrations.get(full_path),
+                                                selected_sample_channels, job["ladder_channel"], (xlim_min, xlim_max))
+                axs[i].sample_path = full_path
+                for line in sample_lines:
+                    line.set_picker(5)
             if num_files > 0: axs[-1].set_xlabel("Tamaño (pb)")
+
+        # Picos: [(ruta, canal, tamaños, alturas)] para la tabla y sus marcadores en la figura
+        peaks, markers = [], []
+        if job["min_height"] is not None:
+            for ax_idx, ax in enumerate(fig.axes):
+                files_for_this_ax = files_to_plot if overlay_mode is not None else [files_to_plot[ax_idx]]
+                for full_path in files_for_this_ax:
+                    if generation != self._render_generation: return None
+                    filename_key = Path(full_path).name
+                    calib_data = calibrations.get(full_path)
+                    if not calib_data: continue
+                    channels_data = loaded_data.get(filename_key, {})
+                    for channel_name in selected_sample_channels:
+                        if channel_name not in channels_data: continue
+                        sizes_bp, heights_rfu = detect_sample_peaks(channels_data[channel_name], calib_data[0], job["min_height"], cache_key=(filename_key, channel_name))
+                        if len(sizes_bp) == 0: continue
+                        peaks.append((full_path, channel_name, sizes_bp, heights_rfu))
+                        color = CHANNEL_COLOR_MAP.get(channel_name, 'purple')
+                        marker = ax.plot(sizes_bp, heights_rfu, 'v', markersize=5, alpha=0.7, color=color)[0]
+                        marker.sample_path = full_path
+                        markers.append(marker)
         
-        self.fig.suptitle("Análisis de Fragmentos Multicanal", fontsize=16)
-        self.fig.tight_layout(rect=[0, 0, 1, 0.96])
-        self.canvas.draw()
+        fig.suptitle("Análisis de Fragmentos Multicanal", fontsize=16)
+        fig.tight_layout(rect=[0, 0, 1, 0.96])
+        if generation != self._render_generation: return None
+        with PERF.stage("Render Agg (segundo plano)"):
+            agg_canvas.draw()
+            # Copia de la imagen completa: se pega en el lienzo de Tk con restore_region
+            region = agg_canvas.copy_from_bbox(fig.bbox)
+        return fig, region, peaks, markers
+
+    def _poll_render(self):
+        """Sondeo en el hilo de Tk: muestra la figura en cuanto el hilo de trabajo la termina."""
+        self._render_after_id = None
+        if self._render_job is None:
+            return
+        generation, future, job = self._render_job
+        if not future.done():
+            self._render_after_id = self.after(RENDER_POLL_MS, self._poll_render); return
+        self._render_job = None
+        try:
+            rendered = future.result()
+        except Exception as e:
+            messagebox.showerror("Error", f"No se pudo dibujar la figura:\n{e}", parent=self); return
+        if rendered is None or generation != self._render_generation:
+            return
+        fig, region, peaks, markers = rendered
+        self._show_rendered_figure(fig, region)
+        self.peak_markers = markers
+        for full_path, channel_name, sizes_bp, heights_rfu in peaks:
+            self._insert_peak_rows(full_path, channel_name, sizes_bp, heights_rfu)
+
+    def _show_rendered_figure(self, fig, region):
+        """Sustituye la figura del lienzo por la ya renderizada y copia su imagen a la pantalla."""
+        self.app._clear_annotations()
+        size, dpi = self.fig.get_size_inches(), self.fig.dpi
+        self.fig = fig
+        fig.set_canvas(self.canvas)
+        self.canvas.figure = fig
+        # Las conexiones de eventos del lienzo se guardan en la figura: se rehacen para la nueva
+        self._connect_canvas_events()
+        if np.allclose(fig.get_size_inches(), size) and fig.dpi == dpi:
+            with PERF.stage("canvas.blit"):
+                self.canvas.get_renderer()
+                self.canvas.restore_region(region)
+                self.canvas.blit()
+        else:
+            # La ventana cambió de tamaño durante el render: se redibuja a la medida actual
+            fig.set_size_inches(size, forward=False)
+            fig.tight_layout(rect=[0, 0, 1, 0.96])
+            self.canvas.draw_idle()
+
+    def _connect_canvas_events(self):
+        """Conecta los eventos del visor y (re)crea la barra de navegación para la figura actual."""
+        from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
+        if self.toolbar is not None:
+            self.toolbar.destroy()
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.plot_frame, pack_toolbar=False)
+        self.toolbar.pack(side=tk.BOTTOM, fill=tk.X, before=self.hover_label)
+        self.canvas.mpl_connect('pick_event', self.app._on_plot_click)
+        self.canvas.mpl_connect('motion_notify_event', self._on_hover)
+# --- Barrido de Parámetros de Detección ---
+class ParameterSweepWindow(tk.Toplevel):
+    """
+    Ajuste de altura, prominencia y distancia mínimas del marcador con deslizadores. Los
+    candidatos de cada muestra se calculan una vez con la altura más baja del barrido y
+    cada movimiento solo los filtra, mostrando al momento cuántos picos quedan en todas
+    las muestras frente a los esperados del marcador seleccionado.
+    """
+
+    def __init__(self, wizard):
+        super().__init__(wizard)
+        self.wizard = wizard
+        self.app = wizard.app
+        self.title("Barrido de Parámetros de Detección")
+        self.geometry("620x520")
+        self.transient(wizard)
+
+        height = float(wizard.height_var.get()); prominence = float(wizard.prominence_var.get()); distance = int(wizard.distance_var.get())
+        self.expected = len(KNOWN_LADDERS.get(self.app.ladder_type_var.get(), []))
+
+        self.config(cursor="watch"); self.update_idletasks()
+        self.min_height = max(1.0, height / 4)
+        self.sweeps = []
+        ladder_ch = self.app.ladder_channel_var.get()
+        with PERF.stage("Barrido: candidatos"):
+            for index, full_path in enumerate(self.app.fsa_files):
+                filename_key = Path(full_path).name
+                key = wizard._precompute_key(index)
+                raw_data = self.app.loaded_data.get(filename_key, {}).get(ladder_ch)
+                if key is None or raw_data is None: continue
+                self.sweeps.append((filename_key, LadderPeakSweep(raw_data, key[2], self.min_height)))
+        self.config(cursor="")
+
+        sliders_frame = ttk.Frame(self, padding=(10, 10))
+        sliders_frame.pack(side=tk.TOP, fill=tk.X)
+        sliders_frame.columnconfigure(1, weight=1)
+        self.height_scale = self._add_slider(sliders_frame, 0, "Altura Mínima:", self.min_height, height * 4, height)
+        self.prominence_scale = self._add_slider(sliders_frame, 1, "Prominencia Mínima:", 0, max(prominence * 4, 1), prominence)
+        self.distance_scale = self._add_slider(sliders_frame, 2, "Distancia Mínima:", 1, max(distance * 4, 50), distance)
+
+        button_frame = ttk.Frame(self, padding=(10, 10))
+        button_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.summary_label = ttk.Label(button_frame)
+        self.summary_label.pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="Aplicar al Asistente", command=self._apply, style="Accent.TButton").pack(side=tk.RIGHT)
+
+        columns = ('file', 'found', 'expected', 'diff')
+        self.count_table = ttk.Treeview(self, columns=columns, show='headings')
+        self.count_table.heading('file', text='Muestra'); self.count_table.column('file', width=260)
+        self.count_table.heading('found', text='Picos'); self.count_table.column('found', width=80, anchor='e')
+        self.count_table.heading('expected', text='Esperados'); self.count_table.column('expected', width=80, anchor='e')
+        self.count_table.heading('diff', text='Diferencia'); self.count_table.column('diff', width=80, anchor='e')
+        self.count_table.tag_configure('ok', foreground='green')
+        self.count_table.tag_configure('off', foreground='red')
+        self.count_table.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10)
+        self._rows = [self.count_table.insert('', tk.END, values=(filename_key, "", self.expected, "")) for filename_key, _ in self.sweeps]
+        self._update_counts()
+
+    def _add_slider(self, frame, row, text, start, stop, value):
+        ttk.Label(frame, text=text).grid(row=row, column=0, padx=5, pady=3, sticky="w")
+        variable = tk.DoubleVar(value=min(max(value, start), stop))
+        ttk.Scale(frame, from_=start, to=stop, variable=variable, command=lambda _value: self._update_counts()).grid(row=row, column=1, padx=5, sticky="ew")
+        value_label = ttk.Label(frame, width=8, anchor='e')
+        value_label.grid(row=row, column=2, padx=5)
+        variable.value_label = value_label
+        return variable
+
+    def _current_params(self):
+        return self.height_scale.get(), self.prominence_scale.get(), int(round(self.distance_scale.get()))
+
+    def _update_counts(self):
+        height, prominence, distance = self._current_params()
+        self.height_scale.value_label.config(text=f"{height:.0f}")
+        self.prominence_scale.value_label.config(text=f"{prominence:.0f}")
+        self.distance_scale.value_label.config(text=f"{distance}")
+        matching = 0
+        with PERF.stage("Barrido de parámetros"):
+            for row_id, (filename_key, sweep) in zip(self._rows, self.sweeps):
+                found = len(sweep.select(height, prominence, distance))
+                matching += found == self.expected
+                self.count_table.item(row_id, values=(filename_key, found, self.expected, f"{found - self.expected:+d}"), tags=('ok' if found == self.expected else 'off',))
+        self.summary_label.config(text=f"{matching} de {len(self.sweeps)} muestras con {self.expected} picos.")
+
+    def _apply(self):
+        height, prominence, distance = self._current_params()
+        self.wizard.height_var.set(f"{height:.0f}")
+        self.wizard.prominence_var.set(f"{prominence:.0f}")
+        self.wizard.distance_var.set(str(distance))
+        self.destroy()
+        self.wizard.detect_peaks(silent=False)
+
+# --- Panel de Rendimiento ---
+class PerformanceWindow(tk.Toplevel):
+    """Muestra los tiempos acumulados por etapa y permite capturar cProfile y guardar un informe."""
+
+    def __init__(self, master):
+        super().__init__(master)
+        self.title("Rendimiento")
+        self.geometry("620x400")
+
+        columns = ('stage', 'calls', 'total', 'mean', 'max')
+        self.stats_table = ttk.Treeview(self, columns=columns, show='headings')
+        self.stats_table.heading('stage', text='Etapa'); self.stats_table.column('stage', width=180)
+        self.stats_table.heading('calls', text='Llamadas'); self.stats_table.column('calls', width=70, anchor='e')
+        self.stats_table.heading('total', text='Total (ms)'); self.stats_table.column('total', width=90, anchor='e')
+        self.stats_table.heading('mean', text='Media (ms)'); self.stats_table.column('mean', width=90, anchor='e')
+        self.stats_table.heading('max', text='Máx. (ms)'); self.stats_table.column('max', width=90, anchor='e')
+
+        button_frame = ttk.Frame(self, padding=(10, 10))
+        button_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.stats_table.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=(10, 0))
+
+        self.profile_var = tk.BooleanVar(value=PERF.profiling)
+        ttk.Checkbutton(button_frame, text="Capturar cProfile", variable=self.profile_var, command=self._toggle_profiling).pack(side=tk.LEFT)
+        ttk.Button(button_frame, text="Reiniciar", command=self._reset).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Guardar Informe...", command=self._dump).pack(side=tk.RIGHT)
+
+        self._refresh()
+
+    def _refresh(self):
+        """Se actualiza sola cada segundo mientras la ventana está abierta."""
+        if not self.winfo_exists():
+            return
+        self.stats_table.delete(*self.stats_table.get_children())
+        for name, calls, total, mean, longest in PERF.summary():
+            self.stats_table.insert('', tk.END, values=(name, calls, f"{total * 1000:.1f}", f"{mean * 1000:.2f}", f"{longest * 1000:.1f}"))
+        self.after(1000, self._refresh)
+
+    def _toggle_profiling(self):
+        if self.profile_var.get():
+            PERF.start_profiling()
+        else:
+            PERF.stop_profiling()
+
+    def _reset(self):
+        PERF.reset()
+        self.stats_table.delete(*self.stats_table.get_children())
+
+    def _dump(self):
+        filepath = filedialog.asksaveasfilename(title="Guardar Informe de Rendimiento", defaultextension=".json", filetypes=[("JSON files", "*.json")], parent=self)
+        if not filepath: return
+        if PERF.profiling:
+            PERF.stop_profiling(); PERF.start_profiling()
+        try:
+            PERF.dump(filepath)
+            messagebox.showinfo("Rendimiento", f"Informe guardado en:\n{filepath}", parent=self)
+        except Exception as e:
+            messagebox.showerror("Rendimiento", f"No se pudo guardar el informe:\n{e}", parent=self)
+
+# --- Consulta de Proyecto ---
+class ProjectQueryWindow(tk.Toplevel):
+    """Busca en la base de datos del proyecto las muestras con un pico en un tamaño y canal dados."""
+
+    def __init__(self, master, db_path):
+        super().__init__(master)
+        self.title(f"Consultar Proyecto - {Path(db_path).name}")
+        self.geometry("700x450")
+        self.db = ProjectDatabase(db_path)
+
+        query_frame = ttk.Frame(self, padding=(10, 10))
+        query_frame.pack(side=tk.TOP, fill=tk.X)
+        ttk.Label(query_frame, text="Canal:").pack(side=tk.LEFT)
+        self._channel_by_name = {CHANNEL_DISPLAY_NAME_MAP.get(ch, ch): ch for ch in SAMPLE_CHANNELS + LADDER_CHANNELS}
+        self.channel_var = tk.StringVar(value=CHANNEL_DISPLAY_NAME_MAP[SAMPLE_CHANNELS[0]])
+        ttk.Combobox(query_frame, textvariable=self.channel_var, values=list(self._channel_by_name), width=10).pack(side=tk.LEFT, padx=5)
+        ttk.Label(query_frame, text="Tamaño (pb):").pack(side=tk.LEFT, padx=(10, 0))
+        self.size_var = tk.StringVar(value="250")
+        ttk.Entry(query_frame, textvariable=self.size_var, width=8).pack(side=tk.LEFT, padx=5)
+        ttk.Label(query_frame, text="±").pack(side=tk.LEFT)
+        self.tolerance_var = tk.StringVar(value="1")
+        ttk.Entry(query_frame, textvariable=self.tolerance_var, width=5).pack(side=tk.LEFT, padx=5)
+        ttk.Button(query_frame, text="🔍 Buscar", command=self._run_query).pack(side=tk.LEFT, padx=10)
+
+        self.status_label = ttk.Label(self, padding=(10, 0))
+        self.status_label.pack(side=tk.BOTTOM, fill=tk.X, pady=(0, 10))
+
+        columns = ('run', 'file', 'channel', 'size', 'height')
+        self.result_table = ttk.Treeview(self, columns=columns, show='headings')
+        self.result_table.heading('run', text='Ejecución'); self.result_table.column('run', width=140)
+        self.result_table.heading('file', text='Archivo'); self.result_table.column('file', width=220)
+        self.result_table.heading('channel', text='Canal'); self.result_table.column('channel', width=70)
+        self.result_table.heading('size', text='Tamaño (pb)'); self.result_table.column('size', width=90, anchor='e')
+        self.result_table.heading('height', text='Altura (RFU)'); self.result_table.column('height', width=90, anchor='e')
+        self.result_table.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=(0, 5))
+
+        n_runs, n_samples, n_peaks = self.db.counts()
+        self.status_label.config(text=f"{n_runs} ejecuciones, {n_samples} muestras, {n_peaks} picos en el proyecto.")
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def _run_query(self):
+        channel_name = self.channel_var.get()
+        channel = self._channel_by_name.get(channel_name, channel_name)
+        try:
+            size_bp = float(self.size_var.get()); tolerance = float(self.tolerance_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "El tamaño y la tolerancia deben ser números.", parent=self); return
+        started = time.perf_counter()
+        rows = self.db.find_peaks(channel, size_bp, tolerance)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.result_table.delete(*self.result_table.get_children())
+        for run_name, filename, channel, size, height in rows:
+            self.result_table.insert('', tk.END, values=(run_name, filename, CHANNEL_DISPLAY_NAME_MAP.get(channel, channel), f"{size:.1f}", f"{height:.0f}"))
+        n_samples = len({(run_name, filename) for run_name, filename, *_ in rows})
+        self.status_label.config(text=f"{len(rows)} picos en {n_samples} muestras ({elapsed_ms:.1f} ms).")
+
+    def on_close(self):
+        self.db.close()
+        self.destroy()
+
+class SimilarityWindow(tk.Toplevel):
+    """Resultados de la búsqueda por similitud de huella de las muestras seleccionadas."""
+
+    def __init__(self, master, db_name, results, n_indexed, elapsed_ms):
+        super().__init__(master)
+        self.title(f"Muestras Similares - {db_name}")
+        self.geometry("700x450")
+
+        columns = ('query', 'run', 'file', 'score')
+        result_table = ttk.Treeview(self, columns=columns, show='headings')
+        result_table.heading('query', text='Muestra'); result_table.column('query', width=180)
+        result_table.heading('run', text='Ejecución'); result_table.column('run', width=140)
+        result_table.heading('file', text='Archivo'); result_table.column('file', width=180)
+        result_table.heading('score', text='Correlación'); result_table.column('score', width=90, anchor='e')
+        ttk.Label(self, text=f"{n_indexed} huellas comparadas en {elapsed_ms:.1f} ms.", padding=(10, 0)).pack(side=tk.BOTTOM, fill=tk.X, pady=(0, 10))
+        result_table.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        for query_name, matches in results.items():
+            for (run_name, filename), score in matches:
+                result_table.insert('', tk.END, values=(query_name, run_name, filename, f"{score:.3f}"))
+
+class ComparisonWindow(tk.Toplevel):
+    """
+    Comparación de la tanda con una muestra de referencia: matriz de picos de la referencia
+    frente a muestras para la métrica elegida (presencia, ratio, desplazamiento...).
+    """
+
+    def __init__(self, master, peak_results):
+        super().__init__(master)
+        self.title("Comparación con Referencia")
+        self.geometry("900x500")
+        self.peak_results = dict(peak_results)
+        self.comparison = None
+        names = [Path(path).name for path in self.peak_results]
+        self._paths_by_name = dict(zip(names, self.peak_results))
+
+        controls = ttk.Frame(self, padding=10)
+        controls.pack(side=tk.TOP, fill=tk.X)
+        ttk.Label(controls, text="Referencia:").pack(side=tk.LEFT)
+        self.reference_var = tk.StringVar(value=names[0])
+        reference_menu = ttk.Combobox(controls, textvariable=self.reference_var, values=names, state="readonly", width=28)
+        reference_menu.pack(side=tk.LEFT, padx=(2, 10))
+        ttk.Label(controls, text="Tolerancia (pb):").pack(side=tk.LEFT)
+        self.tolerance_var = tk.StringVar(value=str(COMPARISON_TOLERANCE_BP))
+        ttk.Entry(controls, textvariable=self.tolerance_var, width=6).pack(side=tk.LEFT, padx=(2, 10))
+        ttk.Label(controls, text="Métrica:").pack(side=tk.LEFT)
+        self.metric_var = tk.StringVar(value=COMPARISON_METRICS[0])
+        metric_menu = ttk.Combobox(controls, textvariable=self.metric_var, values=COMPARISON_METRICS, state="readonly", width=18)
+        metric_menu.pack(side=tk.LEFT, padx=(2, 10))
+        ttk.Button(controls, text="Comparar", command=self._compare, style="Accent.TButton").pack(side=tk.LEFT)
+        ttk.Button(controls, text="📊 Exportar a Excel", command=self._export).pack(side=tk.RIGHT)
+        reference_menu.bind("<<ComboboxSelected>>", lambda e: self._compare())
+        metric_menu.bind("<<ComboboxSelected>>", lambda e: self._show_matrix())
+
+        self.status_label = ttk.Label(self, padding=(10, 0))
+        self.status_label.pack(side=tk.BOTTOM, fill=tk.X, pady=(0, 10))
+        table_frame = ttk.Frame(self)
+        table_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True, padx=10, pady=(0, 10))
+        self.matrix_table = ttk.Treeview(table_frame, show='headings')
+        y_scroll = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.matrix_table.yview)
+        x_scroll = ttk.Scrollbar(table_frame, orient=tk.HORIZONTAL, command=self.matrix_table.xview)
+        self.matrix_table.configure(yscrollcommand=y_scroll.set, xscrollcommand=x_scroll.set)
+        self.matrix_table.grid(row=0, column=0, sticky='nsew')
+        y_scroll.grid(row=0, column=1, sticky='ns'); x_scroll.grid(row=1, column=0, sticky='ew')
+        table_frame.grid_rowconfigure(0, weight=1); table_frame.grid_columnconfigure(0, weight=1)
+        self.matrix_table.tag_configure('absent', foreground='red')
+        self._compare()
+
+    def _compare(self):
+        try:
+            tolerance = float(self.tolerance_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "La tolerancia debe ser un número.", parent=self); return
+        t0 = time.perf_counter()
+        self.comparison = compare_peaks(self._paths_by_name[self.reference_var.get()], self.peak_results, tolerance)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        n_extra = sum(len(peaks) for peaks in self.comparison.unmatched.values())
+        self.status_label.config(text=f"{len(self.comparison.peaks)} picos de referencia x {len(self.comparison.samples)} muestras "
+                                      f"comparados en {elapsed_ms:.1f} ms. Picos sin pareja en la referencia: {n_extra}.")
+        self._show_matrix()
+
+    def _show_matrix(self):
+        if self.comparison is None:
+            return
+        headers, rows = self.comparison.table(self.metric_var.get())
+        presence = self.comparison.metric("Presencia")
+        columns = [f"c{i}" for i in range(len(headers))]
+        self.matrix_table.delete(*self.matrix_table.get_children())
+        self.matrix_table['columns'] = columns
+        for i, (column, header) in enumerate(zip(columns, headers)):
+            self.matrix_table.heading(column, text=header)
+            self.matrix_table.column(column, width=110 if i >= 3 else 90, anchor='e' if i else 'w', stretch=False)
+        for values, present in zip(rows, presence):
+            self.matrix_table.insert('', tk.END, values=values, tags=() if present.all() else ('absent',))
+
+    def _export(self):
+        if self.comparison is None:
+            return
+        filepath = filedialog.asksaveasfilename(title="Guardar Comparación", defaultextension=".xlsx", filetypes=[("Archivos de Excel", "*.xlsx")], parent=self)
+        if not filepath: return
+        params = {
+            "Muestra de Referencia": Path(self.comparison.reference_name).name,
+            "Tolerancia (pb)": self.tolerance_var.get(),
+            "Muestras Comparadas": len(self.comparison.samples),
+            "Fecha de Análisis": np.datetime_as_string(np.datetime64('now', 's'), unit='s'),
+        }
+        try:
+            write_comparison_workbook(filepath, self.comparison, params)
+            messagebox.showinfo("Éxito", f"Comparación exportada a:\n{filepath}", parent=self)
+        except Exception as e:
+            messagebox.showerror("Error de Exportación", f"No se pudo guardar el archivo de Excel:\n{e}", parent=self)
+
 # --- Ventana de la Calculadora de Fórmulas ---
 # --- Ventana de la Calculadora de Fórmulas ---
 class FormulaCalculator(tk.Toplevel):
@@ -872,12 +3575,29 @@ class AnalizadorFSA:
         self.loaded_data = {}
         self.calibrations = {}
         self.calibration_template = None
+        self.data_start_scans = {}
+        # Metadatos ABIF por archivo ({nombre: {"sample", "well", "capillary"}}) y deriva del marcador
+        self.sample_metadata = {}
+        self.drift_model = None
+        # Índice de metadatos y archivos mostrados en la lista, en su orden actual
+        self.sample_index = SampleIndex()
+        self._listed_files = []
+        self.bp_store = None
+        self.detection_params = dict(DEFAULT_DETECTION_PARAMS)
         self.setup_styles()
         self.create_widgets()
         self._create_menubar() # <-- AÑADE ESTA LÍNEA AL FINAL
         self.plot_annotations = {} # <-- AÑADE ESTA LÍNEA
         self.plot_viewer = None
         self.calculator = None # <-- AÑADE ESTA LÍNEA 
+        self.performance_window = None
+        self.project_db_path = None
+        self.folder_watcher = None
+        self._watch_executor = None
+        self._watch_jobs = []
+        self._watch_after_id = None
+        # Errores del modo de vigilancia (no hay consola en la aplicación empaquetada)
+        self._watch_errors = []
 
     # En la clase AnalizadorFSA, reemplaza esta función:
 
@@ -932,6 +3652,24 @@ class AnalizadorFSA:
         selection_frame = ttk.LabelFrame(main_frame, text="3. Selección de Muestras a Visualizar")
         selection_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=10)
         
+        # Filtro, orden y grupos sobre el índice de metadatos (pocillo, capilar, placa, fecha...)
+        index_frame = ttk.Frame(selection_frame)
+        index_frame.pack(side=tk.TOP, fill=tk.X, padx=5, pady=(5, 0))
+        ttk.Label(index_frame, text="Filtro:", font=self.label_font).pack(side=tk.LEFT)
+        self.file_filter_var = tk.StringVar()
+        self.file_filter_var.trace_add("write", lambda *_: self._refresh_file_list())
+        ttk.Entry(index_frame, textvariable=self.file_filter_var, width=14).pack(side=tk.LEFT, padx=(2, 10))
+        ttk.Label(index_frame, text="Ordenar por:", font=self.label_font).pack(side=tk.LEFT)
+        self.file_sort_var = tk.StringVar(value=SAMPLE_INDEX_COLUMNS["file"])
+        sort_menu = ttk.Combobox(index_frame, textvariable=self.file_sort_var, values=list(SAMPLE_INDEX_COLUMNS.values()), state="readonly", width=16)
+        sort_menu.pack(side=tk.LEFT, padx=(2, 10))
+        sort_menu.bind("<<ComboboxSelected>>", lambda e: self._refresh_file_list())
+        ttk.Label(index_frame, text="Grupo:", font=self.label_font).pack(side=tk.LEFT)
+        self.file_group_var = tk.StringVar()
+        self.file_group_menu = ttk.Combobox(index_frame, textvariable=self.file_group_var, state="readonly", width=14)
+        self.file_group_menu.pack(side=tk.LEFT, padx=2)
+        self.file_group_menu.bind("<<ComboboxSelected>>", lambda e: self._select_file_group())
+
         self.file_listbox = tk.Listbox(selection_frame, selectmode=tk.EXTENDED, height=6, font=self.label_font)
         self.file_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, pady=5, padx=5)
 
@@ -971,7 +3709,29 @@ class AnalizadorFSA:
         file_menu.add_command(label="Guardar Sesión...", command=self._save_session)
         file_menu.add_command(label="Cargar Sesión...", command=self._load_session)
         file_menu.add_separator()
+        file_menu.add_command(label="Vigilar Carpeta...", command=self.start_folder_watch)
+        file_menu.add_command(label="Detener Vigilancia", command=self.stop_folder_watch)
+        file_menu.add_separator()
         file_menu.add_command(label="Salir", command=self.master.quit)
+
+        analysis_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Análisis", menu=analysis_menu)
+        analysis_menu.add_command(label="Generar Almacén de Trazas en pb...", command=self._build_bp_store)
+        analysis_menu.add_command(label="Abrir Almacén de Trazas...", command=self._open_bp_store)
+        analysis_menu.add_separator()
+        analysis_menu.add_command(label="Buscar Muestras Similares...", command=self._find_similar_samples)
+        analysis_menu.add_command(label="Generar Informe (PDF/PNG)...", command=self._generate_report)
+        analysis_menu.add_command(label="Procesar Lote en Streaming...", command=self._stream_batch)
+
+        tools_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="Herramientas", menu=tools_menu)
+        self.profile_var = tk.StringVar(value=ACTIVE_PROFILE["name"])
+        self.profile_menu = tk.Menu(tools_menu, tearoff=0)
+        tools_menu.add_cascade(label="Perfil de Instrumento", menu=self.profile_menu)
+        self._refresh_profile_menu()
+        tools_menu.add_separator()
+        tools_menu.add_command(label="Consultar Proyecto...", command=self._open_project_query)
+        tools_menu.add_command(label="Rendimiento", command=self._show_performance)
         
 
    
@@ -999,7 +3759,8 @@ class AnalizadorFSA:
         if not hasattr(artist, 'full_data'):
             return
 
-        x_data, y_data = artist.full_data
+        peak_index = TracePeakIndex.for_artist(artist)
+        x_data, y_data = peak_index.x, peak_index.y
         ax = artist.axes
         
         # Limpiamos la etiqueta anterior de este subplot
@@ -1007,17 +3768,11 @@ class AnalizadorFSA:
             for annotation in self.plot_annotations[ax]:
                 annotation.remove()
         
-        # --- Lógica de búsqueda de pico (sin cambios) ---
+        # --- Búsqueda del pico: máximo local más alto alrededor del clic ---
         mouse_x = event.mouseevent.xdata
         if mouse_x is None: return # Evita errores si el clic es fuera del área de datos
         
-        closest_index = np.argmin(np.abs(x_data - mouse_x))
-        search_radius = 20
-        start = max(0, closest_index - search_radius)
-        end = min(len(y_data), closest_index + search_radius)
-        
-        peak_index_in_slice = np.argmax(y_data[start:end])
-        true_peak_index = start + peak_index_in_slice
+        true_peak_index = peak_index.snap(mouse_x, search_radius=20)
 
         x_coord = x_data[true_peak_index]
         y_coord = y_data[true_peak_index]
@@ -1052,6 +3807,211 @@ class AnalizadorFSA:
         # Actualizamos el lienzo para que se vea la nueva etiqueta
         artist.get_figure().canvas.draw_idle()
 
+    def _show_performance(self):
+        if self.performance_window is None or not self.performance_window.winfo_exists():
+            self.performance_window = PerformanceWindow(self.master)
+        else:
+            self.performance_window.lift()
+
+    def _refresh_profile_menu(self):
+        self.profile_menu.delete(0, tk.END)
+        for name in INSTRUMENT_PROFILES:
+            self.profile_menu.add_radiobutton(label=name, value=name, variable=self.profile_var, command=lambda n=name: self.select_instrument_profile(n))
+        self.profile_menu.add_separator()
+        self.profile_menu.add_command(label="Cargar Perfil...", command=self._load_instrument_profile)
+
+    def _load_instrument_profile(self):
+        filepath = filedialog.askopenfilename(title="Cargar Perfil de Instrumento", filetypes=[("JSON files", "*.json")], parent=self.master)
+        if not filepath: return
+        try:
+            name, profile = load_instrument_profile(filepath)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Perfil de Instrumento", f"No se pudo cargar el perfil:\n{e}", parent=self.master); return
+        INSTRUMENT_PROFILES[name] = profile
+        self._refresh_profile_menu()
+        self.select_instrument_profile(name)
+
+    def select_instrument_profile(self, name):
+        """Activa un perfil y, si hay archivos cargados, los vuelve a leer con sus canales."""
+        profile = INSTRUMENT_PROFILES[name]
+        apply_instrument_profile(name, profile)
+        self.profile_var.set(name)
+        if profile.get("ladder_type") in KNOWN_LADDERS:
+            self.ladder_type_var.set(profile["ladder_type"])
+        if profile.get("start_scan") is not None:
+            self.detection_params["ignore_scans"] = str(profile["start_scan"])
+        if self.fsa_files and not isinstance(self.loaded_data, SessionTraceArchive):
+            self.process_files()
+            self.update_ui_state()
+
+    def ask_project_path(self, parent=None):
+        """Pregunta por la base de datos del proyecto (nueva o existente) y la recuerda para la sesión."""
+        filepath = filedialog.asksaveasfilename(title="Base de Datos del Proyecto", defaultextension=".sqlite",
+                                                filetypes=[("Proyecto PeakPro", "*.sqlite")], confirmoverwrite=False,
+                                                initialfile=Path(self.project_db_path).name if self.project_db_path else "",
+                                                parent=parent or self.master)
+        if filepath:
+            self.project_db_path = filepath
+        return filepath
+
+    def _open_project_query(self):
+        filepath = filedialog.askopenfilename(title="Abrir Base de Datos del Proyecto", filetypes=[("Proyecto PeakPro", "*.sqlite")], parent=self.master)
+        if not filepath: return
+        self.project_db_path = filepath
+        try:
+            ProjectQueryWindow(self.master, filepath)
+        except sqlite3.Error as e:
+            messagebox.showerror("Proyecto", f"No se pudo abrir la base de datos:\n{e}", parent=self.master)
+
+    def _generate_report(self):
+        """Informe estático de las muestras seleccionadas, generado en segundo plano sin el visor."""
+        selected = self.selected_files()
+        if not selected:
+            messagebox.showwarning("Informe", "Selecciona al menos una muestra.", parent=self.master); return
+        filepath = filedialog.asksaveasfilename(title="Guardar Informe", defaultextension=".pdf",
+                                                filetypes=[("PDF (una página por muestra)", "*.pdf"), ("PNG (un archivo por muestra)", "*.png")], parent=self.master)
+        if not filepath: return
+        try:
+            xlim = (float(self.xlim_min_var.get()), float(self.xlim_max_var.get()))
+            min_height = float(self.detection_params["peak_height"])
+        except ValueError:
+            messagebox.showerror("Error", "Parámetros de visualización inválidos.", parent=self.master); return
+        sample_channels = [self.sample_channel_listbox.get(i) for i in self.sample_channel_listbox.curselection()] or list(self.sample_channel_listbox.get(0, tk.END))
+        ladder_channel = self.ladder_channel_var.get()
+        jobs = []
+        for full_path in selected:
+            filename_key = Path(full_path).name
+            calib_data = self.calibrations.get(full_path)
+            jobs.append((filename_key, dict(self.loaded_data.get(filename_key, {})), dict(calib_data[1]) if calib_data else None,
+                         sample_channels, ladder_channel, xlim, min_height))
+
+        self._run_with_progress("Generando Informe", len(jobs), "páginas",
+                                lambda progress: build_report(filepath, jobs, progress=lambda page, total: progress(page)),
+                                lambda pages: messagebox.showinfo("Informe", f"Informe de {pages} páginas guardado en:\n{filepath}", parent=self.master))
+
+    def _run_with_progress(self, title, total, unit, task, on_success):
+        """
+        Ejecuta task(progress) en un hilo de trabajo con una ventana de progreso. El hilo solo
+        actualiza un contador; la ventana lo lee con 'after', así Tk no se toca desde fuera.
+        """
+        progress_window = tk.Toplevel(self.master)
+        progress_window.title(title)
+        progress_window.transient(self.master)
+        progress_label = ttk.Label(progress_window, text=f"0 de {total} {unit}", padding=(10, 10))
+        progress_label.pack()
+        progress_bar = ttk.Progressbar(progress_window, maximum=total, length=300)
+        progress_bar.pack(padx=10, pady=(0, 10))
+        done = [0]
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(task, lambda count: done.__setitem__(0, count))
+        executor.shutdown(wait=False)
+
+        def poll():
+            progress_bar['value'] = done[0]
+            progress_label.config(text=f"{done[0]} de {total} {unit}")
+            if not future.done():
+                progress_window.after(200, poll); return
+            progress_window.destroy()
+            try:
+                result = future.result()
+            except Exception as e:
+                messagebox.showerror(title, f"No se pudo completar la operación:\n{e}", parent=self.master)
+                return
+            on_success(result)
+        poll()
+
+    def _stream_batch(self):
+        """Procesa miles de archivos por bloques, con memoria acotada, directamente a CSV (y al proyecto)."""
+        if not self.calibration_template:
+            messagebox.showwarning("Lote en Streaming", "Carga o crea primero una plantilla de calibración.", parent=self.master); return
+        ladder_channel = self.ladder_channel_var.get() or LADDER_CHANNELS[0]
+        paths = filedialog.askopenfilenames(title="Selecciona los archivos del lote", filetypes=[("FSA files", "*.fsa")], parent=self.master)
+        if not paths: return
+        csv_path = filedialog.asksaveasfilename(title="Guardar Picos del Lote", defaultextension=".csv", filetypes=[("CSV", "*.csv")], parent=self.master)
+        if not csv_path: return
+        db_path = None
+        if messagebox.askyesno("Lote en Streaming", "¿Guardar también el lote en la base de datos del proyecto?", parent=self.master):
+            db_path = self.ask_project_path()
+        try:
+            min_height = float(self.detection_params["peak_height"])
+        except ValueError:
+            min_height = float(DEFAULT_DETECTION_PARAMS["peak_height"])
+        template = dict(self.calibration_template); params = dict(self.detection_params)
+        sample_channels = list(SAMPLE_CHANNELS); ladder_type = self.ladder_type_var.get()
+        run_name = Path(paths[0]).parent.name
+
+        def task(progress):
+            # Las huellas solo se calculan si el lote va al proyecto, donde las usa la búsqueda por similitud
+            results = stream_batch(paths, template, params, ladder_channel, sample_channels, min_height, fingerprints=db_path is not None)
+            return export_stream(results, csv_path, db_path, run_name, ladder_type, ladder_channel, params, progress)
+
+        def done(summary):
+            message = f"{summary['files']} archivos, {summary['calibrated']} calibrados, {summary['peaks']} picos.\n\nGuardado en:\n{csv_path}"
+            if summary["errors"]:
+                message += "\n\nNo se pudieron leer:\n" + "\n".join(summary["errors"][:20])
+            messagebox.showinfo("Lote en Streaming", message, parent=self.master)
+        self._run_with_progress("Procesando Lote", len(paths), "archivos", task, done)
+
+    def _find_similar_samples(self):
+        """Compara la huella de las muestras seleccionadas con todas las guardadas en el proyecto."""
+        selected = [f for f in self.selected_files() if self.calibrations.get(f)]
+        if not selected:
+            messagebox.showwarning("Muestras Similares", "Selecciona al menos una muestra calibrada.", parent=self.master); return
+        filepath = self.project_db_path or filedialog.askopenfilename(title="Abrir Base de Datos del Proyecto", filetypes=[("Proyecto PeakPro", "*.sqlite")], parent=self.master)
+        if not filepath: return
+        self.project_db_path = filepath
+        # Solo se comparan huellas calculadas con los canales del perfil activo
+        fingerprint_channels = list(SAMPLE_CHANNELS)
+        try:
+            with ProjectDatabase(filepath) as db:
+                index = db.load_fingerprints(fingerprint_channels)
+        except sqlite3.Error as e:
+            messagebox.showerror("Muestras Similares", f"No se pudo leer la base de datos:\n{e}", parent=self.master); return
+        if not len(index):
+            messagebox.showinfo("Muestras Similares", "El proyecto todavía no tiene huellas guardadas con los canales del perfil activo.", parent=self.master); return
+
+        started = time.perf_counter()
+        results = {}
+        for full_path in selected:
+            fingerprint = compute_fingerprint(self.loaded_data.get(Path(full_path).name, {}), self.calibrations[full_path][0], fingerprint_channels)
+            results[Path(full_path).name] = index.search(fingerprint, top_k=10)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        SimilarityWindow(self.master, Path(filepath).name, results, len(index), elapsed_ms)
+
+    def _build_bp_store(self):
+        """Remuestrea todas las muestras calibradas sobre la rejilla común de pb."""
+        if not any(cal is not None for cal in self.calibrations.values()):
+            messagebox.showwarning("Almacén de Trazas", "No hay muestras calibradas.", parent=self.master)
+            return
+        on_disk = messagebox.askyesnocancel("Almacén de Trazas", "¿Guardar el almacén en disco (mapeado en memoria)?\n\nNo = mantenerlo solo en memoria.", parent=self.master)
+        if on_disk is None:
+            return
+        filepath = None
+        if on_disk:
+            filepath = filedialog.asksaveasfilename(title="Guardar Almacén de Trazas", defaultextension=".npy", filetypes=[("Almacén de Trazas", "*.npy")])
+            if not filepath: return
+
+        channels = list(self.sample_channel_listbox.get(0, tk.END))
+        ladder_ch = self.ladder_channel_var.get()
+        if ladder_ch and ladder_ch not in channels: channels.append(ladder_ch)
+        grid = build_bp_grid(0, max(KNOWN_LADDERS[self.ladder_type_var.get()]) + 50)
+        try:
+            self.bp_store = BpTraceStore.build(self.fsa_files, self.loaded_data, self.calibrations, channels, grid, path=filepath)
+        except Exception as e:
+            messagebox.showerror("Almacén de Trazas", f"No se pudo generar el almacén:\n{e}", parent=self.master)
+            return
+        n_samples, n_channels, n_points = self.bp_store.data.shape
+        messagebox.showinfo("Almacén de Trazas", f"Almacén generado: {n_samples} muestras x {n_channels} canales x {n_points} puntos.", parent=self.master)
+
+    def _open_bp_store(self):
+        filepath = filedialog.askopenfilename(title="Abrir Almacén de Trazas", filetypes=[("Almacén de Trazas", "*.npy")])
+        if not filepath: return
+        try:
+            self.bp_store = BpTraceStore.open(filepath)
+        except Exception as e:
+            messagebox.showerror("Almacén de Trazas", f"No se pudo abrir el almacén:\n{e}", parent=self.master)
+
     def _save_session(self):
         """Guarda el estado actual de la calibración en un archivo."""
         if not self.calibrations:
@@ -1060,12 +4020,31 @@ class AnalizadorFSA:
 
         filepath = filedialog.asksaveasfilename(
             title="Guardar Sesión de Análisis",
-            defaultextension=".pkl",
-            filetypes=[("Archivos de Sesión de Análisis", "*.pkl")]
+            defaultextension=".ppz",
+            filetypes=[("Sesión PeakPro con datos", "*.ppz"), ("Archivos de Sesión de Análisis", "*.pkl")]
         )
         if not filepath:
             return
 
+        if Path(filepath).suffix.lower() != ".pkl":
+            # Formato autocontenido: las trazas viajan dentro de la sesión
+            settings = {
+                "ladder_channel": self.ladder_channel_var.get(),
+                "ladder_type": self.ladder_type_var.get(),
+                "channels": sorted({ch for channels in self.loaded_data.values() for ch in channels}),
+                "template": {str(k): int(v) for k, v in self.calibration_template.items()} if self.calibration_template else None,
+                "data_start_scans": self.data_start_scans,
+                "sample_metadata": self.sample_metadata,
+                "detection_params": self.detection_params,
+                "instrument_profile": dict(ACTIVE_PROFILE),
+            }
+            try:
+                save_session_archive(filepath, self.fsa_files, self.loaded_data, self.calibrations, settings)
+                messagebox.showinfo("Guardar Sesión", "La sesión se ha guardado correctamente.", parent=self.master)
+            except Exception as e:
+                messagebox.showerror("Error al Guardar", f"No se pudo guardar la sesión:\n{e}", parent=self.master)
+            return
+
         # Preparamos los datos que queremos guardar
         session_data = {
             "fsa_files": self.fsa_files,
@@ -1089,11 +4068,15 @@ class AnalizadorFSA:
         """Carga un estado de calibración desde un archivo."""
         filepath = filedialog.askopenfilename(
             title="Cargar Sesión de Análisis",
-            filetypes=[("Archivos de Sesión de Análisis", "*.pkl")]
+            filetypes=[("Sesiones de Análisis", "*.ppz *.pkl"), ("Sesión PeakPro con datos", "*.ppz"), ("Archivos de Sesión de Análisis", "*.pkl")]
         )
         if not filepath:
             return
 
+        if Path(filepath).suffix.lower() != ".pkl":
+            self._load_session_archive(filepath)
+            return
+
         try:
             with open(filepath, 'rb') as f:
                 session_data = pickle.load(f)
@@ -1141,6 +4124,47 @@ class AnalizadorFSA:
         except Exception as e:
             messagebox.showerror("Error al Cargar", f"No se pudo cargar la sesión:\n{e}", parent=self.master)
 
+    def _load_session_archive(self, filepath):
+        """Abre una sesión autocontenida: la lista aparece al momento y las trazas se leen bajo demanda."""
+        try:
+            manifest = read_session_manifest(filepath)
+            loaded_data = SessionTraceArchive(filepath, manifest.get("traces", []))
+        except Exception as e:
+            messagebox.showerror("Error al Cargar", f"No se pudo cargar la sesión:\n{e}", parent=self.master)
+            return
+
+        profile = manifest.get("instrument_profile")
+        if profile:
+            name = profile.pop("name", DEFAULT_INSTRUMENT_PROFILE)
+            INSTRUMENT_PROFILES.setdefault(name, profile)
+            apply_instrument_profile(name, profile)
+            self.profile_var.set(name); self._refresh_profile_menu()
+        self.fsa_files = manifest.get("fsa_files", [])
+        self.calibrations = manifest["calibrations"]
+        self.loaded_data = loaded_data
+        self.bp_store = None
+        PEAK_CACHE.clear()
+        self.data_start_scans = manifest.get("data_start_scans", {})
+        self.sample_metadata = manifest.get("sample_metadata", {})
+        self.drift_model = None
+        self.detection_params.update(manifest.get("detection_params", {}))
+        template = manifest.get("template")
+        self.calibration_template = {float(k): int(v) for k, v in template.items()} if template else None
+
+        self._rebuild_sample_index()
+
+        self._populate_channel_lists(set(manifest.get("channels", [])))
+        self.ladder_channel_var.set(manifest.get("ladder_channel", self.ladder_channel_var.get()))
+        self.ladder_type_var.set(manifest.get("ladder_type", list(KNOWN_LADDERS.keys())[0]))
+
+        self.fsa_file_label.config(text=f"{len(self.fsa_files)} archivos cargados desde sesión")
+        if self.calibration_template:
+            self.template_status_label.config(text="Plantilla: Cargada desde sesión", foreground="blue")
+        self.update_ui_state()
+        calibrated_count = sum(1 for cal in self.calibrations.values() if cal is not None)
+        self.calibration_status_label.config(text=f"Estado: {calibrated_count} calibraciones cargadas", foreground="green")
+        loaded_data.prefetch()
+
     def load_template(self):
         filepath = filedialog.askopenfilename(title="Cargar Plantilla de Calibración", filetypes=[("JSON files", "*.json"), ("All files", "*.*")])
         if not filepath: return
@@ -1169,8 +4193,15 @@ class AnalizadorFSA:
         if not self.ladder_channel_var.get(): messagebox.showerror("Error", "Debes seleccionar un canal de marcador válido."); return
         CalibrationWizard(self.master, self, template=self.calibration_template)
 
-    def finish_calibration(self, calibrations, new_template):
+    def finish_calibration(self, calibrations, new_template, drift_model=None):
+        changed = [path for path, cal in calibrations.items()
+                   if (cal and cal[1]) != (self.calibrations.get(path) and self.calibrations[path][1])]
         self.calibrations = calibrations
+        self.drift_model = drift_model
+        if changed and self.plot_viewer and self.plot_viewer.winfo_exists():
+            # El visor abierto solo actualiza los ejes en pb de las muestras recalibradas
+            self.plot_viewer.refresh_calibrations(changed)
+        self.bp_store = None
         if new_template:
             self.calibration_template = new_template
             self.template_status_label.config(text="Plantilla: Lista para guardar", foreground="green")
@@ -1182,20 +4213,124 @@ class AnalizadorFSA:
         
     def select_fsa_files(self):
         self.fsa_files = filedialog.askopenfilenames(title="Selecciona archivos .fsa", filetypes=[("FSA files", "*.fsa")])
-        # --- AÑADIR ESTE BLOQUE ---
-        self.file_listbox.delete(0, tk.END) # Limpiamos la lista por si había algo antes
-        if self.fsa_files:
-            for fsa_file_path in self.fsa_files:
-                # Mostramos solo el nombre del archivo, no toda la ruta
-                self.file_listbox.insert(tk.END, Path(fsa_file_path).name)
-            self.file_listbox.select_set(0, tk.END) # Por defecto, seleccionamos todos
-        # --- FIN DEL BLOQUE A AÑADIR ---
         if not self.fsa_files:
             self.fsa_file_label.config(text="0 archivos seleccionados"); self.loaded_data = {}; self.calibrations = {}; self.calibration_template = None
+            self.sample_metadata = {}; self._rebuild_sample_index()
         else:
             self.fsa_file_label.config(text=f"{len(self.fsa_files)} archivos seleccionados"); self.process_files()
         self.update_ui_state()
 
+    def start_folder_watch(self):
+        """Empieza a incorporar los .fsa que el secuenciador vaya escribiendo en una carpeta."""
+        folder = filedialog.askdirectory(title="Selecciona la carpeta de la ejecución")
+        if not folder: return
+        self.stop_folder_watch()
+        if not self.calibration_template:
+            messagebox.showwarning("Vigilar Carpeta", "No hay plantilla de calibración: los archivos se cargarán pero no se calibrarán automáticamente.", parent=self.master)
+        self.fsa_files = list(self.fsa_files)
+        if self.drift_model is None and self.calibration_template:
+            self.drift_model = DriftModel(self.calibration_template)
+        self.folder_watcher = FolderWatcher(folder, known_paths=self.fsa_files)
+        self._watch_executor = ThreadPoolExecutor(max_workers=1)
+        self._watch_errors = []
+        self._watch_tick()
+
+    def stop_folder_watch(self):
+        if self._watch_after_id is not None:
+            self.master.after_cancel(self._watch_after_id)
+            self._watch_after_id = None
+        if self._watch_executor is not None:
+            for _, future in self._watch_jobs:
+                future.cancel()
+            self._watch_executor.shutdown(wait=False)
+            self._watch_executor = None
+        self._watch_jobs = []
+        if self.folder_watcher is not None:
+            self.folder_watcher = None
+            self.fsa_file_label.config(text=f"{len(self.fsa_files)} archivos seleccionados", foreground="")
+            if self._watch_errors:
+                listed = "\n".join(self._watch_errors[-10:])
+                more = f"\n... y {len(self._watch_errors) - 10} más" if len(self._watch_errors) > 10 else ""
+                messagebox.showwarning("Vigilar Carpeta", f"Errores durante la vigilancia de la carpeta:\n\n{listed}{more}", parent=self.master)
+            self._watch_errors = []
+
+    def _watch_tick(self):
+        """Sondeo periódico en el hilo de Tk: encola los archivos nuevos e incorpora los ya procesados."""
+        if self.folder_watcher is None:
+            return
+        try:
+            new_paths = self.folder_watcher.poll()
+        except OSError as e:
+            self._watch_errors.append(f"Error al leer la carpeta vigilada: {e}")
+            new_paths = []
+        ladder_channel = self.ladder_channel_var.get() or LADDER_CHANNELS[0]
+        template = dict(self.calibration_template) if self.calibration_template else None
+        params = dict(self.detection_params)
+        # Copia para el hilo de trabajo: el modelo sigue aprendiendo aquí con cada archivo incorporado
+        drift_model = self.drift_model.copy() if self.drift_model is not None and template else None
+        for path in new_paths:
+            self._watch_jobs.append((path, self._watch_executor.submit(load_and_calibrate, path, ladder_channel, template, params, profile_channels(), drift_model)))
+
+        pending = []
+        for path, future in self._watch_jobs:
+            if not future.done():
+                pending.append((path, future)); continue
+            try:
+                self._ingest_watched_file(path, *future.result())
+            except Exception as e:
+                self._watch_errors.append(f"No se pudo incorporar {Path(path).name}: {e}")
+        self._watch_jobs = pending
+
+        in_progress = f", {len(pending)} en proceso" if pending else ""
+        # Los errores quedan a la vista en la etiqueta de estado; el detalle se muestra al detener la vigilancia
+        errors = f" - ⚠ {len(self._watch_errors)} errores (último: {self._watch_errors[-1]})" if self._watch_errors else ""
+        self.fsa_file_label.config(text=f"{len(self.fsa_files)} archivos - vigilando {Path(self.folder_watcher.folder).name}{in_progress}{errors}",
+                                   foreground="red" if self._watch_errors else "")
+        self._watch_after_id = self.master.after(WATCH_POLL_MS, self._watch_tick)
+
+    def _ingest_watched_file(self, path, channels, metadata, start_scan, calibration):
+        """
+        Añade un archivo ya procesado a la lista, los datos, las calibraciones y la tabla de picos.
+        Si ya estaba en la lista (reescrito en la carpeta), sustituye lo que se tenía de él.
+        """
+        if not isinstance(self.loaded_data, dict):
+            self.loaded_data = dict(self.loaded_data)
+        filename = Path(path).name
+        known = {os.path.normcase(os.path.abspath(f)): f for f in self.fsa_files}
+        full_path = known.get(os.path.normcase(os.path.abspath(path)), path)
+        if full_path not in known.values():
+            self.fsa_files.append(full_path)
+            self.sample_index.append(full_path, metadata)
+            self._refresh_file_list(also_select=[full_path])
+        else:
+            self.sample_index.update(full_path, metadata)
+            self._refresh_file_list()
+
+        new_channels = set(channels) - set(self.sample_channel_listbox.get(0, tk.END)) - set(self.ladder_channel_menu['values'])
+        self.loaded_data[filename] = channels
+        self.data_start_scans[filename] = start_scan
+        self.sample_metadata[filename] = metadata
+        PEAK_CACHE.invalidate(filename)
+        self.calibrations[full_path] = calibration
+        if self.drift_model is not None:
+            # Un archivo reescrito sustituye su ajuste anterior en lugar de contar dos veces
+            if calibration is not None:
+                self.drift_model.observe(metadata.get("capillary"), calibration[1], key=full_path)
+            else:
+                self.drift_model.forget(full_path)
+        self.bp_store = None
+        if new_channels:
+            ladder_channel = self.ladder_channel_var.get()
+            self._populate_channel_lists({ch for data in self.loaded_data.values() for ch in data})
+            if ladder_channel in self.ladder_channel_menu['values']:
+                self.ladder_channel_var.set(ladder_channel)
+
+        if self.plot_viewer and self.plot_viewer.winfo_exists():
+            self.plot_viewer.append_sample_peaks(full_path)
+        calibrated_count = sum(1 for cal in self.calibrations.values() if cal is not None)
+        self.calibration_status_label.config(text=f"Estado: Calibradas {calibrated_count} de {len(self.fsa_files)} muestras.", foreground="green" if calibrated_count == len(self.fsa_files) else "orange")
+        self.update_ui_state()
+
     def update_ui_state(self):
         files_loaded = bool(self.fsa_files)
         calibrated_at_least_one = any(cal is not None for cal in self.calibrations.values())
@@ -1225,32 +4360,103 @@ class AnalizadorFSA:
     
     def process_files(self):
         self.loaded_data = {}; all_channels = set(); failed_files = []
+        self.sample_metadata = {}; self.drift_model = None
+        self.bp_store = None
+        PEAK_CACHE.clear()
         for f in self.fsa_files:
             try:
-                with open(f, 'rb') as handle: record = SeqIO.read(handle, 'abi')
-                filename = Path(f).name; self.loaded_data[filename] = {}
-                abif_raw = record.annotations.get('abif_raw', {})
-                available_channels = [key for key in abif_raw.keys() if key.startswith('DATA')]
-                all_channels.update(available_channels)
-                for channel in available_channels: self.loaded_data[filename][channel] = np.array(abif_raw[channel])
+                channels, metadata = read_fsa_file(f, profile_channels())
+                self.loaded_data[Path(f).name] = channels
+                self.sample_metadata[Path(f).name] = metadata
+                all_channels.update(channels)
             except Exception as e: failed_files.append(f"{Path(f).name}: {e}")
         if failed_files: messagebox.showwarning("Error de Archivo", "No se pudieron procesar algunos archivos:\n\n" + "\n".join(failed_files))
         
-        canales_muestra_deseados = ['DATA9', 'DATA10', 'DATA11']
-        canales_marcador_deseados = ['DATA4', 'DATA105']
+        self._populate_channel_lists(all_channels)
+
+        # Inicio útil de cada archivo (frente de primer / saturación), calculado en un solo pase por lotes
+        starts = detect_data_start([combine_start_channels(channels) for channels in self.loaded_data.values()])
+        self.data_start_scans = dict(zip(self.loaded_data.keys(), starts.tolist()))
+        for filename, start in self.data_start_scans.items():
+            metadata = self.sample_metadata[filename]
+            metadata["saturation"] = trim_saturation(metadata.get("saturation", {}), start)
+        self._rebuild_sample_index()
+
+    def _rebuild_sample_index(self):
+        """Reconstruye el índice de metadatos de los archivos actuales y muestra la lista completa seleccionada."""
+        self.sample_index = SampleIndex(self.fsa_files, self.sample_metadata)
+        self._listed_files = []
+        self.file_listbox.delete(0, tk.END)
+        self._refresh_file_list(also_select=self.fsa_files)
+
+    def selected_files(self):
+        """Rutas de las muestras seleccionadas en la lista, en el orden en que se muestran."""
+        return [self._listed_files[i] for i in self.file_listbox.curselection()]
+
+    def _refresh_file_list(self, also_select=()):
+        """Vuelve a llenar la lista aplicando el filtro y el orden actuales; conserva la selección."""
+        selected = set(self.selected_files()) | set(also_select)
+        index = self.sample_index
+        column = next((key for key, label in SAMPLE_INDEX_COLUMNS.items() if label == self.file_sort_var.get()), "file")
+        rows = index.order(column, index.match(self.file_filter_var.get()))
+        self._listed_files = [index.paths[i] for i in rows]
+        self.file_listbox.delete(0, tk.END)
+        for i, path in zip(rows, self._listed_files):
+            details = [str(index.value(i, key)) for key in ("well", "plate") if index.value(i, key) is not None]
+            if index.value(i, "capillary") is not None:
+                details.append(f"cap. {index.value(i, 'capillary')}")
+            if index.value(i, "saturated") is not None:
+                details.append(f"⚠ saturado: {index.value(i, 'saturated')}")
+            self.file_listbox.insert(tk.END, f"{Path(path).name}   [{' · '.join(details)}]" if details else Path(path).name)
+            if path in selected:
+                self.file_listbox.select_set(tk.END)
+        groups = index.groups(column, rows) if column != "file" else {}
+        self.file_group_menu['values'] = ["" if value is None else str(value) for value in groups]
+        self.file_group_var.set("")
+
+    def _select_file_group(self):
+        """Selecciona en la lista solo las muestras del grupo elegido (según la columna de orden)."""
+        column = next((key for key, label in SAMPLE_INDEX_COLUMNS.items() if label == self.file_sort_var.get()), "file")
+        value = self.file_group_var.get()
+        positions = {path: i for i, path in enumerate(self.sample_index.paths)}
+        self.file_listbox.select_clear(0, tk.END)
+        for row, path in enumerate(self._listed_files):
+            current = self.sample_index.value(positions[path], column)
+            if ("" if current is None else str(current)) == value:
+                self.file_listbox.select_set(row)
+
+    def _populate_channel_lists(self, all_channels):
+        """Rellena la lista de canales de muestra y el selector del canal marcador."""
         self.sample_channel_listbox.delete(0, tk.END)
-        for channel in canales_muestra_deseados:
-             if channel in all_channels: self.sample_channel_listbox.insert(tk.END, channel)
-        
-        ladder_channels_filtrados = [ch for ch in canales_marcador_deseados if ch in all_channels]
+        sample_channels = [ch for ch in SAMPLE_CHANNELS if ch in all_channels]
+        if not sample_channels:
+            # Archivo de otro instrumento: se ofrecen todos sus canales
+            sample_channels = sorted((ch for ch in all_channels if ch not in LADDER_CHANNELS), key=lambda x: int(x[4:]))
+        for channel in sample_channels:
+            self.sample_channel_listbox.insert(tk.END, channel)
+
+        ladder_channels_filtrados = [ch for ch in LADDER_CHANNELS if ch in all_channels]
         if not ladder_channels_filtrados:
             ladder_channels_filtrados = sorted(list(all_channels), key=lambda x: int(x[4:]))
         
         self.ladder_channel_menu['values'] = ladder_channels_filtrados
-        if 'DATA4' in ladder_channels_filtrados: self.ladder_channel_var.set('DATA4')
-        elif ladder_channels_filtrados: self.ladder_channel_var.set(ladder_channels_filtrados[0])
+        if ladder_channels_filtrados: self.ladder_channel_var.set(ladder_channels_filtrados[0])
 
 if __name__ == "__main__":
+    # Necesario para los procesos del informe en el ejecutable empaquetado (Windows)
+    import multiprocessing
+    multiprocessing.freeze_support()
+    if "--serve" in sys.argv:
+        # Modo servicio sin interfaz: python PeakProAnalyzer.py --serve [--host H] [--port N] [--data-dir D]
+        import argparse
+        parser = argparse.ArgumentParser(description="Servicio local de análisis de .fsa (HTTP/JSON)")
+        parser.add_argument("--serve", action="store_true")
+        parser.add_argument("--host", default=SERVICE_HOST)
+        parser.add_argument("--port", type=int, default=SERVICE_PORT)
+        parser.add_argument("--data-dir", help="Directorio desde el que /load puede leer archivos por ruta (sin él, solo se aceptan subidas)")
+        args = parser.parse_args()
+        serve_analysis(args.host, args.port, args.data_dir)
+        sys.exit(0)
     # La magia empieza aquí: usamos ThemedTk si está disponible
     try:
         from ttkthemes import ThemedTk
@@ -1268,22 +4474,23 @@ if __name__ == "__main__":
     # 1. Ocultar la ventana principal inmediatamente
     root.withdraw() 
     
-    # 2. Definimos la función que lanzará la aplicación principal
+    # 2. Definimos la función que mostrará la aplicación principal (ya creada detrás de la portada)
     def launch_main_app():
         splash.destroy()
         root.deiconify()
-        
-        try:
-            path_icono = resource_path("icono.png")
-            root.iconphoto(True, tk.PhotoImage(file=path_icono))
-        except tk.TclError:
-            print("No se encontró 'icono.png', se usará el icono por defecto.")
-        
-        # ¡IMPORTANTE! La instancia de la app se sigue creando aquí
-        app = AnalizadorFSA(root)
 
     # 3. Creamos y mostramos la portada, pasándole la función de lanzamiento
     splash = SplashScreen(root, launch_callback=launch_main_app)
-    
-    # 4. Iniciamos el bucle principal.
+    splash.update()
+
+    # 4. Mientras se ve la portada: módulos pesados en segundo plano y ventana principal oculta
+    preload_heavy_modules()
+    try:
+        path_icono = resource_path("icono.png")
+        root.iconphoto(True, tk.PhotoImage(file=path_icono))
+    except tk.TclError:
+        print("No se encontró 'icono.png', se usará el icono por defecto.")
+    app = AnalizadorFSA(root)
+
+    # 5. Iniciamos el bucle principal.
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Banco de pruebas de rendimiento de PeakPro Analyzer.
+
+Genera archivos ABIF (.fsa) sintéticos y ejecuta sin interfaz gráfica las etapas
+de carga, calibración, detección de picos, renderizado y exportación, midiendo el
+tiempo y el pico de memoria de cada una. El informe se guarda en JSON para poder
+compararlo entre versiones:
+
+    python benchmark.py --samples 96 --output bench_nueva.json --compare bench_anterior.json
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+import PeakProAnalyzer as ppa
+
+
+# --- Escritura de archivos ABIF ---
+ABIF_SHORT = 4
+ABIF_PSTRING = 18
+
+def write_abif(path, tags):
+    """
+    Escribe un archivo ABIF mínimo. 'tags' es una lista de (nombre, número, tipo,
+    tamaño de elemento, nº de elementos, bytes de datos).
+    """
+    header_size = 128
+    blocks = bytearray()
+    entries = []
+    for name, number, elem_type, elem_size, num_elements, data in tags:
+        if len(data) <= 4:
+            # Los datos de hasta 4 bytes van dentro de la propia entrada del directorio
+            offset_field = data.ljust(4, b'\x00')
+        else:
+            offset_field = struct.pack('>I', header_size + len(blocks))
+            blocks.extend(data)
+        entries.append(struct.pack('>4sIHHII', name.encode('ascii'), number, elem_type, elem_size, num_elements, len(data)) + offset_field + struct.pack('>I', 0))
+
+    dir_offset = header_size + len(blocks)
+    header = b'ABIF' + struct.pack('>H4sIHHIIII', 101, b'tdir', 1, 1023, 28, len(entries), len(entries) * 28, dir_offset, 0)
+    with open(path, 'wb') as f:
+        f.write(header.ljust(header_size, b'\x00'))
+        f.write(blocks)
+        f.write(b''.join(entries))
+
+def _short_tag(name, number, values):
+    values = np.asarray(values, dtype='>i2')
+    return (name, number, ABIF_SHORT, 2, len(values), values.tobytes())
+
+def _pstring_tag(name, number, text):
+    raw = text.encode('ascii')
+    return (name, number, ABIF_PSTRING, 1, len(raw) + 1, bytes([len(raw)]) + raw)
+
+
+# --- Generador de muestras sintéticas ---
+def synthetic_scan_positions(sizes_bp, n_scans, max_bp, shift=0.0):
+    """Posición (scan) de cada tamaño: relación creciente y ligeramente no lineal, como en un capilar real."""
+    offset = 0.2 * n_scans + shift
+    span = 0.75 * n_scans
+    return offset + span * (np.asarray(sizes_bp, dtype=float) / max_bp) ** 0.95
+
+def _gaussian_peaks(n_scans, centers, heights, widths):
+    x = np.arange(n_scans, dtype=float)
+    trace = np.zeros(n_scans)
+    for center, height, width in zip(centers, heights, widths):
+        lo = max(0, int(center - 6 * width)); hi = min(n_scans, int(center + 6 * width) + 1)
+        trace[lo:hi] += height * np.exp(-0.5 * ((x[lo:hi] - center) / width) ** 2)
+    return trace
+
+def generate_synthetic_fsa(path, rng, n_scans=8000, ladder_name="GeneScan 500(-250) ROX", noise=8.0, peak_density=2.0, well="A01", capillary=1):
+    """
+    Escribe un .fsa sintético con el marcador en DATA4 y tres canales de muestra (DATA9-11).
+    Devuelve las posiciones reales (scan) de los picos del marcador {pb: scan}.
+    """
+    ladder_sizes = ppa.KNOWN_LADDERS[ladder_name]
+    max_bp = max(ladder_sizes) + 20
+    shift = rng.normal(0, 0.004 * n_scans)
+    x = np.arange(n_scans, dtype=float)
+    baseline = 40 + 20 * np.sin(x / n_scans * np.pi)
+    primer_front = 6000 * np.exp(-0.5 * ((x - 0.12 * n_scans) / (0.015 * n_scans)) ** 2)
+
+    ladder_scans = synthetic_scan_positions(ladder_sizes, n_scans, max_bp, shift)
+    widths = 2.5 + ladder_scans / 3000
+    ladder = _gaussian_peaks(n_scans, ladder_scans, rng.uniform(800, 1500, len(ladder_sizes)), widths)
+    channels = {'DATA4': ladder + baseline + 0.3 * primer_front}
+
+    n_peaks = max(1, int(round(peak_density * (max(ladder_sizes) - min(ladder_sizes)) / 100)))
+    for tag in ('DATA9', 'DATA10', 'DATA11'):
+        sizes = rng.uniform(min(ladder_sizes), max(ladder_sizes), n_peaks)
+        scans = synthetic_scan_positions(sizes, n_scans, max_bp, shift)
+        channels[tag] = _gaussian_peaks(n_scans, scans, rng.uniform(200, 4000, n_peaks), 2.5 + scans / 3000) + baseline + primer_front
+
+    tags = []
+    for tag, trace in channels.items():
+        trace = trace + rng.normal(0, noise, n_scans)
+        tags.append(_short_tag('DATA', int(tag[4:]), np.clip(np.round(trace), -32768, 32767)))
+    tags.append(_pstring_tag('SMPL', 1, Path(path).stem))
+    tags.append(_pstring_tag('TUBE', 1, well))
+    tags.append(_short_tag('LANE', 1, [capillary]))
+    write_abif(path, tags)
+    return {bp: int(round(scan)) for bp, scan in zip(ladder_sizes, ladder_scans)}
+
+
+# --- Etapas medidas ---
+PEAK_TABLE_HEADERS = ['Archivo', 'Canal', 'Tamaño (pb)', 'Altura (RFU)']
+
+def stage_load(ctx):
+    """Equivalente a AnalizadorFSA.process_files: lectura de canales e inicio útil por lotes."""
+    ctx['loaded'] = {Path(p).name: ppa.read_fsa_channels(p, ppa.profile_channels()) for p in ctx['paths']}
+    combined = [ppa.combine_start_channels(channels) for channels in ctx['loaded'].values()]
+    ctx['starts'] = dict(zip(ctx['loaded'], ppa.detect_data_start(combined).tolist()))
+    return len(ctx['loaded'])
+
+def stage_calibrate(ctx):
+    """Asistente de calibración sin interfaz: detección del marcador y asignación por plantilla."""
+    params = ppa.DEFAULT_DETECTION_PARAMS
+    ctx['calibrations'] = {}
+    for path in ctx['paths']:
+        name = Path(path).name
+        ctx['calibrations'][path] = ppa.auto_calibrate(ctx['loaded'][name]['DATA4'], ctx['starts'][name], ctx['template'], params)
+    return sum(1 for cal in ctx['calibrations'].values() if cal is not None)
+
+def stage_detect(ctx):
+    """Equivalente a 'Encontrar Picos' del visor: limpieza de línea base, find_peaks y tamaño en pb."""
+    min_height = float(ppa.DEFAULT_DETECTION_PARAMS['peak_height'])
+    rows = []
+    for path, calib_data in ctx['calibrations'].items():
+        if calib_data is None: continue
+        name = Path(path).name
+        for channel in ppa.SAMPLE_CHANNELS:
+            sizes_bp, heights = ppa.detect_sample_peaks(ctx['loaded'][name][channel], calib_data[0], min_height)
+            display_name = ppa.CHANNEL_DISPLAY_NAME_MAP.get(channel, channel)
+            rows.extend((name, display_name, f"{size:.1f}", f"{height:.0f}") for size, height in zip(sizes_bp, heights))
+    ctx['rows'] = rows
+    return len(rows)
+
+def stage_render(ctx):
+    """Renderizado Agg del modo apilado del visor para las primeras muestras calibradas."""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    paths = [p for p, cal in ctx['calibrations'].items() if cal is not None][:ctx['render_samples']]
+    if not paths:
+        return 0
+    fig = Figure(figsize=(10, 8), dpi=100)
+    FigureCanvasAgg(fig)
+    axs = fig.subplots(len(paths), 1, sharex=True, squeeze=False).flatten()
+    for ax, path in zip(axs, paths):
+        name = Path(path).name
+        ppa.draw_sample_axes(ax, name, ctx['loaded'][name], ctx['calibrations'][path], ppa.SAMPLE_CHANNELS, 'DATA4', (50, 500))
+    fig.tight_layout()
+    fig.canvas.draw()
+    return len(paths)
+
+def stage_export(ctx):
+    """Exportación a Excel de la tabla de picos (mismo libro que genera el visor)."""
+    params = {"Archivos Analizados": len(ctx['paths']), "Tipo de Marcador": ctx['ladder']}
+    ppa.write_peak_workbook(os.path.join(ctx['workdir'], 'benchmark.xlsx'), PEAK_TABLE_HEADERS, ctx['rows'], params)
+    return len(ctx['rows'])
+
+def stage_stream(ctx):
+    """Tubería por bloques completa (carga a CSV) sin 'loaded_data': su memoria no depende del número de archivos."""
+    params = ppa.DEFAULT_DETECTION_PARAMS
+    results = ppa.stream_batch(ctx['paths'], ctx['template'], params, 'DATA4', ppa.SAMPLE_CHANNELS, float(params['peak_height']))
+    summary = ppa.export_stream(results, os.path.join(ctx['workdir'], 'benchmark_stream.csv'))
+    return summary['files']
+
+STAGES = [("load", stage_load), ("calibrate", stage_calibrate), ("detect", stage_detect), ("render", stage_render), ("export", stage_export),
+          ("stream", stage_stream)]
+
+
+# Arranque en frío en un proceso nuevo: importación del módulo y, si hay pantalla, creación de la ventana principal
+STARTUP_SNIPPET = """
+import json, sys, time
+t0 = time.perf_counter()
+import PeakProAnalyzer
+t1 = time.perf_counter()
+window_s = None
+try:
+    import tkinter as tk
+    root = tk.Tk(); root.withdraw()
+    PeakProAnalyzer.AnalizadorFSA(root); root.update_idletasks()
+    window_s = time.perf_counter() - t1
+    root.destroy()
+except Exception:
+    pass
+print(json.dumps({"import_s": t1 - t0, "window_s": window_s}))
+"""
+
+def measure_startup(repeats, target_s):
+    """Mediana de varios arranques en frío; el objetivo se compara con el tiempo total del proceso."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    totals, imports, windows = [], [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", STARTUP_SNIPPET], cwd=here, capture_output=True, text=True, check=True)
+        totals.append(time.perf_counter() - start)
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        imports.append(timings["import_s"])
+        if timings["window_s"] is not None:
+            windows.append(timings["window_s"])
+    total = statistics.median(totals)
+    return {
+        "seconds": total, "import_s": statistics.median(imports),
+        "window_s": statistics.median(windows) if windows else None,
+        "target_s": target_s, "met": total <= target_s, "items": repeats,
+    }
+
+def measure(func, ctx, track_memory):
+    """Ejecuta una etapa y devuelve (segundos, MB de pico, elementos procesados)."""
+    start = time.perf_counter()
+    items = func(ctx)
+    elapsed = time.perf_counter() - start
+    peak_mb = None
+    if track_memory:
+        # Segunda pasada con tracemalloc para que su coste no contamine el tiempo medido
+        tracemalloc.start()
+        func(ctx)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return elapsed, peak_mb, items
+
+def run_benchmark(args):
+    rng = np.random.default_rng(args.seed)
+    stages = {}
+    if not args.skip_startup:
+        stages['startup'] = measure_startup(args.startup_repeats, args.startup_target)
+        startup = stages['startup']
+        print(f"{'startup':<10} {startup['seconds']:8.3f} s  (objetivo {startup['target_s']:.2f} s: {'cumplido' if startup['met'] else 'NO cumplido'})")
+
+    # Igual que la aplicación durante la portada: los módulos pesados se importan antes de medir las etapas
+    for name in ppa.HEAVY_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.keep_files or tmp
+        os.makedirs(workdir, exist_ok=True)
+        ctx = {'workdir': workdir, 'ladder': args.ladder, 'render_samples': args.render_samples, 'paths': []}
+
+        start = time.perf_counter()
+        truths = []
+        for i in range(args.samples):
+            path = os.path.join(workdir, f"muestra_{i + 1:04d}.fsa")
+            well = f"{'ABCDEFGH'[(i // 12) % 8]}{i % 12 + 1:02d}"
+            truths.append(generate_synthetic_fsa(path, rng, args.scans, args.ladder, args.noise, args.peak_density, well, i % 16 + 1))
+            ctx['paths'].append(path)
+        stages['generate'] = {"seconds": time.perf_counter() - start, "items": args.samples}
+        # La plantilla es la que un usuario asignaría a mano en la primera muestra
+        ctx['template'] = {float(bp): scan for bp, scan in truths[0].items()}
+
+        for name, func in STAGES:
+            seconds, peak_mb, items = measure(func, ctx, not args.no_memory)
+            stages[name] = {"seconds": seconds, "peak_mb": peak_mb, "items": items}
+            print(f"{name:<10} {seconds:8.3f} s  {'' if peak_mb is None else f'{peak_mb:8.1f} MB'}  ({items} elementos)")
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "params": {"samples": args.samples, "scans": args.scans, "ladder": args.ladder, "noise": args.noise,
+                       "peak_density": args.peak_density, "seed": args.seed, "render_samples": args.render_samples},
+        },
+        "stages": stages,
+    }
+
+def print_comparison(report, baseline):
+    """Muestra lado a lado el tiempo de cada etapa frente a un informe anterior."""
+    print(f"\n{'Etapa':<12}{'Anterior (s)':>14}{'Actual (s)':>14}{'Relación':>10}")
+    for name, current in report["stages"].items():
+        previous = baseline.get("stages", {}).get(name)
+        if not previous:
+            continue
+        ratio = current["seconds"] / previous["seconds"] if previous["seconds"] else float('nan')
+        print(f"{name:<12}{previous['seconds']:>14.3f}{current['seconds']:>14.3f}{ratio:>9.2f}x")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banco de pruebas de rendimiento de PeakPro Analyzer.")
+    parser.add_argument("--samples", type=int, default=24, help="Número de archivos .fsa sintéticos")
+    parser.add_argument("--scans", type=int, default=8000, help="Longitud de cada traza (scans)")
+    parser.add_argument("--ladder", default=list(ppa.KNOWN_LADDERS)[0], choices=list(ppa.KNOWN_LADDERS), help="Marcador de tamaños")
+    parser.add_argument("--noise", type=float, default=8.0, help="Desviación típica del ruido (RFU)")
+    parser.add_argument("--peak-density", type=float, default=2.0, help="Picos por cada 100 pb en cada canal de muestra")
+    parser.add_argument("--render-samples", type=int, default=8, help="Muestras dibujadas en la etapa de renderizado")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-target", type=float, default=1.0, help="Objetivo de arranque en frío (s)")
+    parser.add_argument("--startup-repeats", type=int, default=3, help="Arranques en frío medidos")
+    parser.add_argument("--skip-startup", action="store_true", help="No medir el arranque en frío")
+    parser.add_argument("--no-memory", action="store_true", help="No medir el pico de memoria (más rápido)")
+    parser.add_argument("--keep-files", metavar="DIR", help="Conservar los archivos generados en este directorio")
+    parser.add_argument("--output", default="benchmark.json", help="Informe JSON de salida")
+    parser.add_argument("--compare", metavar="JSON", help="Informe anterior con el que comparar")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nInforme guardado en {args.output}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print_comparison(report, json.load(f))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""
+Comprobación de resultados de referencia ("golden") de PeakPro Analyzer.
+
+Ejecuta sin interfaz las etapas de análisis (lectura, inicio útil, calibración por
+plantilla, tamaño en pb, limpieza de línea base y detección de picos) sobre un corpus
+de archivos .fsa sintéticos (el generador de benchmark.py) y, opcionalmente, de archivos
+reales. 'record' guarda calibraciones, trazas limpias y tablas de picos junto con el
+tiempo de cada etapa; 'check' vuelve a ejecutar el análisis, comprueba que los
+resultados coinciden dentro de la tolerancia y muestra los tiempos lado a lado:
+
+    python golden_check.py record --output golden.json
+    python golden_check.py check --golden golden.json
+    python golden_check.py check --golden golden.json --module ../rama_nueva/PeakProAnalyzer.py
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import benchmark
+
+# Un punto de la calibración cada tantos scans y un valor de la traza limpia cada tantos
+SIZING_PROBE_STEP = 25
+CLEAN_PROBE_STEP = 10
+# Diferencias que se listan por categoría antes de resumir
+MAX_REPORTED = 10
+
+STAGE_NAMES = ["load", "start", "calibrate", "sizing", "clean", "detect"]
+
+
+def load_module(path):
+    """Módulo de análisis a comprobar: el del árbol actual o un PeakProAnalyzer.py alternativo."""
+    if path is None:
+        return benchmark.ppa
+    spec = importlib.util.spec_from_file_location("peakpro_candidate", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# --- Corpus ---
+def build_corpus(workdir, params, fsa_paths, template_path, ladder_channel):
+    """
+    Genera los archivos sintéticos (deterministas para una semilla) y añade los reales.
+    Devuelve [(ruta, plantilla, canal del marcador)].
+    """
+    rng = np.random.default_rng(params["seed"])
+    corpus, truths = [], []
+    for i in range(params["samples"]):
+        path = os.path.join(workdir, f"sintetica_{i + 1:04d}.fsa")
+        well = f"{'ABCDEFGH'[(i // 12) % 8]}{i % 12 + 1:02d}"
+        truths.append(benchmark.generate_synthetic_fsa(path, rng, params["scans"], params["ladder"], params["noise"],
+                                                       params["peak_density"], well, i % 16 + 1))
+        corpus.append(path)
+    # Como en benchmark.py: la plantilla es la que se asignaría a mano en la primera muestra
+    synthetic_template = {float(bp): scan for bp, scan in truths[0].items()} if truths else None
+    items = [(path, synthetic_template, 'DATA4') for path in corpus]
+
+    if fsa_paths:
+        with open(template_path, 'r') as f:
+            template = {float(k): int(v) for k, v in json.load(f).items()}
+        for entry in fsa_paths:
+            entry = Path(entry)
+            files = sorted(entry.glob("*.fsa")) if entry.is_dir() else [entry]
+            items.extend((str(path), template, ladder_channel) for path in files)
+    return items
+
+
+# --- Análisis de referencia ---
+def analyze_corpus(ppa, items):
+    """
+    Ejecuta las etapas sobre todo el corpus con las funciones de 'ppa' y devuelve
+    (resultados por archivo, segundos por etapa). Sin cache_key: nada sale de PEAK_CACHE.
+    """
+    params = ppa.DEFAULT_DETECTION_PARAMS
+    min_height = float(params["peak_height"])
+    timings = dict.fromkeys(STAGE_NAMES, 0.0)
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        timings[stage] += time.perf_counter() - start
+        return result
+
+    loaded = [timed("load", ppa.read_fsa_channels, path, ppa.profile_channels()) for path, _, _ in items]
+    starts = timed("start", ppa.detect_data_start, [ppa.combine_start_channels(channels) for channels in loaded]).tolist()
+
+    results = []
+    for (path, template, ladder_channel), channels, start in zip(items, loaded, starts):
+        entry = {"file": Path(path).name, "start": int(start), "calibration": None, "cleaned": {}, "peaks": {}}
+        sample_channels = [ch for ch in ppa.SAMPLE_CHANNELS if ch in channels]
+        for channel in sample_channels:
+            cleaned = timed("clean", ppa.clean_trace_hammock, channels[channel])
+            entry["cleaned"][channel] = np.round(cleaned[::CLEAN_PROBE_STEP], 4).tolist()
+
+        calibration = None
+        if template and ladder_channel in channels:
+            calibration = timed("calibrate", ppa.auto_calibrate, channels[ladder_channel], start, template, params)
+        if calibration is not None:
+            calib_func, assignments = calibration
+            n_scans = len(channels[ladder_channel])
+            sizes = timed("sizing", calib_func, np.arange(n_scans))
+            entry["calibration"] = {
+                "assignments": sorted([int(scan), float(bp)] for scan, bp in assignments.items()),
+                "sizes": np.round(sizes[start::SIZING_PROBE_STEP], 4).tolist(),
+            }
+            for channel in sample_channels:
+                sizes_bp, heights = timed("detect", ppa.detect_sample_peaks, channels[channel], calib_func, min_height)
+                entry["peaks"][channel] = [[round(float(s), 4), round(float(h), 4)] for s, h in zip(sizes_bp, heights)]
+        results.append(entry)
+    return results, timings
+
+def run_analysis(ppa, items, repeats):
+    """Resultados de la primera pasada y mediana de los tiempos de todas."""
+    # Pasada previa sin medir: importaciones diferidas (scipy) y primeras llamadas
+    analyze_corpus(ppa, items[:1])
+    results, runs = None, []
+    for _ in range(repeats):
+        current, timings = analyze_corpus(ppa, items)
+        results = results or current
+        runs.append(timings)
+    return results, {stage: statistics.median(run[stage] for run in runs) for stage in STAGE_NAMES}
+
+
+# --- Comparación ---
+def max_abs_difference(reference, current):
+    reference = np.asarray(reference, dtype=float); current = np.asarray(current, dtype=float)
+    if reference.shape != current.shape:
+        return None
+    return float(np.max(np.abs(reference - current))) if reference.size else 0.0
+
+def compare_results(golden, current, tolerances):
+    """Devuelve {categoría: [diferencias]} entre los resultados de referencia y los actuales."""
+    issues = {name: [] for name in ("corpus", "start", "calibration", "sizing", "clean", "peaks", "database")}
+    current_by_file = {entry["file"]: entry for entry in current}
+    for reference in golden:
+        name = reference["file"]
+        entry = current_by_file.get(name)
+        if entry is None:
+            issues["corpus"].append(f"{name}: falta en el corpus actual"); continue
+
+        if abs(reference["start"] - entry["start"]) > tolerances["scan"]:
+            issues["start"].append(f"{name}: inicio {reference['start']} -> {entry['start']}")
+
+        for channel, trace in reference["cleaned"].items():
+            difference = max_abs_difference(trace, entry["cleaned"].get(channel, []))
+            if difference is None or difference > tolerances["rfu"]:
+                issues["clean"].append(f"{name} {channel}: línea base " + ("con otra longitud" if difference is None else f"difiere {difference:.3f} RFU"))
+
+        ref_cal, cal = reference["calibration"], entry["calibration"]
+        if (ref_cal is None) != (cal is None):
+            issues["calibration"].append(f"{name}: {'calibrada' if ref_cal else 'sin calibrar'} -> {'calibrada' if cal else 'sin calibrar'}")
+            continue
+        if ref_cal is None:
+            continue
+        ref_points = {bp: scan for scan, bp in ref_cal["assignments"]}
+        points = {bp: scan for scan, bp in cal["assignments"]}
+        if set(ref_points) != set(points):
+            missing = sorted(set(ref_points) - set(points)); extra = sorted(set(points) - set(ref_points))
+            issues["calibration"].append(f"{name}: tamaños asignados distintos (faltan {missing}, sobran {extra})")
+        else:
+            moved = [bp for bp in ref_points if abs(ref_points[bp] - points[bp]) > tolerances["scan"]]
+            if moved:
+                issues["calibration"].append(f"{name}: {len(moved)} puntos del marcador en otro scan ({moved[:5]})")
+        difference = max_abs_difference(ref_cal["sizes"], cal["sizes"])
+        if difference is None or difference > tolerances["bp"]:
+            issues["sizing"].append(f"{name}: tamaño en pb " + ("con otra longitud" if difference is None else f"difiere {difference:.4f} pb"))
+
+        for channel, ref_peaks in reference["peaks"].items():
+            peaks = entry["peaks"].get(channel, [])
+            if len(ref_peaks) != len(peaks):
+                issues["peaks"].append(f"{name} {channel}: {len(ref_peaks)} -> {len(peaks)} picos"); continue
+            if not peaks: continue
+            size_difference = max_abs_difference([p[0] for p in ref_peaks], [p[0] for p in peaks])
+            height_difference = max_abs_difference([p[1] for p in ref_peaks], [p[1] for p in peaks])
+            if size_difference > tolerances["bp"] or height_difference > tolerances["rfu"]:
+                issues["peaks"].append(f"{name} {channel}: picos difieren {size_difference:.4f} pb / {height_difference:.3f} RFU")
+    return issues
+
+def check_database_round_trip(ppa, results):
+    """Guarda las calibraciones en una base de datos de proyecto en memoria y comprueba que se leen igual."""
+    samples = [{"filename": entry["file"],
+                "assignments": {scan: bp for scan, bp in entry["calibration"]["assignments"]} if entry["calibration"] else None}
+               for entry in results]
+    # Los marcadores sintéticos solo tienen tamaños enteros: una muestra de control con decimales
+    samples.append({"filename": "_control_decimales.fsa", "assignments": {2300: 50.5, 2415: 75.25, 2650: 139.0}})
+    with ppa.ProjectDatabase(":memory:") as db:
+        stored = db.run_calibrations(db.add_run("golden", samples))
+    return [f"{sample['filename']}: puntos guardados {stored.get(sample['filename'])} != {sample['assignments']}"
+            for sample in samples if stored.get(sample["filename"]) != sample["assignments"]]
+
+def check_drift_model(ppa, results):
+    """
+    Modelo de deriva con 0, 1 y 2 muestras observadas: hasta tener dos ajustes se mantiene la
+    tolerancia del usuario, y después solo puede reducirse. Una muestra reobservada no cuenta dos veces.
+    """
+    calibrated = [entry["calibration"]["assignments"] for entry in results if entry["calibration"]]
+    if len(calibrated) < 2:
+        return []
+    tolerance = int(ppa.DEFAULT_DETECTION_PARAMS["template_tolerance"])
+    model = ppa.DriftModel({bp: scan for scan, bp in calibrated[0]})
+    found = []
+    for n_fits, points in enumerate([None] + calibrated[:2]):
+        if points is not None:
+            model.observe(1, {scan: bp for scan, bp in points})
+        try:
+            _, effective = model.template_for(1, tolerance)
+        except Exception as e:
+            found.append(f"{n_fits} ajustes: {type(e).__name__}: {e}"); continue
+        if effective is None or effective > tolerance or (n_fits < 2 and effective != tolerance):
+            found.append(f"{n_fits} ajustes: tolerancia {effective} con la del usuario en {tolerance}")
+    # Un archivo reescrito se vuelve a observar con la misma clave: sustituye su ajuste
+    before = len(model)
+    try:
+        for _ in range(2):
+            model.observe(2, {scan: bp for scan, bp in calibrated[0]}, key="reescrita.fsa")
+    except Exception as e:
+        found.append(f"muestra reobservada: {type(e).__name__}: {e}")
+    else:
+        if len(model) != before + 1:
+            found.append(f"observar dos veces la misma muestra deja {len(model) - before} ajustes")
+    return found
+
+def check_service(ppa, items, results):
+    """
+    Cliente local contra el servicio HTTP en un puerto libre: cargar un canal y luego el archivo
+    completo no mezcla las entradas, dos calibraciones simultáneas del mismo archivo no se pisan
+    y /detect devuelve los mismos picos que detect_sample_peaks.
+    """
+    import base64
+    import threading
+    import urllib.request
+    from concurrent.futures import ThreadPoolExecutor
+
+    sample = next(((item, entry) for item, entry in zip(items, results) if item[1] and entry["calibration"]), None)
+    if sample is None:
+        return []
+    (path, template, ladder_channel), expected = sample
+    with open(path, 'rb') as f:
+        upload = {"filename": Path(path).name, "content_base64": base64.b64encode(f.read()).decode('ascii')}
+
+    server = ppa.create_analysis_server("127.0.0.1", 0, workers=2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def post(endpoint, payload):
+        request = urllib.request.Request(url + endpoint, json.dumps(payload).encode('utf-8'), {"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return json.loads(response.read())
+
+    found = []
+    try:
+        post("/load", {**upload, "channels": [ladder_channel]})
+        loaded = post("/load", upload)
+        missing = [ch for ch in expected["peaks"] if ch not in loaded["channels"]]
+        if missing:
+            found.append(f"/load tras cargar solo {ladder_channel}: faltan los canales {missing}")
+            return found
+        # Dos clientes calibran a la vez el mismo archivo: uno con la plantilla, otro con puntos desplazados
+        shifted = {str(scan + 40): bp for scan, bp in expected["calibration"]["assignments"]}
+        requests = [{"file_id": loaded["file_id"], "template": {str(bp): scan for bp, scan in template.items()},
+                     "ladder_channel": ladder_channel},
+                    {"file_id": loaded["file_id"], "assignments": shifted}]
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            own, other = pool.map(lambda payload: post("/calibrate", payload), requests)
+        if own["calibration_id"] == other["calibration_id"]:
+            found.append("dos calibraciones distintas comparten calibration_id")
+        detected = post("/detect", {"calibration_id": own["calibration_id"]})["peaks"]
+        for channel, peaks in expected["peaks"].items():
+            served = [[peak["size_bp"], peak["height"]] for peak in detected if peak["channel"] == channel]
+            if len(served) != len(peaks):
+                found.append(f"/detect {channel}: {len(served)} picos, detect_sample_peaks da {len(peaks)}")
+            elif peaks and np.max(np.abs(np.array(served) - np.array(peaks))) > 0.1:
+                found.append(f"/detect {channel}: los picos no coinciden con detect_sample_peaks")
+    except Exception as e:
+        found.append(f"{type(e).__name__}: {e}")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return found
+
+def print_issues(issues):
+    failed = False
+    print(f"\n{'Comprobación':<14}{'Resultado':>12}")
+    for category, found in issues.items():
+        print(f"{category:<14}{'OK' if not found else f'{len(found)} fallos':>12}")
+    for category, found in issues.items():
+        if not found: continue
+        failed = True
+        print(f"\n[{category}]")
+        for line in found[:MAX_REPORTED]:
+            print(f"  {line}")
+        if len(found) > MAX_REPORTED:
+            print(f"  ... y {len(found) - MAX_REPORTED} más")
+    return failed
+
+def print_timings(reference, current):
+    """Tiempo de cada etapa frente a la referencia; >1x significa más rápido que la referencia."""
+    print(f"\n{'Etapa':<12}{'Referencia (s)':>16}{'Actual (s)':>14}{'Aceleración':>13}")
+    for stage in STAGE_NAMES:
+        before, after = reference.get(stage), current[stage]
+        if before is None: continue
+        speedup = before / after if after else float('inf')
+        print(f"{stage:<12}{before:>16.4f}{after:>14.4f}{speedup:>12.2f}x")
+    total_before = sum(reference.get(stage, 0.0) for stage in STAGE_NAMES)
+    total_after = sum(current.values())
+    print(f"{'total':<12}{total_before:>16.4f}{total_after:>14.4f}{(total_before / total_after if total_after else float('inf')):>12.2f}x")
+
+
+# --- Órdenes ---
+def corpus_params(args):
+    return {"samples": args.samples, "scans": args.scans, "ladder": args.ladder, "noise": args.noise,
+            "peak_density": args.peak_density, "seed": args.seed}
+
+def environment():
+    import scipy
+    return {"python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__}
+
+def record(args):
+    ppa = load_module(args.module)
+    params = corpus_params(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        items = build_corpus(tmp, params, args.fsa, args.template, args.ladder_channel)
+        digests = {Path(path).name: file_digest(path) for path, _, _ in items}
+        results, timings = run_analysis(ppa, items, args.repeats)
+    golden = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), **environment(),
+                 "corpus": params, "fsa": [str(Path(p).resolve()) for p in args.fsa], "ladder_channel": args.ladder_channel,
+                 "template": str(Path(args.template).resolve()) if args.template else None,
+                 "sizing_probe_step": SIZING_PROBE_STEP, "clean_probe_step": CLEAN_PROBE_STEP, "digests": digests},
+        "timings": timings,
+        "results": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(golden, f)
+    n_peaks = sum(len(peaks) for entry in results for peaks in entry["peaks"].values())
+    n_calibrated = sum(1 for entry in results if entry["calibration"])
+    print(f"{len(results)} archivos ({n_calibrated} calibrados, {n_peaks} picos) guardados en {args.output}")
+    return 0
+
+def check(args):
+    with open(args.golden, 'r') as f:
+        golden = json.load(f)
+    meta = golden["meta"]
+    if (meta["sizing_probe_step"], meta["clean_probe_step"]) != (SIZING_PROBE_STEP, CLEAN_PROBE_STEP):
+        print("La referencia se guardó con otro muestreo de resultados: vuelve a ejecutar 'record'.")
+        return 2
+    current_env = environment()
+    changed = [f"{key} {meta.get(key)} -> {value}" for key, value in current_env.items() if meta.get(key) != value]
+    if changed:
+        print("Aviso: el entorno ha cambiado desde la referencia (" + ", ".join(changed) + ")")
+
+    ppa = load_module(args.module)
+    with tempfile.TemporaryDirectory() as tmp:
+        items = build_corpus(tmp, meta["corpus"], meta["fsa"], meta["template"], meta["ladder_channel"])
+        digests = {Path(path).name: file_digest(path) for path, _, _ in items}
+        results, timings = run_analysis(ppa, items, args.repeats)
+        service_issues = check_service(ppa, items, results)
+    issues = compare_results(golden["results"], results, {"scan": args.scan_tol, "bp": args.bp_tol, "rfu": args.rfu_tol})
+    issues["corpus"].extend(f"{name}: el archivo ha cambiado desde la referencia"
+                            for name, digest in meta["digests"].items() if name in digests and digests[name] != digest)
+    issues["database"].extend(check_database_round_trip(ppa, results))
+    issues["drift"] = check_drift_model(ppa, results)
+    issues["service"] = service_issues
+
+    print(f"{len(results)} archivos comparados con {args.golden} ({meta['timestamp']})")
+    failed = print_issues(issues)
+    print_timings(golden["timings"], timings)
+    print("\nResultado: " + ("DIFERENCIAS fuera de tolerancia" if failed else "coincide con la referencia"))
+    return 1 if failed else 0
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--module", metavar="PY", help="PeakProAnalyzer.py alternativo a analizar (por defecto, el de este directorio)")
+    common.add_argument("--repeats", type=int, default=3, help="Pasadas medidas (se usa la mediana de los tiempos)")
+    parser = argparse.ArgumentParser(description="Resultados de referencia de PeakPro Analyzer: guarda y comprueba calibraciones y picos.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", parents=[common], help="Ejecuta el análisis actual y guarda sus resultados como referencia")
+    record_parser.add_argument("--samples", type=int, default=24, help="Número de archivos .fsa sintéticos")
+    record_parser.add_argument("--scans", type=int, default=8000, help="Longitud de cada traza (scans)")
+    record_parser.add_argument("--ladder", default=list(benchmark.ppa.KNOWN_LADDERS)[0], choices=list(benchmark.ppa.KNOWN_LADDERS), help="Marcador de tamaños")
+    record_parser.add_argument("--noise", type=float, default=8.0, help="Desviación típica del ruido (RFU)")
+    record_parser.add_argument("--peak-density", type=float, default=2.0, help="Picos por cada 100 pb en cada canal de muestra")
+    record_parser.add_argument("--seed", type=int, default=0)
+    record_parser.add_argument("--fsa", nargs="*", default=[], metavar="RUTA", help="Archivos .fsa reales o carpetas que los contienen")
+    record_parser.add_argument("--template", metavar="JSON", help="Plantilla de calibración (la que guarda la aplicación) para los archivos reales")
+    record_parser.add_argument("--ladder-channel", default="DATA4", help="Canal del marcador de los archivos reales")
+    record_parser.add_argument("--output", default="golden.json", help="Archivo de referencia de salida")
+
+    check_parser = commands.add_parser("check", parents=[common], help="Compara el análisis actual con la referencia guardada")
+    check_parser.add_argument("--golden", default="golden.json", help="Archivo de referencia")
+    check_parser.add_argument("--scan-tol", type=int, default=0, help="Diferencia admitida en scans (inicio y puntos del marcador)")
+    check_parser.add_argument("--bp-tol", type=float, default=0.01, help="Diferencia admitida en tamaños (pb)")
+    check_parser.add_argument("--rfu-tol", type=float, default=0.01, help="Diferencia admitida en alturas y línea base (RFU)")
+    args = parser.parse_args(argv)
+
+    if args.command == "record" and args.fsa and not args.template:
+        parser.error("--fsa necesita --template para calibrar los archivos reales")
+    return record(args) if args.command == "record" else check(args)
+
+if __name__ == "__main__":
+    sys.exit(main())